@@ -0,0 +1,89 @@
+"""
+Autoscaler - 根据负载弹性调整 worker 数量
+目标 = 运行中 + 现在就能分发的排队任务数（不含退避中、被项目并发上限挡住的），限制在 [min_workers, max_workers] 内；
+扩容还受主机 CPU / 内存余量约束，缩容交给 WorkerManager.resize 优雅 drain
+"""
+import logging
+import os
+from typing import Optional
+
+from worker_manager import WorkerManager
+
+log = logging.getLogger(__name__)
+
+
+def _mem_available_mb() -> Optional[float]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Autoscaler:
+    def __init__(self, wm: WorkerManager, enabled: bool = True):
+        self.wm = wm
+        self.enabled = enabled
+        self.interval = 15  # 检查间隔（秒）
+        # 单个 agent 预估占用，用来换算主机还能再容纳几个
+        self.agent_cpu = float(os.getenv("AGENT_CPU", 1.0))
+        self.agent_mem_mb = float(os.getenv("AGENT_MEM_MB", 1024))
+        self.cpu_limit = float(os.getenv("HOST_CPU_LIMIT", 0.9))    # 允许使用的 CPU 比例
+        self.mem_reserve_mb = float(os.getenv("HOST_MEM_RESERVE_MB", 1024))
+        self.last_reason = ""
+
+    def headroom(self) -> int:
+        """按当前 load average 和可用内存估算还能多跑几个 agent"""
+        limits = []
+        try:
+            load = os.getloadavg()[0]
+            limits.append(((os.cpu_count() or 1) * self.cpu_limit - load) / self.agent_cpu)
+        except OSError:
+            pass
+        mem = _mem_available_mb()
+        if mem is not None:
+            limits.append((mem - self.mem_reserve_mb) / self.agent_mem_mb)
+        if not limits:
+            return self.wm.max_workers
+        return max(0, int(min(limits)))
+
+    def desired(self, queued: int) -> int:
+        """queued: 现在就能分发的排队任务数（Scheduler.dispatchable）"""
+        busy = self.wm.count_busy()
+        current = self.wm.num_workers
+        target = max(self.wm.min_workers, min(self.wm.max_workers, busy + queued))
+        if target > current:
+            room = self.headroom()
+            if current + room < target:
+                self.last_reason = f"host headroom {room}"
+                target = max(current, current + room)
+            else:
+                self.last_reason = f"queue depth {queued}"
+        elif target < current:
+            self.last_reason = "idle"
+        return target
+
+    def step(self, queued: int) -> bool:
+        """执行一次扩缩容，返回是否有变化"""
+        if not self.enabled:
+            return False
+        target = self.desired(queued)
+        if target == self.wm.num_workers:
+            return False
+        log.info(f"Autoscale {self.wm.num_workers} -> {target} ({self.last_reason})")
+        self.wm.resize(target)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "num_workers": self.wm.num_workers,
+            "min_workers": self.wm.min_workers,
+            "max_workers": self.wm.max_workers,
+            "busy": self.wm.count_busy(),
+            "headroom": self.headroom(),
+            "last_reason": self.last_reason,
+        }
@@ -0,0 +1,118 @@
+"""
+DB - 进程内共享的 SQLite 引擎与 DB 线程池
+同一个 db 文件只创建一个 engine（WAL、synchronous=NORMAL、busy_timeout、固定大小连接池），
+异步代码通过 run_db() / run_db_write() 把同步的 SQLAlchemy 调用放到专用线程池，不阻塞事件循环；
+写入走单独的单线程池（SQLite 本来就只有一个写者），并且优先于读：
+  - 读线程池很小（CC_MANAGER_DB_READERS，默认 2）：查询主要是持有 GIL 的 Python 代码（ORM 组装、序列化），
+    读线程多了只会和写线程、事件循环抢 GIL，并不会更快
+  - 有写入在排队或执行时，新的读调用先在事件循环里等写入做完再进线程池
+每次调用记录排队等待时间和执行时间（cc_db_queue_wait_seconds / cc_db_query_seconds）
+"""
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+from typing import Callable, Dict
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from metrics import REGISTRY
+
+POOL_SIZE = int(os.getenv("CC_MANAGER_DB_POOL", 8))
+READ_THREADS = int(os.getenv("CC_MANAGER_DB_READERS", 2))
+BUSY_TIMEOUT_MS = 5000
+
+_engines: Dict[str, Engine] = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=READ_THREADS, thread_name_prefix="db")
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+DB_QUEUE_WAIT = REGISTRY.histogram("cc_db_queue_wait_seconds", "Time a DB call waited for a pool thread", ["pool"])
+DB_QUERY = REGISTRY.histogram("cc_db_query_seconds", "Time spent executing a DB call", ["pool", "op"])
+
+
+def _set_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    # WAL：读不阻塞写，前端轮询不会挡住分发循环的写入
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def get_engine(db_path: str, setup: Callable[[Engine], None] = None) -> Engine:
+    """返回 db_path 对应的共享 engine；首次创建时调用 setup（建表 / 迁移）"""
+    db_path = os.path.abspath(db_path)
+    with _lock:
+        engine = _engines.get(db_path)
+        if engine is None:
+            engine = create_engine(
+                f"sqlite:///{db_path}",
+                echo=False,
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_SIZE,
+                connect_args={"check_same_thread": False, "timeout": BUSY_TIMEOUT_MS / 1000},
+            )
+            event.listen(engine, "connect", _set_pragmas)
+            if setup:
+                setup(engine)
+            _engines[db_path] = engine
+        return engine
+
+
+def _timed(pool: str, fn: Callable, args: tuple, kwargs: dict, submitted: float):
+    start = time.perf_counter()
+    DB_QUEUE_WAIT.observe(start - submitted, pool=pool)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        DB_QUERY.observe(time.perf_counter() - start, pool=pool, op=getattr(fn, "__name__", "call"))
+
+
+class _WriteGate:
+    """每个事件循环一个：记录排队 / 执行中的写入数，读调用在写入全部完成后才放行"""
+
+    def __init__(self):
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+
+_gates: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _WriteGate]" = weakref.WeakKeyDictionary()
+
+
+def _gate(loop: asyncio.AbstractEventLoop) -> _WriteGate:
+    gate = _gates.get(loop)
+    if gate is None:
+        gate = _gates[loop] = _WriteGate()
+    return gate
+
+
+async def run_db(fn: Callable, *args, **kwargs):
+    """在 DB 读线程池里执行同步调用；有写入排队时先让写入做完"""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+    gate = _gate(loop)
+    while gate.pending:
+        await gate.idle.wait()
+    return await loop.run_in_executor(
+        _executor, functools.partial(_timed, "read", fn, args, kwargs, submitted))
+
+
+async def run_db_write(fn: Callable, *args, **kwargs):
+    """在 DB 写线程里执行同步调用"""
+    loop = asyncio.get_running_loop()
+    gate = _gate(loop)
+    gate.pending += 1
+    gate.idle.clear()
+    try:
+        return await loop.run_in_executor(
+            _write_executor, functools.partial(_timed, "write", fn, args, kwargs, time.perf_counter()))
+    finally:
+        gate.pending -= 1
+        if not gate.pending:
+            gate.idle.set()
@@ -0,0 +1,71 @@
+"""
+Failures - 任务失败分类与重试退避
+根据返回码、stderr 和 stream-json 的 result 事件判断失败原因：
+限流 / 过载 / 5xx / 网络抖动属于暂时性故障，按指数退避 + 抖动自动重新入队；
+鉴权、权限、超时、agent 自身失败直接标记 failed。
+"""
+import os
+import random
+import re
+from typing import Optional
+
+MAX_RETRIES = int(os.getenv("CC_MANAGER_MAX_RETRIES", 5))
+RETRY_BASE = float(os.getenv("CC_MANAGER_RETRY_BASE", 30))          # 第一次重试的基准延迟（秒）
+RETRY_MAX_DELAY = float(os.getenv("CC_MANAGER_RETRY_MAX_DELAY", 1800))
+
+TRANSIENT = {"rate_limit", "overloaded", "server_error", "network"}
+
+# 按顺序匹配，先命中的生效。API 故障只认 claude CLI 的 "API Error: <status>" 和 API 错误体里的 "type"，
+# 不匹配裸状态码 / 关键词，避免 agent 输出里恰好出现 500、rate limit 之类的字样被当成暂时性故障重试
+_API_TYPE = r'"type"\s*:\s*"{}"'
+_PATTERNS = [
+    ("rate_limit", r"api error: 429\b|" + _API_TYPE.format("rate_limit_error")),
+    ("overloaded", r"api error: 529\b|" + _API_TYPE.format("overloaded_error")),
+    ("auth", r"api error: 40[13]\b|invalid api key|invalid x-api-key|"
+             + _API_TYPE.format("authentication_error") + "|" + _API_TYPE.format("permission_error")),
+    ("network", r"econnreset|econnrefused|etimedout|enotfound|eai_again|socket hang up|fetch failed"
+                r"|connection (?:reset|refused|error|timed out)"
+                # git push / fetch
+                r"|could not resolve host|remote end hung up|early eof|unable to access|rpc failed"),
+    ("server_error", r"api error: 5\d\d\b|" + _API_TYPE.format("api_error")),
+    ("permission", r"permission denied|eacces|eperm|operation not permitted"),
+]
+_COMPILED = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in _PATTERNS]
+
+
+def classify(returncode: Optional[int], stderr: str = "", result: str = "",
+             subtype: str = None, error: str = None) -> str:
+    """返回失败类别；result 只应传入 is_error 的 result 事件文本，避免误判正常输出"""
+    if error == "Task timed out":
+        return "timeout"
+    if subtype == "error_max_turns":
+        return "max_turns"
+    text = "\n".join(s for s in (stderr, result, error) if s)
+    for name, pattern in _COMPILED:
+        if pattern.search(text):
+            return name
+    if returncode or subtype or text:
+        return "agent_error"
+    return "unknown"
+
+
+def describe(result: dict) -> tuple:
+    """从执行结果 {returncode, stdout, stderr, is_error, subtype, error} 得到 (失败类别, 错误信息)"""
+    returncode = result.get("returncode")
+    # is_error 时 result 事件文本就是错误信息（如 "API Error: 529 ..."），否则是正常输出
+    reported = result.get("stdout", "") if result.get("is_error") else ""
+    stderr = result.get("stderr", "")
+    failure_class = classify(returncode, stderr, reported, result.get("subtype"), result.get("error"))
+    message = reported or stderr or result.get("error") or f"claude exited with code {returncode}"
+    return failure_class, message
+
+
+def retry_delay(failure_class: str, retries: int) -> Optional[float]:
+    """暂时性故障的下一次重试延迟（秒），不应重试时返回 None
+
+    延迟 = min(上限, base * 2^retries)，再在 [50%, 100%] 之间随机抖动，避免同时醒来。
+    """
+    if failure_class not in TRANSIENT or retries >= MAX_RETRIES:
+        return None
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE * 2 ** retries)
+    return random.uniform(delay / 2, delay)
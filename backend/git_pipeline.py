@@ -0,0 +1,197 @@
+"""
+Git Pipeline - 后台提交 / 推送流水线
+任务成功后 worker 立即释放，worktree 交给流水线：
+  1. 提交：git add -A && git commit（本地操作，完成后马上归还 worktree）
+  2. 推送：同一仓库的多个任务分支攒一小段时间后合并成一次 git push，
+     网络类失败按指数退避重试
+提交 SHA、分支名和推送状态通过 on_update 回调写回任务。
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from failures import classify
+from metrics import REGISTRY
+from worktree_pool import GIT_IDENTITY, _git
+
+log = logging.getLogger(__name__)
+
+GIT_COMMIT = REGISTRY.histogram("cc_git_commit_seconds", "Time to commit a finished task's worktree", ["result"])
+GIT_PUSH = REGISTRY.histogram("cc_git_push_seconds", "Time per batched git push", ["result"])
+GIT_PUSH_BATCH = REGISTRY.histogram("cc_git_push_batch_size", "Task branches per git push",
+                                    buckets=(1, 2, 4, 8, 16, 32, 64))
+GIT_QUEUE = REGISTRY.gauge("cc_git_queue", "Jobs waiting in the git pipeline", ["stage"])
+
+
+class _Job:
+    def __init__(self, task: dict, path: str, release: Callable[[str], None]):
+        self.task_id = task["id"]
+        self.title = task["title"]
+        self.path = path
+        self._release = release
+        self.sha: Optional[str] = None
+        self.branch: Optional[str] = None
+        self.attempts = 0
+
+    def release(self):
+        if self._release:
+            self._release(self.path)
+            self._release = None
+
+
+class GitPipeline:
+    def __init__(self, on_update: Callable[[int, dict], Awaitable[None]] = None, remote: str = "origin",
+                 batch_window: float = 2.0, max_retries: int = 3, retry_base: float = 5.0):
+        self.on_update = on_update
+        self.remote = remote
+        self.batch_window = batch_window  # 推送前等待同仓库其他分支的时间（秒）
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending: Dict[str, List[_Job]] = {}  # git common dir -> 待推送的任务
+        self._push_ready = asyncio.Event()
+        REGISTRY.add_collector("git", self._collect)
+        self.committed = 0
+        self.pushed = 0
+        self.push_failures = 0
+        self.pushes = 0  # 实际执行的 git push 次数（批量合并后）
+
+    def submit(self, task: dict, path: str, release: Callable[[str], None]):
+        """提交一个已完成任务的 worktree；release(path) 在提交完成后调用"""
+        self.queue.put_nowait(_Job(task, path, release))
+
+    async def run(self):
+        asyncio.create_task(self._push_loop())
+        while True:
+            job = await self.queue.get()
+            start = time.perf_counter()
+            try:
+                await self._commit(job)
+                GIT_COMMIT.observe(time.perf_counter() - start, result="ok")
+            except Exception as e:
+                GIT_COMMIT.observe(time.perf_counter() - start, result="error")
+                log.error(f"Commit for task #{job.task_id} failed: {e}")
+                await self._update(job.task_id, {"push_status": "failed", "push_error": str(e)[:2000]})
+                job.release()
+
+    async def _commit(self, job: _Job):
+        path = job.path
+        rc, _, _ = await _git("rev-parse", "--is-inside-work-tree", cwd=path)
+        if rc != 0:
+            await self._update(job.task_id, {"push_status": "skipped"})
+            job.release()
+            return
+        await _git("add", "-A", cwd=path)
+        rc, _, _ = await _git("diff", "--cached", "--quiet", cwd=path)
+        changed = rc != 0
+        if changed:
+            rc, _, err = await _git(*GIT_IDENTITY, "commit", "-q", "-m", f"Task #{job.task_id}: {job.title}",
+                                    cwd=path)
+            if rc != 0:
+                raise RuntimeError(f"git commit failed: {err}")
+        _, job.sha, _ = await _git("rev-parse", "HEAD", cwd=path)
+        rc, branch, _ = await _git("symbolic-ref", "--short", "-q", "HEAD", cwd=path)
+        job.branch = branch if rc == 0 and branch else f"task-{job.task_id}"
+        _, common_dir, _ = await _git("rev-parse", "--git-common-dir", cwd=path)
+        common_dir = os.path.normpath(os.path.join(path, common_dir))
+        # 提交已进入对象库，worktree 可以交还；推送只依赖 SHA
+        job.release()
+
+        if not changed:
+            await self._update(job.task_id, {"branch_name": job.branch, "push_status": "no_changes"})
+            return
+        self.committed += 1
+        log.info(f"Task #{job.task_id} committed {job.sha[:10]} on {job.branch}")
+        rc, _, _ = await _git("remote", "get-url", self.remote, cwd=common_dir)
+        if rc != 0:
+            await self._update(job.task_id, {"commit_sha": job.sha, "branch_name": job.branch,
+                                             "push_status": "no_remote"})
+            return
+        await self._update(job.task_id, {"commit_sha": job.sha, "branch_name": job.branch, "push_status": "pending"})
+        self.pending.setdefault(common_dir, []).append(job)
+        self._push_ready.set()
+
+    async def _push_loop(self):
+        while True:
+            await self._push_ready.wait()
+            await asyncio.sleep(self.batch_window)
+            self._push_ready.clear()
+            batches, self.pending = self.pending, {}
+            for common_dir, jobs in batches.items():
+                try:
+                    await self._push(common_dir, jobs)
+                except Exception as e:
+                    log.error(f"Push from {common_dir} failed: {e}")
+                    for job in jobs:
+                        await self._push_failed(job, str(e))
+
+    async def _push(self, common_dir: str, jobs: List[_Job]):
+        """一次 git push 推送同一仓库的所有任务分支，按 --porcelain 输出逐个判定结果"""
+        refs: Dict[str, List[_Job]] = {}
+        for job in jobs:
+            # 同一分支上的多个提交（如复用的临时目录）按提交顺序排列，推最新的即可
+            refs.setdefault(f"refs/heads/{job.branch}", []).append(job)
+        self.pushes += 1
+        start = time.perf_counter()
+        rc, out, err = await _git("push", "--porcelain", self.remote,
+                                  *[f"{group[-1].sha}:{ref}" for ref, group in refs.items()], cwd=common_dir)
+        GIT_PUSH.observe(time.perf_counter() - start, result="ok" if rc == 0 else "error")
+        GIT_PUSH_BATCH.observe(len(refs))
+        results = {}
+        for line in out.splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 3 and ":" in parts[1]:
+                results[parts[1].split(":", 1)[1]] = (parts[0], parts[2])
+        for ref, group in refs.items():
+            flag, summary = results.get(ref, ("!", err or out))
+            for job in group:
+                if flag != "!":
+                    self.pushed += 1
+                    log.info(f"Task #{job.task_id} pushed to {self.remote}/{job.branch}")
+                    await self._update(job.task_id, {"push_status": "pushed", "push_error": None})
+                elif ref not in results and classify(rc, err) in ("network", "server_error") \
+                        and job.attempts < self.max_retries:
+                    await self._retry(common_dir, job, err)
+                else:
+                    await self._push_failed(job, summary)
+
+    async def _retry(self, common_dir: str, job: _Job, err: str):
+        delay = self.retry_base * 2 ** job.attempts
+        job.attempts += 1
+        log.warning(f"Push for task #{job.task_id} failed ({err[:200]}), retry #{job.attempts} in {delay:.0f}s")
+        await self._update(job.task_id, {"push_status": "retrying", "push_error": err[:2000]})
+
+        def requeue():
+            self.pending.setdefault(common_dir, []).append(job)
+            self._push_ready.set()
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _push_failed(self, job: _Job, err: str):
+        self.push_failures += 1
+        log.error(f"Push for task #{job.task_id} failed: {err[:300]}")
+        await self._update(job.task_id, {"push_status": "failed", "push_error": err[:2000]})
+
+    async def _update(self, task_id: int, fields: dict):
+        """写回任务状态失败只记日志，不影响流水线"""
+        if self.on_update is None:
+            return
+        try:
+            await self.on_update(task_id, fields)
+        except Exception as e:
+            log.error(f"Git status update for task #{task_id} failed: {e}")
+
+    def _collect(self):
+        GIT_QUEUE.set(self.queue.qsize(), stage="commit")
+        GIT_QUEUE.set(sum(len(jobs) for jobs in self.pending.values()), stage="push")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "pending_push": sum(len(jobs) for jobs in self.pending.values()),
+            "committed": self.committed,
+            "pushed": self.pushed,
+            "push_failures": self.push_failures,
+            "pushes": self.pushes,
+        }
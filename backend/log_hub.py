@@ -0,0 +1,186 @@
+"""
+Log Hub - WebSocket 发布/订阅中心
+向前端推送任务状态变化、worker 状态和 agent 实时输出
+
+每个客户端有独立的有界发送队列和发送协程，慢客户端只会丢自己的日志块，
+不会阻塞分发循环或其他客户端：
+  - status / workers 消息按 key 合并，只保留最新一条
+  - log 消息队列满时丢弃最旧的日志块，并补发一条 dropped 通知
+  - 队列里没有日志块可丢时丢最旧的状态类消息，并补发一条 resync 通知，客户端重新拉取任务列表
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+WS_CLIENTS = REGISTRY.gauge("cc_ws_clients", "Connected WebSocket clients")
+WS_QUEUE = REGISTRY.gauge("cc_ws_send_queue", "Messages waiting in WebSocket send queues", ["stat"])
+WS_SENT = REGISTRY.counter("cc_ws_messages_sent_total", "Messages sent to WebSocket clients")
+WS_DROPPED = REGISTRY.counter("cc_ws_log_dropped_total", "Log chunks dropped because a client queue was full")
+WS_RESYNC = REGISTRY.counter("cc_ws_status_dropped_total",
+                             "Status messages dropped (replaced by a resync notice) because a client queue was full")
+
+RESYNC = ("resync",)
+
+
+class _Subscriber:
+    def __init__(self, ws: WebSocket, max_queue: int):
+        self.ws = ws
+        self.max_queue = max_queue
+        self.task_ids: Set[int] = set()
+        self.all_tasks = False
+        self.pending: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.seq = 0
+        self.ready = asyncio.Event()
+
+    def wants_log(self, task_id: int) -> bool:
+        return self.all_tasks or task_id in self.task_ids
+
+    def push(self, key: tuple, message: dict):
+        """非阻塞入队；合并同 key 消息，超限时丢最旧的日志块"""
+        if key in self.pending:
+            self.pending[key] = message
+        else:
+            if len(self.pending) >= self.max_queue:
+                self._drop_oldest()
+            self.pending[key] = message
+        self.ready.set()
+
+    def push_log(self, task_id: int, message: dict):
+        self.seq += 1
+        self.push(("log", task_id, self.seq), message)
+
+    def _drop_oldest(self):
+        key = next((k for k in self.pending if k[0] == "log"), None)
+        if key is None:
+            key = next((k for k in self.pending if k != RESYNC), None)
+            if key is None:
+                return
+            # 状态类消息不能悄悄丢掉，客户端收到 resync 后重新拉取，补上丢掉的变化
+            self.pending.pop(key)
+            WS_RESYNC.inc()
+            self.pending.setdefault(RESYNC, {"type": "resync"})
+            return
+        message = self.pending.pop(key)
+        WS_DROPPED.inc()
+        task_id = message["task_id"]
+        dropped = self.pending.pop(("dropped", task_id), None)
+        count = dropped["count"] + 1 if dropped else 1
+        self.pending[("dropped", task_id)] = {"type": "dropped", "task_id": task_id, "count": count}
+
+    async def send_loop(self, send_timeout: float):
+        while True:
+            await self.ready.wait()
+            while self.pending:
+                _, message = self.pending.popitem(last=False)
+                await asyncio.wait_for(self.ws.send_text(json.dumps(message)), timeout=send_timeout)
+                WS_SENT.inc()
+            self.ready.clear()
+
+
+class LogHub:
+    def __init__(self, max_queue: int = 256, send_timeout: float = 10):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.subscribers: List[_Subscriber] = []
+        REGISTRY.add_collector("ws", self._collect)
+
+    def _collect(self):
+        sizes = [len(sub.pending) for sub in self.subscribers]
+        WS_CLIENTS.set(len(sizes))
+        WS_QUEUE.set(sum(sizes), stat="total")
+        WS_QUEUE.set(max(sizes, default=0), stat="max")
+
+    async def serve(self, ws: WebSocket):
+        """处理一个 WebSocket 连接直到断开
+
+        客户端消息：{"action": "subscribe" | "unsubscribe", "task_id": <id> | "*"}
+        """
+        await ws.accept()
+        sub = _Subscriber(ws, self.max_queue)
+        self.subscribers.append(sub)
+        sender = asyncio.create_task(sub.send_loop(self.send_timeout))
+        receiver = asyncio.create_task(self._receive_loop(sub))
+        try:
+            await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+            for task in (sender, receiver):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e:
+                    # 慢客户端发送超时、连接已断开等，断开这个客户端即可
+                    log.debug(f"WebSocket client closed: {e!r}")
+
+    async def _receive_loop(self, sub: _Subscriber):
+        try:
+            while True:
+                data = await sub.ws.receive_text()
+                try:
+                    msg = json.loads(data)
+                except ValueError:
+                    continue  # 前端的 ping
+                if not isinstance(msg, dict):
+                    continue
+                self._handle(sub, msg)
+        except WebSocketDisconnect:
+            pass
+
+    def _handle(self, sub: _Subscriber, msg: dict):
+        action, task_id = msg.get("action"), msg.get("task_id")
+        if action == "subscribe":
+            if task_id == "*":
+                sub.all_tasks = True
+            elif isinstance(task_id, int):
+                sub.task_ids.add(task_id)
+        elif action == "unsubscribe":
+            if task_id == "*":
+                sub.all_tasks = False
+            elif isinstance(task_id, int):
+                sub.task_ids.discard(task_id)
+
+    def publish_status(self, task_id: int, status: str, **fields):
+        """任务状态变化，推送给所有客户端"""
+        message = {"type": "status", "task_id": task_id, "status": status, **fields}
+        for sub in self.subscribers:
+            sub.push(("status", task_id), message)
+
+    def publish_batch(self, status: str, task_ids: List[int]):
+        """批量状态变化合并成一条消息，客户端按 since 增量刷新"""
+        message = {"type": "batch", "status": status, "count": len(task_ids),
+                   "first_id": min(task_ids), "last_id": max(task_ids)}
+        for sub in self.subscribers:
+            sub.push(("batch", message["first_id"]), message)
+
+    def publish_workers(self, workers: List[dict]):
+        message = {"type": "workers", "workers": workers}
+        for sub in self.subscribers:
+            sub.push(("workers",), message)
+
+    def publish_log(self, task_id: int, offset: int, data: str):
+        """agent 输出行，只推给订阅了该任务（或全部任务）的客户端
+
+        offset 是该行在任务日志文件中的字节位置，客户端发现缺口时可用
+        GET /api/tasks/{id}/log?offset= 补齐。
+        """
+        message = {"type": "log", "task_id": task_id, "offset": offset, "data": data}
+        for sub in self.subscribers:
+            if sub.wants_log(task_id):
+                sub.push_log(task_id, message)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "clients": len(self.subscribers),
+            "queued": sum(len(sub.pending) for sub in self.subscribers),
+        }
@@ -1,15 +1,21 @@
 import os
+import json
+import time
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, ValidationError
+from typing import Optional, List, Union
 from datetime import datetime
 
 from task_queue import TaskQueue
-from worker_manager import WorkerManager
-from ralph_loop import RalphLoop
+from db import run_db, run_db_write
+from ralph_loop import RalphLoop, DISPATCHED
+from task_logs import TaskLogStore, run_io
+from log_hub import LogHub
+from failures import describe
+from metrics import REGISTRY
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 log = logging.getLogger(__name__)
@@ -18,23 +24,17 @@ app = FastAPI(title="CC Manager API v2")
 
 # 全局状态
 tq = TaskQueue()
-wm = WorkerManager(num_workers=2)
-ralph = RalphLoop(num_workers=2)
-
-# WebSocket 连接池
-ws_connections: List[WebSocket] = []
-
-
-async def broadcast_log(message: str):
-    """广播日志到所有 WebSocket 客户端"""
-    dead = []
-    for ws in ws_connections:
-        try:
-            await ws.send_text(message)
-        except Exception:
-            dead.append(ws)
-    for ws in dead:
-        ws_connections.remove(ws)
+logs = TaskLogStore()
+hub = LogHub()
+num_workers = int(os.getenv("WORKERS", 2))
+ralph = RalphLoop(
+    num_workers=num_workers,
+    min_workers=int(os.getenv("WORKERS_MIN", num_workers)),
+    max_workers=int(os.getenv("WORKERS_MAX", num_workers)),
+    tq=tq, logs=logs, hub=hub,
+)
+wm = ralph.wm  # 与分发循环共用同一份 worker 状态
+boot_id = int(time.time())  # worker 版本号只在内存里，ETag 需要区分进程重启
 
 
 # 数据模型
@@ -44,88 +44,402 @@ class TaskCreate(BaseModel):
     prompt: str
     mode: str = "execute"
     priority: int = 0
+    no_cache: bool = False  # 跳过结果缓存，强制重新执行
+    idempotency_key: Optional[str] = None  # 也可以用 Idempotency-Key 请求头
+    depends_on: List[int] = []  # 依赖的任务 id，全部完成后才会进入队列
+
+
+class DagNode(TaskCreate):
+    key: str
+    depends_on: List[Union[int, str]] = []  # 字符串引用同一 DAG 内的节点 key，整数引用已有任务
+
+
+class DagCreate(BaseModel):
+    tasks: List[DagNode]
+
+
+class AgentRegister(BaseModel):
+    name: str
+
+
+class AgentHeartbeat(BaseModel):
+    running: List[int] = []
+
+
+class AgentLease(BaseModel):
+    max_tasks: int = 1
+
+
+class TaskReport(BaseModel):
+    success: bool
+    result: str = ""
+    stderr: str = ""
+    error: Optional[str] = None
+    is_error: bool = False
+    subtype: Optional[str] = None
+    returncode: Optional[int] = None
+    usage: Optional[dict] = None  # {"cpu_seconds", "peak_rss_mb", "wall_seconds"}
+
+
+class GitUpdate(BaseModel):
+    commit_sha: Optional[str] = None
+    branch_name: Optional[str] = None
+    push_status: Optional[str] = None
+    push_error: Optional[str] = None
+
+
+class WorkerPoolUpdate(BaseModel):
+    num_workers: Optional[int] = None
+    min_workers: Optional[int] = None
+    max_workers: Optional[int] = None
+    autoscale: Optional[bool] = None
 
 
 # ===== 任务 API =====
 @app.post("/api/tasks")
-async def create_task(task: TaskCreate):
-    task_id = tq.add_task(
-        project=task.project,
-        title=task.title,
-        prompt=task.prompt,
-        mode=task.mode,
-        priority=task.priority
-    )
-    await broadcast_log(f"New task #{task_id}: {task.title}")
-    return {"id": task_id, "status": "queued"}
+async def create_task(task: TaskCreate, request: Request):
+    """提交任务；重复提交（同一幂等键，或同样的任务还在排队 / 运行）返回已有任务"""
+    try:
+        task_id, status, created = await run_db_write(
+            tq.submit_task,
+            project=task.project,
+            title=task.title,
+            prompt=task.prompt,
+            mode=task.mode,
+            priority=task.priority,
+            no_cache=task.no_cache,
+            idempotency_key=request.headers.get("idempotency-key") or task.idempotency_key,
+            depends_on=task.depends_on,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if not created:
+        log.info(f"Duplicate submission coalesced into task #{task_id}")
+        return {"id": task_id, "status": status, "duplicate": True}
+    if status == "queued":
+        ralph.notify()
+    hub.publish_status(task_id, status, project=task.project, title=task.title, mode=task.mode)
+    return {"id": task_id, "status": status, "duplicate": False}
+
+
+@app.post("/api/dags")
+async def create_dag(dag: DagCreate):
+    """一次提交一组有依赖的任务（扇出 / 汇合），返回 {key: task_id}"""
+    try:
+        ids = await run_db_write(tq.add_dag, [node.model_dump() for node in dag.tasks])
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if ids:
+        ralph.notify()
+        hub.publish_batch("queued", sorted(ids.values()))
+    return {"tasks": ids}
+
+
+def task_summary(t) -> dict:
+    return {
+        "id": t.id,
+        "project": t.project,
+        "title": t.title,
+        "status": t.status,
+        "mode": t.mode,
+        "worker_id": t.worker_id,
+        "attempts": t.attempts or 0,
+        "retries": t.retries or 0,
+        "failure_class": t.failure_class,
+        "branch_name": t.branch_name,
+        "commit_sha": t.commit_sha,
+        "push_status": t.push_status,
+        "merge_status": t.merge_status,
+        "cpu_seconds": t.cpu_seconds,
+        "peak_rss_mb": t.peak_rss_mb,
+        "wall_seconds": t.wall_seconds,
+        "not_before": t.not_before.isoformat() if t.not_before else None,
+        "created_at": t.created_at.isoformat(),
+        "finished_at": t.finished_at.isoformat() if t.finished_at else None,
+    }
+
+
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """If-None-Match 命中时返回 304，否则给响应带上 ETag"""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
+
+
+@app.post("/api/tasks/batch")
+async def create_tasks_batch(request: Request):
+    """批量提交：JSON 数组，或 Content-Type: application/x-ndjson 每行一个任务
+
+    带 idempotency_key 的项按键去重（重试整批不会重复创建），返回的 ids 中对应位置是已有任务的 id。
+    """
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items, pending = [], b""
+            async for chunk in request.stream():
+                pending += chunk
+                *lines, pending = pending.split(b"\n")
+                items.extend(json.loads(line) for line in lines if line.strip())
+            if pending.strip():
+                items.append(json.loads(pending))
+        else:
+            items = await request.json()
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail="Expected a JSON array of tasks")
+        tasks = [TaskCreate(**item).model_dump() for item in items]
+        if any(t["depends_on"] for t in tasks):
+            raise HTTPException(status_code=422, detail="Use POST /api/dags for tasks with dependencies")
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    task_ids = await run_db_write(tq.add_tasks, tasks)
+    if task_ids:
+        ralph.notify()
+        hub.publish_batch("queued", task_ids)
+    return {"ids": task_ids, "count": len(task_ids)}
 
 
 @app.get("/api/tasks")
-async def list_tasks(status: Optional[str] = None, limit: int = 50):
-    tasks = tq.list_tasks(status=status, limit=limit)
-    return [
-        {
-            "id": t.id,
-            "project": t.project,
-            "title": t.title,
-            "status": t.status,
-            "mode": t.mode,
-            "worker_id": t.worker_id,
-            "created_at": t.created_at.isoformat(),
-            "finished_at": t.finished_at.isoformat() if t.finished_at else None,
+async def list_tasks(request: Request, response: Response, status: Optional[str] = None,
+                     limit: int = 50, since: Optional[int] = None):
+    """任务列表；带 since=<version> 时只返回该版本之后变化过的任务"""
+    version = await run_db(tq.current_version)
+    cached = not_modified(request, response, f'W/"tasks-{version}-{status}-{limit}-{since}"')
+    if cached:
+        return cached
+    response.headers["X-Queue-Version"] = str(version)
+    if since is not None:
+        tasks = await run_db(tq.list_tasks_since, since, limit=limit)
+        # 截断时只推进到已返回的最大版本（该版本的行已全部返回），客户端继续用它拉剩下的
+        more = len(tasks) >= limit
+        return {
+            "version": tasks[-1].version if more else version,
+            "more": more,
+            "tasks": [task_summary(t) for t in tasks],
         }
-        for t in tasks
-    ]
+    tasks = await run_db(tq.list_tasks, status=status, limit=limit)
+    return [task_summary(t) for t in tasks]
 
 
 @app.get("/api/tasks/{task_id}")
 async def get_task(task_id: int):
-    tasks = tq.list_tasks(limit=10000)
-    for task in tasks:
-        if task.id == task_id:
-            return {
-                "id": task.id,
-                "project": task.project,
-                "title": task.title,
-                "prompt": task.prompt,
-                "status": task.status,
-                "result": task.result,
-                "plan_text": task.plan_text,
-                "created_at": task.created_at.isoformat(),
-            }
-    raise HTTPException(status_code=404, detail="Task not found")
+    task = await run_db(tq.get_task, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return {
+        "id": task.id,
+        "project": task.project,
+        "title": task.title,
+        "prompt": task.prompt,
+        "status": task.status,
+        "result": task.result,
+        "plan_text": task.plan_text,
+        "branch_name": task.branch_name,
+        "commit_sha": task.commit_sha,
+        "push_status": task.push_status,
+        "push_error": task.push_error,
+        "merge_status": task.merge_status,
+        "merge_error": task.merge_error,
+        "cpu_seconds": task.cpu_seconds,
+        "peak_rss_mb": task.peak_rss_mb,
+        "wall_seconds": task.wall_seconds,
+        "created_at": task.created_at.isoformat(),
+        "pending_deps": task.pending_deps or 0,
+        **await run_db(tq.get_dependencies, task_id),
+    }
+
+
+@app.get("/api/tasks/{task_id}/log")
+async def get_task_log(task_id: int, offset: int = 0, limit: int = 65536):
+    """按字节区间读取任务完整输出日志（stream-json 行）"""
+    chunk = await run_io(logs.read, task_id, offset=offset, limit=min(max(limit, 1), 1024 * 1024))
+    if chunk is None:
+        if not await run_db(tq.get_task, task_id):
+            raise HTTPException(status_code=404, detail="Task not found")
+        return {"task_id": task_id, "offset": 0, "next_offset": 0, "size": 0, "data": ""}
+    return chunk
 
 
 @app.delete("/api/tasks/{task_id}")
 async def delete_task(task_id: int):
-    tq.update_task_status(task_id=task_id, status="cancelled")
+    """取消任务；运行中的 agent 进程会被停止（SIGTERM，宽限期后 SIGKILL）"""
+    cancelled = await run_db_write(tq.cancel_task, task_id)
+    if cancelled is None:
+        task = await run_db(tq.get_task, task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="Task not found")
+        if task.status != "cancelled":
+            raise HTTPException(status_code=409, detail=f"Task already {task.status}")
+        return {"ok": True}
+    hub.publish_status(task_id, "cancelled", worker_id=None)
+    ralph.publish_dag(cancelled)
+    if cancelled["status"] == "running":
+        ralph.cancel_task(task_id)
     return {"ok": True}
 
 
+@app.get("/api/usage")
+async def get_usage(hours: float = 24):
+    """最近 hours 小时内结束任务的资源用量，按项目汇总"""
+    return await run_db(tq.usage_by_project, hours)
+
+
 # ===== Worker API =====
 @app.get("/api/workers")
-async def get_workers():
+async def get_workers(request: Request, response: Response):
+    cached = not_modified(request, response, f'W/"workers-{boot_id}-{wm.version}"')
+    if cached:
+        return cached
     return wm.get_all_workers()
 
 
+# ===== 远程 Agent API =====
+AGENT_HEARTBEAT_INTERVAL = 10
+
+
+@app.get("/api/agents")
+async def list_agents():
+    return await run_db(tq.list_agents)
+
+
+@app.post("/api/agents/register")
+async def register_agent(body: AgentRegister):
+    agent_id = await run_db_write(tq.register_agent, body.name)
+    log.info(f"Agent #{agent_id} registered: {body.name}")
+    return {"agent_id": agent_id, "heartbeat_interval": AGENT_HEARTBEAT_INTERVAL, "lease_timeout": ralph.agent_timeout}
+
+
+@app.post("/api/agents/{agent_id}/heartbeat")
+async def agent_heartbeat(agent_id: int, body: AgentHeartbeat):
+    if not await run_db_write(tq.heartbeat_agent, agent_id, body.running):
+        raise HTTPException(status_code=404, detail="Unknown or expired agent")
+    # 已被取消 / 回收的任务通知 agent 停止执行
+    return {"ok": True, "cancel": await run_db(tq.orphaned_tasks, agent_id, body.running)}
+
+
+@app.post("/api/agents/{agent_id}/lease")
+async def lease_tasks(agent_id: int, body: AgentLease):
+    """agent 拉取任务：原子认领最多 max_tasks 个"""
+    if not await run_db_write(tq.heartbeat_agent, agent_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired agent")
+    # 远程 agent 同样占用上游额度
+    budget = min(body.max_tasks, 16, ralph.limiter.allowance(await run_db(tq.count_tasks, "running")))
+    tasks = await ralph.lease_for_agent(agent_id, budget)
+    ralph.limiter.take(len(tasks))
+    DISPATCHED.inc(len(tasks), kind="agent")
+    for task in tasks:
+        # 重新入队的任务日志接在已有内容后面
+        task["log_offset"] = await run_io(logs.size, task["id"])
+        hub.publish_status(task["id"], "running", worker_id=agent_id)
+    return {"tasks": tasks}
+
+
+@app.post("/api/tasks/{task_id}/log")
+async def upload_task_log(task_id: int, request: Request, agent_id: int, offset: int):
+    """agent 上传完整的输出行；offset 是这批数据在任务日志中的起始字节位置
+
+    只接受仍持有该任务租约的 agent，租约已被回收 / 转给别人时返回 409，避免旧 agent 的输出混进新一次运行的日志。
+    """
+    if not await run_db(tq.holds_lease, task_id, agent_id):
+        raise HTTPException(status_code=409, detail="Task is no longer leased to this agent")
+    data = await request.body()
+    old_size = await run_io(logs.size, task_id)
+    size = await run_io(logs.append, task_id, offset, data)
+    if size is None:
+        raise HTTPException(status_code=409, detail={"size": old_size})
+    pos = offset
+    for line in data.split(b"\n")[:-1]:
+        if pos >= old_size:
+            hub.publish_log(task_id, pos, line.decode("utf-8", errors="replace"))
+        pos += len(line) + 1
+    return {"size": size}
+
+
+@app.post("/api/tasks/{task_id}/result")
+async def report_task_result(task_id: int, agent_id: int, report: TaskReport):
+    if report.success:
+        effects = await run_db_write(tq.finish_task, task_id, agent_id, "done", report.result,
+                                     usage=report.usage)
+        if effects is None:
+            raise HTTPException(status_code=409, detail="Task is no longer leased to this agent")
+        ralph.on_upstream_result(None)
+        hub.publish_status(task_id, "done")
+        ralph.publish_dag(effects)
+        ralph.notify()
+        return {"status": "done"}
+    failure_class, err = describe({**report.model_dump(), "stdout": report.result})
+    ralph.on_upstream_result(failure_class)
+    outcome = await run_db_write(tq.fail_task, task_id, agent_id, err[:2000], failure_class,
+                                 usage=report.usage)
+    if outcome is None:
+        raise HTTPException(status_code=409, detail="Task is no longer leased to this agent")
+    if outcome["status"] == "queued":
+        hub.publish_status(task_id, "queued", worker_id=None, retries=outcome["retries"], failure_class=failure_class)
+        ralph.wake_after(outcome["delay"])
+    else:
+        hub.publish_status(task_id, "failed", failure_class=failure_class)
+        ralph.publish_dag(outcome)
+    ralph.notify()
+    return {"status": outcome["status"]}
+
+
+@app.post("/api/tasks/{task_id}/git")
+async def report_task_git(task_id: int, agent_id: int, update: GitUpdate):
+    """agent 的 git 流水线回报提交 / 推送结果（可能早于任务结果到达）"""
+    if not await ralph.on_git_update(task_id, update.model_dump(exclude_unset=True), agent_id):
+        raise HTTPException(status_code=404, detail="Task not found for this agent")
+    return {"ok": True}
+
+
+# ===== 管理 API =====
+@app.get("/api/admin/workers")
+async def get_worker_pool():
+    return ralph.autoscaler.stats()
+
+
+@app.post("/api/admin/workers")
+async def update_worker_pool(update: WorkerPoolUpdate):
+    """运行时调整 worker 池：上下限、目标数量、是否自动伸缩"""
+    min_workers = update.min_workers if update.min_workers is not None else wm.min_workers
+    max_workers = update.max_workers if update.max_workers is not None else wm.max_workers
+    if min_workers < 0 or max_workers < max(min_workers, 1):
+        raise HTTPException(status_code=422, detail="Require 0 <= min_workers <= max_workers, max_workers >= 1")
+    wm.min_workers, wm.max_workers = min_workers, max_workers
+    if update.autoscale is not None:
+        ralph.autoscaler.enabled = update.autoscale
+    wm.resize(update.num_workers if update.num_workers is not None else wm.num_workers)
+    ralph.on_workers_changed()
+    return ralph.autoscaler.stats()
+
+
 # ===== 健康检查 =====
 @app.get("/health")
 async def health():
-    return {"status": "ok", "workers": len(wm.workers)}
+    return {
+        "status": "ok",
+        "workers": len(wm.workers),
+        "scheduler": ralph.scheduler.stats(),
+        "autoscaler": ralph.autoscaler.stats(),
+        "upstream": ralph.limiters.stats(),
+        "cache": await run_db(ralph.cache.stats),
+        "git": ralph.git.stats(),
+        "merge_queue": ralph.merges.stats(),
+        "limits": ralph.limits.describe(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的指标"""
+    await REGISTRY.collect()
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 # ===== WebSocket 日志流 =====
 @app.websocket("/ws/logs")
 async def websocket_logs(websocket: WebSocket):
-    await websocket.accept()
-    ws_connections.append(websocket)
-    try:
-        while True:
-            data = await websocket.receive_text()
-            # 可以接受来自前端的 ping
-    except WebSocketDisconnect:
-        if websocket in ws_connections:
-            ws_connections.remove(websocket)
+    # 订阅：{"action": "subscribe", "task_id": <id> | "*"}
+    await hub.serve(websocket)
 
 
 # ===== 生命周期管理 =====
@@ -0,0 +1,324 @@
+"""
+Merge Queue - 把完成的任务分支按顺序合入项目基线分支
+只对 projects.json 中配置了 "merge_queue": true 的项目生效，所有操作都在项目主 clone 里
+只动对象和 ref（git merge-tree / commit-tree），不碰工作区：
+  1. 任务分支推送成功后入队，立即用 merge-tree 对当前基线试合并，有冲突马上标记
+  2. 落地轮次：在最新基线上按入队顺序依次试合并，得到一串推测提交
+     base -> base+t1 -> base+t1+t2 ...；和基线冲突的剔除，只和前面任务冲突的留到下一轮
+  3. 配置了 "merge_check" 时，对前 parallel 个推测提交并行跑检查命令，
+     取第一个失败之前的最长前缀；否则整串落地。检查命令执行的是任务写的代码，
+     经由 Runner 以 agent 用户、同样的资源限制运行，不以 manager 的 root 身份跑
+  4. 一次 push（快进）把这串提交推到基线分支，被别人抢先时下一轮重建
+同时对外提供路径重叠提示：排队合并的任务实际改动的路径、运行中任务 prompt 里提到的路径，
+调度器据此避免同时运行会改同一批文件的任务。
+"""
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Set
+
+from runner import Runner
+from worktree_pool import GIT_IDENTITY, WorktreePool, _git
+
+log = logging.getLogger(__name__)
+
+MERGE_PARALLEL = int(os.getenv("CC_MANAGER_MERGE_PARALLEL", 4))       # 并行检查的推测提交数
+CHECK_TIMEOUT = int(os.getenv("CC_MANAGER_MERGE_CHECK_TIMEOUT", 1800))
+
+_PATH_TOKEN = re.compile(r"[\w./-]*\w\.\w+|[\w.-]+(?:/[\w.-]+)+")
+
+
+class _Entry:
+    def __init__(self, task_id: int, project: str, title: str, branch: str, sha: str):
+        self.task_id = task_id
+        self.project = project
+        self.title = title
+        self.branch = branch
+        self.sha = sha
+        self.paths: FrozenSet[str] = frozenset()
+
+
+class MergeQueue:
+    def __init__(self, pool: WorktreePool, projects: Dict[str, dict], runner: Runner,
+                 on_update: Callable[[int, dict], Awaitable[None]] = None, parallel: int = MERGE_PARALLEL):
+        self.pool = pool
+        self.runner = runner
+        # 项目 -> 检查命令（None 表示只做冲突检测）
+        self.projects = {name: cfg.get("merge_check") for name, cfg in projects.items()
+                         if cfg.get("merge_queue") and pool.has_project(name)}
+        self.on_update = on_update
+        self.parallel = max(1, parallel)
+        self.queues: Dict[str, List[_Entry]] = {name: [] for name in self.projects}
+        self._wake: Dict[str, asyncio.Event] = {name: asyncio.Event() for name in self.projects}
+        self._files: Dict[str, tuple] = {}       # 项目 -> (基线 commit, 文件列表)
+        self.hints: Dict[int, FrozenSet[str]] = {}  # task_id -> 预计会改动的路径
+        self._running: Set[int] = set()
+        self.merged = 0
+        self.conflicts = 0
+        self.check_failures = 0
+        self.rounds = 0
+
+    def enabled(self, project: str) -> bool:
+        return project in self.projects
+
+    async def run(self):
+        await asyncio.gather(*(self._land_loop(name) for name in self.projects))
+
+    # ===== 入队 =====
+
+    async def submit(self, task_id: int, project: str, title: str, branch: str, sha: str):
+        """任务分支已推送：先对当前基线试合并，冲突立即标记，否则排队等待落地"""
+        if not self.enabled(project) or any(e.task_id == task_id for e in self.queues[project]):
+            return
+        entry = _Entry(task_id, project, title, branch, sha)
+        proj = self.pool.projects[project]
+        if not await self._ensure_commit(proj.main_dir, entry):
+            await self._update(task_id, {"merge_status": "failed", "merge_error": f"commit {sha} not found"})
+            return
+        base = await self._base(project)
+        entry.paths = await self._changed_paths(proj.main_dir, base, sha)
+        _, conflicts = await self._merge(proj.main_dir, base, entry)
+        if conflicts is not None:
+            await self._conflict(entry, conflicts, f"origin/{proj.branch}")
+            return
+        self.queues[project].append(entry)
+        self.hints[task_id] = entry.paths
+        await self._update(task_id, {"merge_status": "queued", "merge_error": None})
+        self._wake[project].set()
+
+    def restore(self, tasks: Iterable[dict]):
+        """进程重启后恢复排队中的任务（不重复做入队检查，落地轮次会重新试合并）"""
+        for t in tasks:
+            if self.enabled(t["project"]) and t.get("commit_sha"):
+                self.queues[t["project"]].append(
+                    _Entry(t["id"], t["project"], t["title"], t["branch_name"], t["commit_sha"]))
+        for name, queue in self.queues.items():
+            if queue:
+                self._wake[name].set()
+
+    # ===== 落地 =====
+
+    async def _land_loop(self, project: str):
+        wake = self._wake[project]
+        while True:
+            await wake.wait()
+            wake.clear()
+            try:
+                if not await self._land(project):
+                    # 推送被拒（基线被别人更新），稍后在新基线上重试
+                    await asyncio.sleep(5)
+                    wake.set()
+                elif self.queues[project]:
+                    wake.set()
+            except Exception as e:
+                log.error(f"Merge queue for '{project}' failed: {e}")
+                await asyncio.sleep(30)
+                wake.set()
+
+    async def _land(self, project: str) -> bool:
+        queue = self.queues[project]
+        if not queue:
+            return True
+        self.rounds += 1
+        proj = self.pool.projects[project]
+        base = await self._base(project, fetch=True)
+        # 在最新基线上按顺序堆出推测提交
+        chain, tip = [], base
+        for entry in list(queue):
+            merged, conflicts = await self._merge(proj.main_dir, tip, entry)
+            if conflicts is not None and not chain:
+                queue.remove(entry)
+                await self._conflict(entry, conflicts, f"origin/{proj.branch}")
+                continue
+            if conflicts is not None:
+                # 只和前面排队的任务冲突：它们可能过不了检查，等它们落地后再在新基线上判定
+                continue
+            tip = merged
+            chain.append((entry, tip))
+        if not chain:
+            return True
+
+        check = self.projects[project]
+        if check:
+            chain = chain[:self.parallel]
+            results = await asyncio.gather(*(self._check(proj.main_dir, check, tip) for _, tip in chain))
+            failed = next((i for i, error in enumerate(results) if error is not None), None)
+            if failed is not None:
+                entry = chain[failed][0]
+                queue.remove(entry)
+                self.hints.pop(entry.task_id, None)
+                self.check_failures += 1
+                log.warning(f"Task #{entry.task_id} failed merge check: {results[failed][:300]}")
+                await self._update(entry.task_id, {"merge_status": "check_failed", "merge_error": results[failed]})
+                chain = chain[:failed]
+                if not chain:
+                    return True
+
+        tip = chain[-1][1]
+        rc, _, err = await _git("push", "-q", "origin", f"{tip}:refs/heads/{proj.branch}", cwd=proj.main_dir)
+        if rc != 0:
+            log.warning(f"Merge queue push to '{project}' {proj.branch} rejected: {err[:300]}")
+            return False
+        await _git("update-ref", f"refs/remotes/origin/{proj.branch}", tip, cwd=proj.main_dir)
+        for entry, merged in chain:
+            queue.remove(entry)
+            self.hints.pop(entry.task_id, None)
+            self.merged += 1
+            log.info(f"Task #{entry.task_id} merged into {project}/{proj.branch} ({merged[:10]})")
+            await self._update(entry.task_id, {"merge_status": "merged", "merge_error": None})
+        return True
+
+    async def _merge(self, repo: str, tip: str, entry: _Entry) -> tuple:
+        """试合并 entry 到 tip，返回 (合并后的 commit, None) 或 (None, 冲突文件列表)"""
+        rc, _, _ = await _git("merge-base", "--is-ancestor", tip, entry.sha, cwd=repo)
+        if rc == 0:
+            return entry.sha, None  # 任务分支已包含 tip，快进
+        rc, out, err = await _git("merge-tree", "--write-tree", "--name-only", "--no-messages", tip, entry.sha,
+                                  cwd=repo)
+        if rc == 1:
+            return None, out.splitlines()[1:]
+        if rc != 0:
+            raise RuntimeError(f"git merge-tree failed: {err}")
+        tree = out.splitlines()[0]
+        rc, merged, err = await _git(*GIT_IDENTITY, "commit-tree", tree, "-p", tip, "-p", entry.sha,
+                                     "-m", f"Merge task #{entry.task_id}: {entry.title}", cwd=repo)
+        if rc != 0:
+            raise RuntimeError(f"git commit-tree failed: {err}")
+        return merged, None
+
+    async def _check(self, repo: str, command: str, commit: str) -> Optional[str]:
+        """在临时 worktree 中对推测提交运行检查命令，通过返回 None，否则返回错误输出"""
+        path = tempfile.mkdtemp(prefix="cc-merge-")
+        try:
+            rc, _, err = await _git("worktree", "add", "-q", "--detach", path, commit, cwd=repo)
+            if rc != 0:
+                return f"git worktree add failed: {err}"
+            await self.pool.chown_worktree(path)
+            try:
+                rc, out = await self.runner.exec(["/bin/sh", "-c", command], path, f"cc-merge-{commit[:10]}",
+                                                 timeout=CHECK_TIMEOUT)
+            except Exception as e:
+                return f"merge check failed to start: {e}"
+            if rc is None:
+                return f"merge check timed out after {CHECK_TIMEOUT}s"
+            if rc != 0:
+                return out[-2000:] or f"merge check exited with {rc}"
+            return None
+        finally:
+            await _git("worktree", "remove", "--force", path, cwd=repo)
+            shutil.rmtree(path, ignore_errors=True)
+
+    async def _conflict(self, entry: _Entry, paths: List[str], against: str):
+        self.conflicts += 1
+        self.hints.pop(entry.task_id, None)
+        error = f"Conflicts with {against}: {', '.join(paths[:20])}"
+        log.warning(f"Task #{entry.task_id} {error}")
+        await self._update(entry.task_id, {"merge_status": "conflict", "merge_error": error})
+
+    # ===== git 辅助 =====
+
+    async def _base(self, project: str, fetch: bool = False) -> str:
+        proj = self.pool.projects[project]
+        if fetch:
+            await _git("fetch", "-q", "origin", proj.branch, cwd=proj.main_dir)
+        rc, base, err = await _git("rev-parse", f"origin/{proj.branch}", cwd=proj.main_dir)
+        if rc != 0:
+            raise RuntimeError(f"Cannot resolve origin/{proj.branch}: {err}")
+        return base
+
+    async def _ensure_commit(self, repo: str, entry: _Entry) -> bool:
+        """本地 worktree 的提交已在对象库里；远程 agent 的提交需要先 fetch 任务分支"""
+        rc, _, _ = await _git("cat-file", "-e", f"{entry.sha}^{{commit}}", cwd=repo)
+        if rc == 0:
+            return True
+        await _git("fetch", "-q", "origin", f"refs/heads/{entry.branch}", cwd=repo)
+        rc, _, _ = await _git("cat-file", "-e", f"{entry.sha}^{{commit}}", cwd=repo)
+        return rc == 0
+
+    async def _changed_paths(self, repo: str, base: str, sha: str) -> FrozenSet[str]:
+        rc, out, _ = await _git("diff", "--name-only", f"{base}...{sha}", cwd=repo)
+        return frozenset(out.splitlines()) if rc == 0 else frozenset()
+
+    # ===== 路径重叠提示 =====
+
+    async def predict_paths(self, project: str, prompt: str) -> FrozenSet[str]:
+        """prompt 中提到的仓库文件（完整路径或唯一的文件名），作为任务会改动哪些文件的粗略预测"""
+        files = await self._file_index(project)
+        if not files:
+            return frozenset()
+        paths, by_name = set(), files[1]
+        for token in _PATH_TOKEN.findall(prompt):
+            if token.startswith("./"):
+                token = token[2:]
+            if token in files[0]:
+                paths.add(token)
+            elif "/" not in token and len(by_name.get(token, ())) == 1:
+                paths.update(by_name[token])
+        return frozenset(paths)
+
+    async def _file_index(self, project: str) -> Optional[tuple]:
+        """基线分支的文件列表，按基线 commit 缓存：(路径集合, 文件名 -> 路径列表)"""
+        proj = self.pool.projects.get(project)
+        if proj is None or not proj.ready:
+            return None
+        rc, base, _ = await _git("rev-parse", f"origin/{proj.branch}", cwd=proj.main_dir)
+        if rc != 0:
+            return None
+        cached = self._files.get(project)
+        if cached and cached[0] == base:
+            return cached[1]
+        _, out, _ = await _git("ls-tree", "-r", "--name-only", base, cwd=proj.main_dir)
+        files = set(out.splitlines())
+        by_name: Dict[str, List[str]] = {}
+        for path in files:
+            by_name.setdefault(os.path.basename(path), []).append(path)
+        self._files[project] = (base, (files, by_name))
+        return files, by_name
+
+    async def annotate(self, candidates: List[dict], get_prompts: Callable[[List[int]], Awaitable[Dict[int, str]]]):
+        """给启用了合并队列的项目的候选任务加上 "paths" 预测（按 task_id 缓存）"""
+        # 只保留仍可能用到的预测：候选、运行中和排队合并的任务
+        keep = {t["id"] for t in candidates} | self._running | {e.task_id for q in self.queues.values() for e in q}
+        self.hints = {task_id: paths for task_id, paths in self.hints.items() if task_id in keep}
+        missing = [t["id"] for t in candidates if self.enabled(t["project"]) and t["id"] not in self.hints]
+        if missing:
+            prompts = await get_prompts(missing)
+            for t in candidates:
+                if t["id"] in prompts:
+                    self.hints[t["id"]] = await self.predict_paths(t["project"], prompts[t["id"]])
+        for t in candidates:
+            if t["id"] in self.hints:
+                t["paths"] = self.hints[t["id"]]
+
+    def busy_paths(self, running: Dict[int, str]) -> Dict[str, Set[str]]:
+        """项目 -> 正在被改动的路径：运行中任务（task_id -> 项目）的预测路径 + 排队合并任务的实际改动"""
+        busy: Dict[str, Set[str]] = {}
+        self._running = set(running)
+        for task_id, project in running.items():
+            if project and self.hints.get(task_id):
+                busy.setdefault(project, set()).update(self.hints[task_id])
+        for project, queue in self.queues.items():
+            for entry in queue:
+                busy.setdefault(project, set()).update(entry.paths)
+        return busy
+
+    async def _update(self, task_id: int, fields: dict):
+        if self.on_update is None:
+            return
+        try:
+            await self.on_update(task_id, fields)
+        except Exception as e:
+            log.error(f"Merge status update for task #{task_id} failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "projects": sorted(self.projects),
+            "queued": {name: [e.task_id for e in queue] for name, queue in self.queues.items()},
+            "merged": self.merged,
+            "conflicts": self.conflicts,
+            "check_failures": self.check_failures,
+            "rounds": self.rounds,
+        }
@@ -0,0 +1,191 @@
+"""
+Metrics - 进程内指标注册表，按 Prometheus 文本格式导出（GET /metrics）
+不依赖 prometheus_client：Counter / Gauge / Histogram 各自带锁，可以在 DB 线程里打点。
+各模块在模块级声明自己的指标并上报到同一个 REGISTRY；
+只在抓取时才有意义的量（队列深度、worker 状态、WebSocket 队列）通过 collector 回调现算。
+"""
+import asyncio
+import inspect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# 秒级延迟的默认分桶：从 1ms 到 1h
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple[str, str] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 无标签的指标从 0 开始导出
+        self.values: Dict[tuple, float] = {} if self.labels else {(): 0}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def replace(self, values: Dict[tuple, float]):
+        """整体替换所有标签组合（collector 用，消失的组合不再导出）"""
+        with self._lock:
+            self.values = {tuple(str(v) for v in k): value for k, value in values.items()}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.series: Dict[tuple, list] = {}  # labels -> [各桶计数..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', _format_value(bound)))} "
+                             f"{cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.collectors: Dict[str, Callable] = {}
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        # 重复声明（如模块被重新导入）返回同一个指标
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def add_collector(self, name: str, fn: Callable):
+        """抓取前调用 fn()（可以是协程函数）刷新 gauge；同名 collector 后注册的覆盖先注册的"""
+        self.collectors[name] = fn
+
+    async def collect(self):
+        for fn in list(self.collectors.values()):
+            result = fn()
+            if inspect.isawaitable(result):
+                await result
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    "cc_event_loop_lag_seconds", "Delay between scheduled and actual wake-up of the event loop probe",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+async def monitor_event_loop(interval: float = 0.5):
+    """定时 sleep，实际醒来比预期晚多少就是事件循环被阻塞的时间"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, Float
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, Boolean, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -12,21 +12,78 @@ class Task(Base):
     title = Column(String(255), nullable=False)
     prompt = Column(Text, nullable=False)
     priority = Column(Integer, default=0)
-    status = Column(String(50), default="queued")  # queued, running, done, failed
+    status = Column(String(50), default="queued")  # blocked, queued, running, done, failed, cancelled
     mode = Column(String(50), default="execute")  # execute, plan
     plan_text = Column(Text, nullable=True)
     result = Column(Text, nullable=True)
     worker_id = Column(Integer, nullable=True)
+    owner = Column(String(64), nullable=True)  # 持有租约的分发进程（本地 worker 的 slot 编号只在进程内唯一）；agent 为空
     branch_name = Column(String(255), nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    commit_sha = Column(String(40), nullable=True)  # 自动提交的 commit，由 git 流水线写入
+    push_status = Column(String(50), nullable=True)  # pending, retrying, pushed, failed, no_changes, no_remote, skipped
+    push_error = Column(Text, nullable=True)
+    merge_status = Column(String(50), nullable=True)  # queued, merged, conflict, check_failed, failed（见 merge_queue.py）
+    merge_error = Column(Text, nullable=True)
+    # 最近一次运行的资源用量（见 resources.py）
+    cpu_seconds = Column(Float, nullable=True)
+    peak_rss_mb = Column(Float, nullable=True)
+    wall_seconds = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     finished_at = Column(DateTime, nullable=True)
+    version = Column(Integer, nullable=True, index=True)  # 队列变更版本号，每次修改单调递增
+    lease_expires_at = Column(DateTime, nullable=True)  # running 任务的租约到期时间，由心跳续期
+    attempts = Column(Integer, default=0, server_default=text("0"))  # 已被认领的次数
+    retries = Column(Integer, default=0, server_default=text("0"))  # 暂时性故障后自动重试的次数
+    not_before = Column(DateTime, nullable=True)  # 退避中的任务在此时间之前不会被分发
+    failure_class = Column(String(50), nullable=True)  # 最近一次失败的分类，见 failures.py
+    no_cache = Column(Boolean, default=False, server_default=text("0"))  # 跳过结果缓存
+    prompt_hash = Column(String(64), nullable=True)  # sha256(prompt)，用于提交时去重
+    idempotency_key = Column(String(255), nullable=True)  # 客户端提交的幂等键
+    pending_deps = Column(Integer, default=0, server_default=text("0"))  # 尚未完成的依赖数，归零后 blocked -> queued
+
+    __table_args__ = (
+        # 分发查询：WHERE status='queued' ORDER BY priority DESC, id ASC
+        Index("ix_tasks_status_priority_id", status, priority.desc(), id),
+        # 列表查询：WHERE status=? ORDER BY created_at DESC
+        Index("ix_tasks_status_created_at", status, created_at),
+        # 租约回收：WHERE status='running' AND lease_expires_at < now
+        Index("ix_tasks_status_lease", status, lease_expires_at),
+        # 提交去重：WHERE prompt_hash=? AND project=? AND mode=? AND status IN ('queued', 'running')
+        Index("ix_tasks_prompt_hash", prompt_hash, project, mode, status),
+        Index("ix_tasks_idempotency_key", idempotency_key, unique=True),
+    )
+
+class TaskDependency(Base):
+    """task_id 依赖 depends_on：depends_on 完成后 task_id 的 pending_deps 减一"""
+    __tablename__ = "task_deps"
+
+    task_id = Column(Integer, primary_key=True)
+    depends_on = Column(Integer, primary_key=True, index=True)
+
 
 class Worker(Base):
     __tablename__ = "workers"
     
     id = Column(Integer, primary_key=True)
-    status = Column(String(50), default="idle")  # idle, running, committing
+    kind = Column(String(50), default="local")  # local（分发进程的 slot）, dispatcher（分发进程）, agent（远程 worker agent）
+    name = Column(String(255), nullable=True)
+    status = Column(String(50), default="idle")  # idle, dispatching, running, committing, dead
     current_task_id = Column(Integer, nullable=True)
     worktree_path = Column(String(255), nullable=True)
     project = Column(String(255), nullable=True)
     last_heartbeat = Column(DateTime, default=datetime.utcnow)
+    owner = Column(String(64), nullable=True)  # dispatcher 行和本地 slot 行：所属分发进程的标识
+    slot = Column(Integer, nullable=True)  # 本地 slot 在所属进程内的编号
+
+
+class CacheEntry(Base):
+    __tablename__ = "result_cache"
+
+    key = Column(String(64), primary_key=True)  # sha256(prompt, mode, model, project, base commit)
+    project = Column(String(255), nullable=False)
+    mode = Column(String(50), nullable=False)
+    result = Column(Text, nullable=False)
+    size = Column(Integer, nullable=False)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,107 @@
+"""
+Queue Index - 调度用的排队任务内存索引
+按项目分组，组内按有效优先级有序（bisect 维护的有序列表），同时记录各项目运行中的任务数（含远程 agent）。
+通过任务版本号增量同步：每轮分发只查询上次同步之后变化过的行，不再为每个空闲 worker 扫描整张表；
+每 RESYNC_INTERVAL 秒全量重建一次兜底。
+
+老化：排队每满 aging 秒，有效优先级 +1，低优先级任务等得足够久总能排到前面。
+有效优先级 = priority + (now - created_at) / aging，同一时刻所有任务的 now 项相同，
+所以排序键 created_at / aging - priority 不随时间变化，插入时算一次即可。
+"""
+import bisect
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+AGING_SECONDS = float(os.getenv("CC_MANAGER_AGING_SECONDS", 600))
+RESYNC_INTERVAL = 300
+EPOCH = datetime(1970, 1, 1)
+
+
+class QueueIndex:
+    def __init__(self, aging: float = AGING_SECONDS):
+        self.aging = aging
+        self.version: Optional[int] = None
+        self.loaded_at = 0.0
+        self.tasks: Dict[int, dict] = {}           # task_id -> {"project", "priority", "status", "key", "not_before"}
+        self.queues: Dict[str, List[tuple]] = {}   # project -> [(key, task_id)]，升序
+        self.running: Dict[str, int] = {}          # project -> 运行中任务数
+
+    def since(self) -> Optional[int]:
+        """下一次同步的起始版本；需要全量加载时返回 None"""
+        if self.version is None or time.monotonic() - self.loaded_at > RESYNC_INTERVAL:
+            return None
+        return self.version
+
+    def apply(self, version: int, rows: List[dict], full: bool = False):
+        """应用 TaskQueue.queue_changes 的结果；重复应用同一行是幂等的"""
+        if full:
+            self.tasks, self.queues, self.running = {}, {}, {}
+            self.loaded_at = time.monotonic()
+        for row in rows:
+            self._remove(row["id"])
+            if row["status"] in ("queued", "running"):
+                self._add(row["id"], {
+                    "project": row["project"],
+                    "priority": row["priority"] or 0,
+                    "status": row["status"],
+                    "key": self._key(row),
+                    "not_before": row["not_before"],
+                })
+        self.version = version
+
+    def mark_running(self, tasks: List[dict]):
+        """刚认领的任务立即移出队列，不等下一次同步"""
+        for task in tasks:
+            entry = self._remove(task["id"])
+            if entry:
+                self._add(task["id"], {**entry, "status": "running"})
+
+    def projects(self) -> List[str]:
+        return list(self.queues)
+
+    def head(self, project: str, limit: int, now: datetime = None) -> Iterator[dict]:
+        """项目内按有效优先级取前 limit 个可分发的任务（跳过退避中的）"""
+        now = now or datetime.utcnow()
+        count = 0
+        for _, task_id in self.queues.get(project, ()):
+            if count >= limit:
+                return
+            entry = self.tasks[task_id]
+            if entry["not_before"] and entry["not_before"] > now:
+                continue
+            count += 1
+            yield {"id": task_id, "project": project, "priority": entry["priority"]}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def _key(self, row: dict) -> float:
+        if self.aging <= 0 or row["created_at"] is None:
+            return -(row["priority"] or 0)
+        return (row["created_at"] - EPOCH).total_seconds() / self.aging - (row["priority"] or 0)
+
+    def _add(self, task_id: int, entry: dict):
+        self.tasks[task_id] = entry
+        project = entry["project"]
+        if entry["status"] == "queued":
+            bisect.insort(self.queues.setdefault(project, []), (entry["key"], task_id))
+        else:
+            self.running[project] = self.running.get(project, 0) + 1
+
+    def _remove(self, task_id: int) -> Optional[dict]:
+        entry = self.tasks.pop(task_id, None)
+        if entry is None:
+            return None
+        project = entry["project"]
+        if entry["status"] == "queued":
+            queue = self.queues[project]
+            del queue[bisect.bisect_left(queue, (entry["key"], task_id))]
+            if not queue:
+                del self.queues[project]
+        else:
+            self.running[project] -= 1
+            if not self.running[project]:
+                del self.running[project]
+        return entry
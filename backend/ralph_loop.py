@@ -1,17 +1,34 @@
 """
 Ralph Loop - 后台持续任务分发循环
-每 5 秒检查一次队列，找到空闲 worker 就分配任务
+事件驱动：提交任务或 worker 空闲时立即唤醒分配，定时轮询仅作兜底
 """
 import asyncio
 import logging
 import os
-import shlex
+import socket
 import sys
+import time
+import uuid
 from datetime import datetime
+from typing import List, Optional
 
 sys.path.insert(0, os.path.dirname(__file__))
 from task_queue import TaskQueue
+from db import run_db, run_db_write
 from worker_manager import WorkerManager
+from task_logs import TaskLogStore
+from log_hub import LogHub
+from scheduler import Scheduler
+from queue_index import QueueIndex
+from autoscaler import Autoscaler
+from worktree_pool import load_projects, clean_head
+from failures import describe
+from rate_limiter import RateLimiter
+from result_cache import ResultCache, cache_key
+from git_pipeline import GitPipeline
+from merge_queue import MergeQueue
+from metrics import REGISTRY, monitor_event_loop
+from runner import MODEL, Runner
 
 logging.basicConfig(
     level=logging.INFO,
@@ -20,140 +37,345 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+TASK_RUN = REGISTRY.histogram("cc_task_run_seconds", "Claude Code run time on local workers", ["mode", "result"])
+DISPATCH_TICK = REGISTRY.histogram("cc_dispatch_tick_seconds", "Time spent in one dispatch round")
+DISPATCHED = REGISTRY.counter("cc_tasks_dispatched_total", "Tasks handed to workers", ["kind"])
+THROTTLED = REGISTRY.counter("cc_dispatch_throttled_total",
+                             "Dispatch rounds with idle workers that started nothing", ["reason"])
+UPSTREAM_LIMIT = REGISTRY.gauge("cc_upstream_concurrency_limit", "Adaptive upstream concurrency limit (-1 = unlimited)")
+UPSTREAM_COOLDOWN = REGISTRY.gauge("cc_upstream_cooldown_seconds", "Remaining upstream rate-limit cooldown")
+TASK_CPU = REGISTRY.histogram("cc_task_cpu_seconds", "CPU time used by one agent run", ["mode"],
+                              buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+TASK_RSS = REGISTRY.histogram("cc_task_peak_rss_mb", "Peak RSS of one agent run's process tree", ["mode"],
+                              buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+MERGE_QUEUE = REGISTRY.gauge("cc_merge_queue", "Task branches waiting in the merge queue", ["project"])
+
 
 class RalphLoop:
-    def __init__(self, num_workers: int = 2):
-        self.tq = TaskQueue()
-        self.wm = WorkerManager(num_workers=num_workers)
+    def __init__(self, num_workers: int = 2, tq: Optional[TaskQueue] = None,
+                 logs: Optional[TaskLogStore] = None, hub: Optional[LogHub] = None,
+                 min_workers: int = None, max_workers: int = None):
+        self.tq = tq or TaskQueue()
+        self.logs = logs or TaskLogStore()
+        self.hub = hub or LogHub()
+        projects = load_projects()
+        caps = {name: cfg["max_concurrency"] for name, cfg in projects.items() if "max_concurrency" in cfg}
+        weights = {name: float(cfg["weight"]) for name, cfg in projects.items() if "weight" in cfg}
+        self.scheduler = Scheduler(caps=caps, weights=weights)
+        # 排队任务的内存快照，每轮分发前按版本号增量同步
+        self.index = QueueIndex()
+        self.wm = WorkerManager(num_workers=num_workers, min_workers=min_workers, max_workers=max_workers)
+        # 只有配置了可伸缩区间才自动扩缩容
+        self.autoscaler = Autoscaler(self.wm, enabled=self.wm.max_workers > self.wm.min_workers)
+        self.agent_timeout = 45  # 远程 agent 心跳超时（秒），超时后其任务重新入队
+        # 本分发进程的标识：本地 worker 的租约和 workers 行都带上它，多个分发进程的 slot 编号不会互相冲突
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
         self.running = False
-        self.interval = 5
+        self.interval = 30  # 兜底轮询间隔（秒），正常分配由 notify() 触发
+        self._wake = asyncio.Event()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 所有 worker 共用 env 里的 API key / base URL，对应同一个上游限流器
+        self.limiters = RateLimiter()
+        self.limiter = self.limiters.get()
+        self.cache = ResultCache(self.tq.Session)
+        # 自动提交 / 推送在后台流水线里做，worker 跑完 Claude 就释放
+        self.git = GitPipeline(on_update=self.on_git_update)
+        # 直接以 CC_AGENT_USER 身份 exec claude，带资源限制（见 runner.py / resources.py）
+        self.runner = Runner(self.logs, run_as=os.getenv("CC_AGENT_USER", "ccuser"))
+        self.limits = self.runner.limits
+        # 推送成功的任务分支按顺序合入基线（项目配置 "merge_queue": true 时）
+        self.merges = MergeQueue(self.wm.pool, projects, self.runner, on_update=self.on_git_update)
+        REGISTRY.add_collector("ralph", self._collect)
+
+    def notify(self):
+        """唤醒分配循环（新任务入队 / worker 释放时调用）"""
+        self._wake.set()
 
     async def start(self):
         self.running = True
         log.info(f"Ralph Loop started with {self.wm.num_workers} workers")
+        # 后台预热各项目的 worktree 池，不阻塞分发
+        asyncio.create_task(self.wm.pool.prepare_all())
+        asyncio.create_task(self._autoscale_loop())
+        asyncio.create_task(monitor_event_loop())
+        asyncio.create_task(self.git.run())
+        self.merges.restore(await run_db(self.tq.list_merge_pending))
+        asyncio.create_task(self.merges.run())
+        log.info(f"Dispatcher id {self.owner}")
+        await self._recover()
+        asyncio.create_task(self._lease_loop())
         while self.running:
+            self._wake.clear()
             try:
                 await self._tick()
             except Exception as e:
                 log.error(f"Tick error: {e}")
-            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _autoscale_loop(self):
+        while self.running:
+            await asyncio.sleep(self.autoscaler.interval)
+            try:
+                await self.sync_queue()
+                if self.autoscaler.step(self.scheduler.dispatchable(self.index)):
+                    self.on_workers_changed()
+            except Exception as e:
+                log.error(f"Autoscale error: {e}")
+
+    async def _lease_loop(self):
+        """续期本地任务租约、同步 worker 状态，回收超时 agent 和过期租约"""
+        interval = min(self.tq.lease_seconds, self.agent_timeout) / 3
+        while self.running:
+            await asyncio.sleep(interval)
+            try:
+                task_ids = [w["current_task_id"] for w in self.wm.get_all_workers() if w["current_task_id"]]
+                await run_db_write(self.tq.renew_leases, task_ids, owner=self.owner)
+                for agent_id in await run_db_write(self.tq.reap_agents, self.agent_timeout):
+                    log.warning(f"Agent #{agent_id} missed heartbeats, marked dead")
+                await self._recover()
+            except Exception as e:
+                log.error(f"Lease loop error: {e}")
+
+    async def _recover(self):
+        """持久化本地 worker 状态（兼作本进程心跳），回收已退出的分发进程和租约过期的任务"""
+        await run_db_write(self.tq.sync_workers, self.owner, self.wm.get_all_workers())
+        expired = await run_db_write(self.tq.reap_dispatchers, self.tq.lease_seconds)
+        if expired:
+            log.warning(f"Recovering tasks left running by exited dispatchers: {expired}")
+        expired = await run_db_write(self.tq.requeue_expired)
+        for task_id in expired["requeued"]:
+            log.warning(f"Task #{task_id} requeued: lease expired")
+            self.hub.publish_status(task_id, "queued", worker_id=None)
+        for task_id in expired["failed"]:
+            log.error(f"Task #{task_id} failed: lease expired {self.tq.max_attempts} times")
+            self.hub.publish_status(task_id, "failed")
+        self.publish_dag(expired)
+        if expired["requeued"]:
+            self.notify()
+
+    def wake_after(self, delay: float):
+        """delay 秒后唤醒分配循环（退避结束 / 限流令牌恢复），只保留最早的一个定时器"""
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        if self._timer and not self._timer.cancelled() and self._timer.when() <= when:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self.notify)
+
+    def on_upstream_result(self, failure_class: Optional[str]):
+        """把任务结果反馈给上游限流器：限流类错误收紧并发，成功则逐步放开"""
+        if failure_class in ("rate_limit", "overloaded"):
+            self.limiter.on_rate_limited()
+        elif failure_class is None:
+            self.limiter.on_success()
+
+    def publish_dag(self, effects: dict):
+        """推送依赖处理结果：解除阻塞的任务进入队列，失败传播的任务标记 failed"""
+        for task_id in effects.get("released", []):
+            self.hub.publish_status(task_id, "queued")
+        for task_id in effects.get("cascaded", []):
+            self.hub.publish_status(task_id, "failed", failure_class="dependency")
+        if effects.get("released"):
+            self.notify()
+
+    def cancel_task(self, task_id: int) -> bool:
+        """停止在本地 worker 上运行的任务（任务状态已由调用方改为 cancelled），进程退出后 worker 立即空出
+
+        任务不在本地 worker 上时返回 False（远程 agent 在下一次心跳时得知取消）。
+        """
+        if not any(w["current_task_id"] == task_id for w in self.wm.workers.values()):
+            return False
+        asyncio.create_task(self.runner.cancel(task_id))
+        return True
+
+    def on_workers_changed(self):
+        """worker 数量变化后推送状态并重新分配"""
+        self.hub.publish_workers(self.wm.get_all_workers())
+        self.notify()
 
     async def stop(self):
         self.running = False
+        self.notify()
+
+    def _collect(self):
+        UPSTREAM_LIMIT.set(self.limiter.limit if self.limiter.limit is not None else -1)
+        UPSTREAM_COOLDOWN.set(self.limiter.stats()["cooldown_remaining"])
+        MERGE_QUEUE.replace({(name,): len(queue) for name, queue in self.merges.queues.items()})
 
     async def _tick(self):
-        idle_workers = self.wm.get_idle_workers()
+        with DISPATCH_TICK.time():
+            await self._dispatch()
+
+    async def _dispatch(self):
+        # 先占住空闲 worker 再 await，期间的缩容只会把它们标记 draining
+        idle_workers = self.wm.reserve_idle()
         if not idle_workers:
             return
+        try:
+            await self._assign(idle_workers)
+        finally:
+            self.wm.unreserve([w["id"] for w in idle_workers])
+
+    async def _assign(self, idle_workers: List[dict]):
         log.info(f"Idle workers: {[w['id'] for w in idle_workers]}")
-        for worker in idle_workers:
-            task = self.tq.get_next_task()
-            if not task:
-                break
+        # 只有设置了并发上限时才需要精确的全局 running 数（含远程 agent）
+        running = await run_db(self.tq.count_tasks, "running") if self.limiter.limit is not None else self.wm.count_busy()
+        budget = self.limiter.allowance(running)
+        if budget <= 0:
+            THROTTLED.inc(reason="upstream")
+            wait = self.limiter.wait_time()
+            if wait > 0:
+                self.wake_after(wait)
+            return
+        await self.sync_queue()
+        candidates = self.scheduler.order(self.index)
+        busy_paths = None
+        if self.merges.projects:
+            await self.merges.annotate(candidates, lambda ids: run_db(self.tq.get_prompts, ids))
+            running = {w["current_task_id"]: w["project"] for w in self.wm.get_all_workers() if w["current_task_id"]}
+            busy_paths = self.merges.busy_paths(running)
+        pairs = self.scheduler.assign(idle_workers, candidates, self.index.running, busy_paths, budget)
+        if not pairs:
+            if candidates:
+                THROTTLED.inc(reason="scheduler")
+            return
+        workers = {w["id"]: w for w in idle_workers}
+        claimed = await run_db_write(self.tq.claim_assignments, {t["id"]: w["id"] for w, t in pairs}, self.owner)
+        self.index.mark_running(claimed)
+        self.scheduler.charge(claimed)
+        self.limiter.take(len(claimed))
+        DISPATCHED.inc(len(claimed), kind="local")
+        if len(claimed) < len(pairs):
+            # 部分任务被其他分发进程抢走，马上再调度一轮
+            self.notify()
+        for task in claimed:
+            worker = workers[task["worker_id"]]
             log.info(f"Assigning task #{task['id']} to worker #{worker['id']}")
-            self.tq.update_task_status(task_id=task["id"], status="running", worker_id=worker["id"])
+            # 立即占住 worker，避免紧接着的下一轮 tick 重复分配
+            self.wm.set_worker_running(worker["id"], task["id"], task["project"])
+            self.hub.publish_status(task["id"], "running", worker_id=worker["id"])
             asyncio.create_task(self._run_task(worker, task))
 
+    async def sync_queue(self):
+        since = self.index.since()
+        version, rows = await run_db(self.tq.queue_changes, since)
+        self.index.apply(version, rows, full=since is None)
+
+    async def lease_for_agent(self, agent_id: int, max_tasks: int) -> List[dict]:
+        """远程 agent 拉取任务：和本地 worker 共用公平调度与项目并发上限"""
+        if max_tasks <= 0:
+            return []
+        await self.sync_queue()
+        picked = self.scheduler.take(self.scheduler.order(self.index), max_tasks, self.index.running)
+        claimed = await run_db_write(self.tq.claim_assignments, {t["id"]: agent_id for t in picked})
+        self.index.mark_running(claimed)
+        self.scheduler.charge(claimed)
+        return claimed
+
     async def _run_task(self, worker: dict, task: dict):
         worker_id = worker["id"]
         task_id = task["id"]
         try:
-            self.wm.set_worker_running(worker_id, task_id)
+            self.hub.publish_workers(self.wm.get_all_workers())
             log.info(f"Worker #{worker_id} starting task #{task_id}: {task['title']}")
-            worktree_path = await self.wm.get_worktree(worker_id, task["project"])
+            worktree_path = await self.wm.get_worktree(worker_id, task["project"], task_id)
+            key = await self._cache_key(task, worktree_path)
+            cached = await run_db_write(self.cache.get, key) if key else None
+            if cached is not None:
+                log.info(f"Task #{task_id} served from result cache")
+                await self._finish(worker_id, task, "done", cached)
+                return
+            start = time.perf_counter()
             result = await self._execute_cc(task, worktree_path)
-            if result["success"]:
+            outcome = "cancelled" if result.get("cancelled") else "ok" if result["success"] else "error"
+            TASK_RUN.observe(time.perf_counter() - start, mode=task.get("mode", "execute"), result=outcome)
+            if result.get("cancelled"):
+                # 状态已经是 cancelled，不再写结果，也不计入上游失败
+                log.info(f"Task #{task_id} cancelled on worker #{worker_id}")
+            elif result["success"]:
                 log.info(f"Task #{task_id} completed OK")
-                self.tq.update_task_status(task_id=task_id, status="done", result=result.get("stdout", "")[:2000])
-                await self._auto_commit(worktree_path, task)
+                self.on_upstream_result(None)
+                await self._finish(worker_id, task, "done", result.get("stdout", ""), result.get("usage"))
+                if key:
+                    await run_db_write(self.cache.put, key, task["project"], task["mode"], result.get("stdout", ""))
+                self.git.submit(task, self.wm.hand_off_worktree(worktree_path), self.wm.release_path)
             else:
-                err = result.get("stderr") or result.get("error", "Unknown")
-                log.error(f"Task #{task_id} FAILED: {err[:300]}")
-                self.tq.update_task_status(task_id=task_id, status="failed", result=err[:2000])
-                self._log_failure_to_progress(task, {"error": err})
+                await self._fail(worker_id, task, result)
         except Exception as e:
             log.error(f"Worker #{worker_id} exception: {e}")
-            self.tq.update_task_status(task_id=task_id, status="failed", result=str(e))
+            await self._fail(worker_id, task, {"error": str(e)})
         finally:
+            self.runner.forget(task_id)
+            self.wm.release_worktree(worker_id)
             self.wm.set_worker_idle(worker_id)
+            self.hub.publish_workers(self.wm.get_all_workers())
             log.info(f"Worker #{worker_id} idle")
+            self.notify()
 
-    async def _execute_cc(self, task: dict, worktree_path: str) -> dict:
-        """以 ccuser stdin 方式执行 Claude Code（避免复杂引号嵌套）"""
-        prompt = task["prompt"]
-        mode = task.get("mode", "execute")
-        if mode == "plan":
-            prompt = "请先分析并输出实施计划，不要写代码。\n\n" + prompt
-
-        api_key = os.getenv("ANTHROPIC_API_KEY", "")
-        base_url = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
-        auth_token = os.getenv("ANTHROPIC_AUTH_TOKEN", api_key)
-
-        # 把命令写到临时脚本文件，避免引号嵌套问题
-        import tempfile
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".sh", delete=False, dir="/tmp") as f:
-            script_path = f.name
-            f.write(f"""#!/bin/bash
-export ANTHROPIC_API_KEY='{api_key}'
-export ANTHROPIC_BASE_URL='{base_url}'
-export ANTHROPIC_AUTH_TOKEN='{auth_token}'
-export HOME=/home/ccuser
-cd {shlex.quote(worktree_path)}
-exec claude -p {shlex.quote(prompt)} --dangerously-skip-permissions --output-format text --model claude-opus-4-6
-""")
+    async def _cache_key(self, task: dict, worktree_path: str) -> Optional[str]:
+        """可缓存的任务返回缓存 key；工作区不是干净的 git 仓库时无法确定仓库状态，不缓存"""
+        if not self.cache.applies(task):
+            return None
+        base_commit = await clean_head(worktree_path)
+        if base_commit is None:
+            return None
+        return cache_key(task["prompt"], task["mode"], MODEL, task["project"], base_commit)
 
-        try:
-            os.chmod(script_path, 0o755)
-            # 把脚本所有权给 ccuser
-            os.system(f"chown ccuser:ccuser {script_path}")
-
-            log.info(f"Running script as ccuser: {script_path}")
-            proc = await asyncio.create_subprocess_shell(
-                f"su -s /bin/bash ccuser {script_path}",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=3600)
-
-            out = stdout.decode("utf-8", errors="replace")
-            err = stderr.decode("utf-8", errors="replace")
-
-            if proc.returncode != 0:
-                log.error(f"claude rc={proc.returncode}, stderr={err[:300]}")
-
-            return {
-                "success": proc.returncode == 0,
-                "stdout": out,
-                "stderr": err,
-                "returncode": proc.returncode
-            }
-        except asyncio.TimeoutError:
-            try:
-                proc.kill()
-            except Exception:
-                pass
-            return {"success": False, "error": "Task timed out"}
-        except Exception as e:
-            return {"success": False, "error": str(e)}
-        finally:
-            try:
-                os.unlink(script_path)
-            except Exception:
-                pass
+    async def _finish(self, worker_id: int, task: dict, status: str, result: str, usage: dict = None):
+        """写入结果；租约已过期并被回收（或任务已取消）时放弃写入"""
+        task_id = task["id"]
+        plan_text = result if task.get("mode") == "plan" else None
+        effects = await run_db_write(self.tq.finish_task, task_id, worker_id, status, result,
+                                     plan_text=plan_text, usage=usage, owner=self.owner)
+        if effects is not None:
+            self.hub.publish_status(task_id, status)
+            self.publish_dag(effects)
+        else:
+            log.warning(f"Task #{task_id} no longer held by worker #{worker_id}, result discarded")
 
-    async def _auto_commit(self, worktree_path: str, task: dict):
-        try:
-            msg = f"Task #{task['id']}: {task['title']}"
-            proc = await asyncio.create_subprocess_shell(
-                f"cd {shlex.quote(worktree_path)} && git add -A && "
-                f"git diff --cached --quiet || git commit -m {shlex.quote(msg)} && git push origin HEAD 2>/dev/null || true",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await proc.communicate()
-            log.info(f"Auto-committed in {worktree_path}")
-        except Exception as e:
-            log.error(f"Auto-commit failed: {e}")
+    async def _fail(self, worker_id: int, task: dict, result: dict):
+        """按失败类别处理：暂时性故障退避后重新入队，其余标记 failed"""
+        task_id = task["id"]
+        failure_class, err = describe(result)
+        self.on_upstream_result(failure_class)
+        outcome = await run_db_write(self.tq.fail_task, task_id, worker_id, err[:2000], failure_class,
+                                     usage=result.get("usage"), owner=self.owner)
+        if outcome is None:
+            log.warning(f"Task #{task_id} no longer held by worker #{worker_id}, result discarded")
+        elif outcome["status"] == "queued":
+            log.warning(f"Task #{task_id} {failure_class}, retry #{outcome['retries']} in {outcome['delay']:.0f}s")
+            self.hub.publish_status(task_id, "queued", worker_id=None, retries=outcome["retries"],
+                                    failure_class=failure_class)
+            self.wake_after(outcome["delay"])
+        else:
+            log.error(f"Task #{task_id} FAILED ({failure_class}): {err[:300]}")
+            self.hub.publish_status(task_id, "failed", failure_class=failure_class)
+            self.publish_dag(outcome)
+            self._log_failure_to_progress(task, {"error": f"[{failure_class}] {err}"})
+
+    async def _execute_cc(self, task: dict, worktree_path: str) -> dict:
+        result = await self.runner.run(
+            task, worktree_path, on_output=lambda offset, line: self.hub.publish_log(task["id"], offset, line))
+        if "usage" in result:
+            mode = task.get("mode", "execute")
+            TASK_CPU.observe(result["usage"]["cpu_seconds"], mode=mode)
+            TASK_RSS.observe(result["usage"]["peak_rss_mb"], mode=mode)
+        return result
+
+    async def on_git_update(self, task_id: int, fields: dict, worker_id: int = None) -> bool:
+        """git 流水线 / 合并队列的状态回写；任务分支推送成功后进入合并队列"""
+        if not await run_db_write(self.tq.update_git, task_id, fields, worker_id):
+            return False
+        task = await run_db(self.tq.get_task, task_id)
+        self.hub.publish_status(task_id, task.status, **fields)
+        if fields.get("push_status") == "pushed" and self.merges.enabled(task.project):
+            asyncio.create_task(self.merges.submit(task.id, task.project, task.title, task.branch_name,
+                                                   task.commit_sha))
+        return True
 
     def _log_failure_to_progress(self, task: dict, result: dict):
         progress_path = "/root/cc-manager/PROGRESS.md"
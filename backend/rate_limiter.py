@@ -0,0 +1,146 @@
+"""
+Rate Limiter - 上游模型 API 的并发预算与启动速率限制
+同一个 API key / base URL 下的所有会话共用一个 UpstreamLimiter：
+  - 并发上限：同时运行的会话数（按 DB 中 running 任务数计，远程 agent 也算在内）
+  - 启动速率：令牌桶，每分钟最多启动 rate 个会话，允许 burst 个突发
+  - 自适应退避：检测到限流时并发上限减半并冷却一段时间，之后每成功一次上限 +1（AIMD）
+"""
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+COOLDOWN_BASE = 30   # 首次限流后的冷却时间（秒），连续限流时翻倍
+COOLDOWN_MAX = 600
+UNLIMITED = 1 << 16
+
+
+def upstream_key(env=None) -> str:
+    """base URL + API key 指纹，用来区分不同的上游额度（不暴露 key 本身）"""
+    env = os.environ if env is None else env
+    base_url = env.get("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+    key = env.get("ANTHROPIC_AUTH_TOKEN") or env.get("ANTHROPIC_API_KEY", "")
+    return f"{base_url}#{hashlib.sha256(key.encode()).hexdigest()[:8]}"
+
+
+class TokenBucket:
+    def __init__(self, rate_per_min: float, burst: int):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> int:
+        self._refill()
+        return int(self.tokens)
+
+    def take(self, n: int):
+        self._refill()
+        self.tokens -= n
+
+    def wait_time(self) -> float:
+        """距离下一个令牌还要多久"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class UpstreamLimiter:
+    def __init__(self, key: str, max_concurrent: int = 0, rate_per_min: float = 0, burst: int = 5):
+        self.key = key
+        self.max_concurrent = max_concurrent  # 0 表示不限
+        self.limit: Optional[int] = max_concurrent or None  # 自适应后的当前并发上限
+        self.bucket = TokenBucket(rate_per_min, burst) if rate_per_min > 0 else None
+        self.cooldown_until = 0.0
+        self.cooldown = COOLDOWN_BASE
+        self.running = 0
+        self.started = 0
+        self.rate_limited = 0
+
+    def allowance(self, running: int) -> int:
+        """当前还能启动几个会话"""
+        self.running = running
+        if time.monotonic() < self.cooldown_until:
+            return 0
+        rooms = []
+        if self.limit is not None:
+            rooms.append(self.limit - running)
+        if self.bucket:
+            rooms.append(self.bucket.available())
+        return max(0, min(rooms)) if rooms else UNLIMITED
+
+    def take(self, n: int):
+        if n <= 0:
+            return
+        self.started += n
+        self.running += n
+        if self.bucket:
+            self.bucket.take(n)
+
+    def wait_time(self) -> float:
+        """allowance 为 0 时，多久之后值得再试（并发占满时等 worker 释放的通知即可）"""
+        waits = [self.cooldown_until - time.monotonic()]
+        if self.bucket:
+            waits.append(self.bucket.wait_time())
+        return max(0.0, max(waits))
+
+    def on_rate_limited(self):
+        """乘性减小并发上限并进入冷却"""
+        self.rate_limited += 1
+        current = self.limit if self.limit is not None else max(self.running, 2)
+        self.limit = max(1, current // 2)
+        self.cooldown_until = time.monotonic() + self.cooldown
+        log.warning(f"Upstream {self.key} rate limited: concurrency -> {self.limit}, cooling down {self.cooldown}s")
+        self.cooldown = min(COOLDOWN_MAX, self.cooldown * 2)
+
+    def on_success(self):
+        """加性恢复并发上限"""
+        self.cooldown = COOLDOWN_BASE
+        if self.limit is None:
+            return
+        if self.max_concurrent and self.limit >= self.max_concurrent:
+            return
+        self.limit += 1
+        if not self.max_concurrent and self.limit > self.running * 2:
+            # 未配置上限时恢复到足够宽松就取消限制
+            self.limit = None
+
+    def stats(self) -> dict:
+        cooldown = self.cooldown_until - time.monotonic()
+        return {
+            "max_concurrent": self.max_concurrent or None,
+            "concurrency_limit": self.limit,
+            "running": self.running,
+            "starts_per_min": round(self.bucket.rate * 60, 2) if self.bucket else None,
+            "burst": self.bucket.burst if self.bucket else None,
+            "tokens": round(self.bucket.tokens, 2) if self.bucket else None,
+            "cooldown_remaining": round(cooldown, 1) if cooldown > 0 else 0,
+            "started": self.started,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class RateLimiter:
+    """按上游（API key / base URL）分组的限流器集合，配置来自环境变量"""
+
+    def __init__(self):
+        self.max_concurrent = int(os.getenv("UPSTREAM_MAX_CONCURRENT", 0))
+        self.rate_per_min = float(os.getenv("UPSTREAM_STARTS_PER_MIN", 0))
+        self.burst = int(os.getenv("UPSTREAM_BURST", 5))
+        self.limiters: Dict[str, UpstreamLimiter] = {}
+
+    def get(self, key: str = None) -> UpstreamLimiter:
+        key = key or upstream_key()
+        if key not in self.limiters:
+            self.limiters[key] = UpstreamLimiter(key, self.max_concurrent, self.rate_per_min, self.burst)
+        return self.limiters[key]
+
+    def stats(self) -> Dict[str, dict]:
+        return {key: limiter.stats() for key, limiter in self.limiters.items()}
@@ -0,0 +1,208 @@
+"""
+Resources - agent 子进程的资源限制与用量采样
+限制（环境变量配置，未配置的项不限制）：
+  CC_AGENT_MEMORY_MB   内存上限
+  CC_AGENT_CPU_QUOTA   CPU 配额，百分比（200 = 两个核），只有 cgroup 能限制
+  CC_AGENT_CPU_SECONDS CPU 时间上限（RLIMIT_CPU，超限的进程被 SIGXCPU 杀掉）
+  CC_AGENT_PIDS        进程数上限
+  CC_AGENT_NOFILE      打开文件数上限
+CC_AGENT_LIMITS 选择实现：auto（默认，有 systemd 时用 systemd-run --scope 建 cgroup v2 scope，
+否则退回 rlimit）/ systemd / rlimit / off。
+rlimit 只能近似：内存用 RLIMIT_DATA（限制的是单个进程），RLIMIT_NPROC 按用户计数，
+同一用户下的所有 agent 共享这个上限。
+
+UsageSampler 定时扫描 /proc 中 agent 的进程树，记录 CPU 时间（含已退出子进程）、
+整棵树的峰值 RSS 和墙钟时间，写到任务上供调度和容量规划使用。
+"""
+import asyncio
+import logging
+import os
+import resource
+import shutil
+import time
+import uuid
+from typing import Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 1.0
+PRLIMIT = shutil.which("prlimit")
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = resource.getpagesize()
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name, "").strip()
+    return int(value) if value else None
+
+
+def systemd_available() -> bool:
+    """systemd 是 init 且当前进程能创建 scope（需要 root）"""
+    return (shutil.which("systemd-run") is not None and os.path.isdir("/run/systemd/system")
+            and os.geteuid() == 0)
+
+
+class ResourceLimits:
+    def __init__(self, memory_mb: int = None, cpu_quota: int = None, cpu_seconds: int = None,
+                 pids: int = None, nofile: int = None, backend: str = "auto"):
+        self.memory_mb = memory_mb
+        self.cpu_quota = cpu_quota
+        self.cpu_seconds = cpu_seconds
+        self.pids = pids
+        self.nofile = nofile
+        if backend == "auto":
+            backend = "systemd" if systemd_available() else "rlimit"
+        self.backend = backend if self.configured() else "off"
+
+    @classmethod
+    def from_env(cls) -> "ResourceLimits":
+        return cls(
+            memory_mb=_env_int("CC_AGENT_MEMORY_MB"),
+            cpu_quota=_env_int("CC_AGENT_CPU_QUOTA"),
+            cpu_seconds=_env_int("CC_AGENT_CPU_SECONDS"),
+            pids=_env_int("CC_AGENT_PIDS"),
+            nofile=_env_int("CC_AGENT_NOFILE"),
+            backend=os.getenv("CC_AGENT_LIMITS", "auto"),
+        )
+
+    def configured(self) -> bool:
+        return any(v is not None for v in (self.memory_mb, self.cpu_quota, self.cpu_seconds, self.pids, self.nofile))
+
+    def wrap(self, cmd: List[str], name: str, uid: int = None, gid: int = None) -> List[str]:
+        """在命令前加 prlimit 设置 rlimit；systemd 后端再在最外层加 systemd-run --scope，
+        让整棵进程树进入独立的 cgroup
+
+        systemd-run 本身要以 root 运行，降权交给它的 --uid / --gid。
+        """
+        cmd = self._prlimit() + cmd
+        if self.backend != "systemd":
+            return cmd
+        props = []
+        if self.memory_mb is not None:
+            # 超过上限直接 OOM kill，不让它换出拖慢整台机器
+            props += [f"MemoryMax={self.memory_mb}M", "MemorySwapMax=0"]
+        if self.cpu_quota is not None:
+            props.append(f"CPUQuota={self.cpu_quota}%")
+        if self.pids is not None:
+            props.append(f"TasksMax={self.pids}")
+        args = ["systemd-run", "--scope", "--quiet", "--collect", f"--unit={name}-{uuid.uuid4().hex[:8]}"]
+        if uid is not None:
+            args += [f"--uid={uid}", f"--gid={gid}"]
+        for prop in props:
+            args += ["-p", prop]
+        return args + cmd
+
+    def _prlimit(self) -> List[str]:
+        """rlimit 用 prlimit 包一层再 exec，不在 fork 出的子进程里跑 Python（preexec_fn 在多线程进程里不安全）
+
+        systemd 后端只需要 cgroup 管不到的几项。
+        """
+        if self.backend == "off":
+            return []
+        limits = []
+        if self.cpu_seconds is not None:
+            limits.append(("cpu", resource.RLIMIT_CPU, self.cpu_seconds))
+        if self.nofile is not None:
+            limits.append(("nofile", resource.RLIMIT_NOFILE, self.nofile))
+        if self.backend == "rlimit":
+            if self.memory_mb is not None:
+                limits.append(("data", resource.RLIMIT_DATA, self.memory_mb * 1024 * 1024))
+            if self.pids is not None:
+                limits.append(("nproc", resource.RLIMIT_NPROC, self.pids))
+        if not limits:
+            return []
+        if PRLIMIT is None:
+            log.warning("prlimit not found, rlimits are not applied")
+            return []
+        args = [PRLIMIT]
+        for name, kind, value in limits:
+            # 降权后的进程不能调高硬上限，按 manager 当前的硬上限截断
+            _, hard = resource.getrlimit(kind)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            args.append(f"--{name}={value}:{value}")
+        return args + ["--"]
+
+    def describe(self) -> dict:
+        return {
+            "backend": self.backend,
+            "memory_mb": self.memory_mb,
+            "cpu_quota": self.cpu_quota,
+            "cpu_seconds": self.cpu_seconds,
+            "pids": self.pids,
+            "nofile": self.nofile,
+        }
+
+
+def _read_stat(pid: int) -> Optional[tuple]:
+    """返回 (ppid, 本进程 + 已回收子进程的 CPU ticks, rss 页数)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # comm 可能含空格，从最后一个 ')' 之后开始按字段切分
+    fields = data[data.rfind(")") + 2:].split()
+    ppid = int(fields[1])
+    ticks = int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])  # utime stime cutime cstime
+    rss = int(fields[21])
+    return ppid, ticks, rss
+
+
+def _process_tree(root: int) -> Dict[int, tuple]:
+    stats = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = _read_stat(int(name))
+            if stat:
+                stats[int(name)] = stat
+    tree, frontier = {}, [root]
+    children: Dict[int, List[int]] = {}
+    for pid, (ppid, _, _) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+    while frontier:
+        pid = frontier.pop()
+        if pid in stats and pid not in tree:
+            tree[pid] = stats[pid]
+            frontier.extend(children.get(pid, ()))
+    return tree
+
+
+class UsageSampler:
+    """定时采样一个进程树的资源用量；没有 /proc 的平台只记录墙钟时间"""
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.started = time.monotonic()
+        self.cpu_ticks = 0
+        self.peak_rss = 0  # 字节
+        self._task: Optional[asyncio.Task] = None
+        if os.path.isdir("/proc"):
+            self._task = asyncio.create_task(self._run())
+
+    def sample(self):
+        tree = _process_tree(self.pid)
+        if not tree:
+            return
+        # 已退出并被回收的子进程计入父进程的 cutime，所以整棵树求和只增不减
+        self.cpu_ticks = max(self.cpu_ticks, sum(ticks for _, ticks, _ in tree.values()))
+        self.peak_rss = max(self.peak_rss, sum(rss for _, _, rss in tree.values()) * _PAGE_SIZE)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+            except Exception as e:
+                log.debug(f"Usage sampling for pid {self.pid} failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stop(self) -> dict:
+        """停止采样，返回 {"cpu_seconds", "peak_rss_mb", "wall_seconds"}"""
+        if self._task:
+            self._task.cancel()
+        return {
+            "cpu_seconds": round(self.cpu_ticks / _CLK_TCK, 2),
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+            "wall_seconds": round(time.monotonic() - self.started, 2),
+        }
@@ -0,0 +1,121 @@
+"""
+Result Cache - 相同输入的任务结果复用（默认只缓存 plan 模式）
+key = sha256(规范化 prompt, mode, model, project, 基线 commit)，
+同一仓库状态下重复提交的 plan 任务直接返回上次的结果，不再跑一遍 Claude。
+条目存在 tasks.db 的 result_cache 表里：超过 TTL 视为失效，
+总条数 / 总字节数超限时按最近使用时间（LRU）淘汰。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, func, select
+
+from metrics import REGISTRY
+from models import CacheEntry
+
+log = logging.getLogger(__name__)
+
+LOOKUPS = REGISTRY.counter("cc_result_cache_lookups_total", "Result cache lookups", ["result"])
+
+
+def cache_key(prompt: str, mode: str, model: str, project: str, base_commit: str) -> str:
+    # 空白差异不影响语义，统一压缩成单个空格
+    normalized = re.sub(r"\s+", " ", prompt).strip()
+    raw = json.dumps([normalized, mode, model, project, base_commit], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, Session, enabled: bool = None):
+        self.Session = Session
+        self.enabled = enabled if enabled is not None else os.getenv("CC_MANAGER_RESULT_CACHE", "0") == "1"
+        self.modes = set(os.getenv("CC_MANAGER_CACHE_MODES", "plan").split(","))
+        self.ttl = timedelta(seconds=int(os.getenv("CC_MANAGER_CACHE_TTL", 7 * 24 * 3600)))
+        self.max_entries = int(os.getenv("CC_MANAGER_CACHE_MAX_ENTRIES", 1000))
+        self.max_bytes = int(os.getenv("CC_MANAGER_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def applies(self, task: dict) -> bool:
+        return self.enabled and not task.get("no_cache") and task.get("mode", "execute") in self.modes
+
+    def get(self, key: str) -> Optional[str]:
+        session = self.Session()
+        try:
+            entry = session.get(CacheEntry, key)
+            if entry is None or entry.created_at < datetime.utcnow() - self.ttl:
+                self.misses += 1
+                LOOKUPS.inc(result="miss")
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_used_at = datetime.utcnow()
+            result = entry.result
+            session.commit()
+            self.hits += 1
+            LOOKUPS.inc(result="hit")
+            return result
+        finally:
+            session.close()
+
+    def put(self, key: str, project: str, mode: str, result: str):
+        size = len(result.encode())
+        if size > self.max_bytes:
+            return
+        now = datetime.utcnow()
+        session = self.Session()
+        try:
+            session.merge(CacheEntry(key=key, project=project, mode=mode, result=result, size=size,
+                                     hits=0, created_at=now, last_used_at=now))
+            session.flush()
+            self._evict(session, now)
+            session.commit()
+        finally:
+            session.close()
+
+    def _evict(self, session, now: datetime):
+        """删除过期条目，再按 LRU 淘汰到条数和字节数都不超限"""
+        self.evictions += session.execute(
+            delete(CacheEntry).where(CacheEntry.created_at < now - self.ttl)
+        ).rowcount
+        count, total = session.execute(
+            select(func.count(CacheEntry.key), func.coalesce(func.sum(CacheEntry.size), 0))
+        ).one()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in session.execute(
+            select(CacheEntry.key, CacheEntry.size).order_by(CacheEntry.last_used_at.asc())
+        ):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append(key)
+            count -= 1
+            total -= size or 0
+        session.execute(delete(CacheEntry).where(CacheEntry.key.in_(victims)))
+        self.evictions += len(victims)
+
+    def stats(self) -> dict:
+        session = self.Session()
+        try:
+            entries, size = session.execute(
+                select(func.count(CacheEntry.key), func.coalesce(func.sum(CacheEntry.size), 0))
+            ).one()
+        finally:
+            session.close()
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "modes": sorted(self.modes),
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
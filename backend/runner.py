@@ -0,0 +1,201 @@
+"""
+Runner - 启动并跟踪一次 Claude Code 运行（manager 本地 worker 和远程 agent 共用）
+合并队列的检查命令也经由 exec() 以同样的用户、环境和资源限制运行
+直接 create_subprocess_exec 执行 claude：
+  - 降权在 fork 之后、exec 之前由 subprocess 完成（user / group / extra_groups），
+    不再经过临时脚本 + chown + su + bash，也不会把 API key 写到磁盘上
+  - 环境变量按白名单重新构造，不把 manager 进程的全部环境泄给 agent
+  - 资源限制和用量采样见 resources.py
+  - 每次运行是独立的进程组，取消时先 SIGTERM 整个进程组，宽限期后仍未退出再 SIGKILL
+运行用户由 CC_AGENT_USER 指定（manager 默认 ccuser）；当前进程不是 root 时无法切换用户，
+以当前用户运行。
+"""
+import asyncio
+import logging
+import os
+import pwd
+import shutil
+import signal
+from typing import Callable, Dict, List, Optional, Set
+
+from resources import ResourceLimits, UsageSampler
+from task_logs import TaskLogStore, capture_output
+
+log = logging.getLogger(__name__)
+
+MODEL = os.getenv("CC_MANAGER_MODEL", "claude-opus-4-6")
+CLAUDE_BIN = os.getenv("CC_AGENT_CLAUDE", "claude")
+TASK_TIMEOUT = 3600
+CANCEL_GRACE = float(os.getenv("CC_AGENT_CANCEL_GRACE", 10))
+PLAN_PREFIX = "请先分析并输出实施计划，不要写代码。\n\n"
+
+# 从 manager 环境原样传给 agent 的变量；ANTHROPIC_* / CLAUDE_* 前缀的变量全部透传
+ENV_PASSTHROUGH = ("PATH", "LANG", "LC_ALL", "TZ", "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY",
+                   "http_proxy", "https_proxy", "no_proxy")
+ENV_PREFIXES = ("ANTHROPIC_", "CLAUDE_")
+
+
+class _User:
+    def __init__(self, name: str):
+        entry = pwd.getpwnam(name)
+        self.name = name
+        self.uid = entry.pw_uid
+        self.gid = entry.pw_gid
+        self.home = entry.pw_dir
+        self.groups = [g for g in os.getgrouplist(name, entry.pw_gid) if g != entry.pw_gid]
+
+
+class Runner:
+    def __init__(self, logs: TaskLogStore, run_as: Optional[str] = None, model: str = MODEL,
+                 limits: Optional[ResourceLimits] = None, timeout: float = TASK_TIMEOUT):
+        self.logs = logs
+        self.model = model
+        self.limits = limits or ResourceLimits.from_env()
+        self.timeout = timeout
+        self.procs: Dict[int, asyncio.subprocess.Process] = {}  # task_id -> 运行中的进程
+        self.cancelled: Set[int] = set()
+        # 解析一次，之后每次启动直接 exec 绝对路径
+        self.claude = shutil.which(CLAUDE_BIN) or CLAUDE_BIN
+        self.user: Optional[_User] = None
+        self.user_error: Optional[str] = None
+        if run_as and os.geteuid() == 0:
+            try:
+                self.user = _User(run_as)
+            except KeyError:
+                # 不退回 root 运行，每个任务都报错
+                self.user_error = f"Agent user {run_as!r} does not exist"
+                log.error(self.user_error)
+        elif run_as and run_as != pwd.getpwuid(os.geteuid()).pw_name:
+            log.warning(f"Not running as root, agent runs as the current user instead of {run_as}")
+
+    def command(self, task: dict) -> List[str]:
+        prompt = task["prompt"]
+        if task.get("mode", "execute") == "plan":
+            prompt = PLAN_PREFIX + prompt
+        return [
+            self.claude,
+            "-p", prompt,
+            "--dangerously-skip-permissions",
+            "--output-format", "stream-json",
+            "--verbose",
+            "--model", self.model,
+        ]
+
+    def environment(self) -> dict:
+        env = {k: v for k, v in os.environ.items() if k in ENV_PASSTHROUGH or k.startswith(ENV_PREFIXES)}
+        env.setdefault("PATH", os.defpath)
+        env.setdefault("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+        if "ANTHROPIC_API_KEY" in env:
+            env.setdefault("ANTHROPIC_AUTH_TOKEN", env["ANTHROPIC_API_KEY"])
+        if self.user:
+            env.update(HOME=self.user.home, USER=self.user.name, LOGNAME=self.user.name)
+        else:
+            env["HOME"] = os.path.expanduser("~")
+        return env
+
+    async def spawn(self, task: dict, worktree_path: str) -> asyncio.subprocess.Process:
+        return await self._start(self.command(task), worktree_path, f"cc-task-{task['id']}")
+
+    async def exec(self, cmd: List[str], cwd: str, name: str, timeout: float = None) -> tuple:
+        """运行一条任意命令直到结束，返回 (returncode, stdout + stderr)；超时则 SIGKILL 进程组，returncode 为 None"""
+        proc = await self._start(cmd, cwd, name, stderr=asyncio.subprocess.STDOUT)
+        try:
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self._signal(proc, signal.SIGKILL)
+            await proc.wait()
+            return None, ""
+        return proc.returncode, out.decode(errors="replace")
+
+    async def _start(self, cmd: List[str], cwd: str, name: str,
+                     stderr: int = asyncio.subprocess.PIPE) -> asyncio.subprocess.Process:
+        if self.user_error:
+            raise RuntimeError(self.user_error)
+        uid, gid = (self.user.uid, self.user.gid) if self.user else (None, None)
+        cmd = self.limits.wrap(cmd, name, uid, gid)
+        kwargs = {}
+        if self.user and self.limits.backend != "systemd":
+            # systemd-run 要以 root 启动，由它自己降权；其余情况 fork 之后、exec 之前切换用户
+            kwargs = {"user": uid, "group": gid, "extra_groups": self.user.groups}
+        return await asyncio.create_subprocess_exec(
+            *cmd,
+            cwd=cwd,
+            env=self.environment(),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=stderr,
+            start_new_session=True,
+            **kwargs,
+        )
+
+    def _signal(self, proc: asyncio.subprocess.Process, sig: int):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def cancel(self, task_id: int, grace: float = CANCEL_GRACE) -> bool:
+        """停止任务的运行：还没启动的不再启动；已启动的 SIGTERM 进程组，grace 秒后 SIGKILL
+
+        等到进程退出后返回；任务不在本 runner 上运行时返回 False。
+        """
+        self.cancelled.add(task_id)
+        proc = self.procs.get(task_id)
+        if proc is None:
+            return False
+        if proc.returncode is None:
+            log.info(f"Task #{task_id} cancelled, sending SIGTERM to pid {proc.pid}")
+            self._signal(proc, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=grace)
+            except asyncio.TimeoutError:
+                log.warning(f"Task #{task_id} still running {grace:.0f}s after SIGTERM, killing")
+                self._signal(proc, signal.SIGKILL)
+                await proc.wait()
+        return True
+
+    def forget(self, task_id: int):
+        """任务结束（无论是否经过 run）后清理取消标记"""
+        self.cancelled.discard(task_id)
+
+    async def run(self, task: dict, worktree_path: str,
+                  on_output: Optional[Callable[[int, str], None]] = None) -> dict:
+        """执行到结束，返回 {"success", "stdout", "stderr", "is_error", "subtype", "returncode", "usage"}
+
+        被 cancel() 停止时返回 {"success": False, "cancelled": True, ...}。
+        """
+        task_id = task["id"]
+        if task_id in self.cancelled:
+            return {"success": False, "cancelled": True, "error": "Task cancelled"}
+        proc = None
+        sampler = None
+        try:
+            proc = self.procs[task_id] = await self.spawn(task, worktree_path)
+            sampler = UsageSampler(proc.pid)
+            if task_id in self.cancelled:
+                # 启动过程中收到取消
+                asyncio.create_task(self.cancel(task_id))
+            output = await asyncio.wait_for(
+                capture_output(proc, task["id"], self.logs, on_output=on_output), timeout=self.timeout)
+            if proc.returncode != 0 and task_id not in self.cancelled:
+                log.error(f"Task #{task['id']} claude rc={proc.returncode}, stderr={output['stderr'][:300]}")
+            result = {
+                "success": proc.returncode == 0 and not output["is_error"],
+                "stdout": output["stdout"],
+                "stderr": output["stderr"],
+                "is_error": output["is_error"],
+                "subtype": output["subtype"],
+                "returncode": proc.returncode,
+            }
+        except asyncio.TimeoutError:
+            result = {"success": False, "error": "Task timed out"}
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        finally:
+            if proc and proc.returncode is None:
+                self._signal(proc, signal.SIGKILL)
+            self.procs.pop(task_id, None)
+        if task_id in self.cancelled:
+            result = {**result, "success": False, "cancelled": True, "error": "Task cancelled"}
+        if sampler:
+            result["usage"] = sampler.stop()
+        return result
@@ -0,0 +1,202 @@
+"""
+Scheduler - 空闲 worker 与候选任务的配对策略
+公平分享：order() 用 start-time fair queuing 把各项目的排队任务按权重交织成候选序列，
+          某个项目批量提交时其他项目仍能按权重分到 worker；项目内仍按有效优先级（含老化）排序
+项目亲和：本轮要分配的任务优先交给上一次跑过同一项目的 worker（worktree / 依赖缓存是热的）
+防饿死：序列靠前的任务被跳过 max_skips 次后必须优先分配
+并发上限：caps 中配置了上限的项目，同时运行的任务数（含远程 agent）不超过上限
+路径重叠：候选任务带 "paths"（预计改动的文件）时，和运行中 / 待合并任务重叠的暂缓分配，
+          避免在合并时才发现冲突；被暂缓 max_skips 次，或从第一次被暂缓起超过 max_defer 秒后不再避让
+          （合并队列卡住、或项目里没有别的任务可分时跳过次数不会增加，靠时间兜底）
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from queue_index import QueueIndex
+
+log = logging.getLogger(__name__)
+
+MAX_DEFER = float(os.getenv("CC_MANAGER_MAX_DEFER", 600))
+
+
+class Scheduler:
+    def __init__(self, window: int = 20, max_skips: int = 3, caps: Dict[str, int] = None,
+                 weights: Dict[str, float] = None, max_defer: float = MAX_DEFER):
+        self.window = window        # 每次只在公平序列前 window 个任务里挑
+        self.max_skips = max_skips  # 单个任务最多被亲和调度跳过的次数
+        self.caps = caps or {}      # 项目 -> 最大同时运行数
+        self.weights = weights or {}  # 项目 -> 权重（默认 1），分到的 worker 数与权重成正比
+        self.vtime = 0.0            # 系统虚拟时间：最近分配的任务的开始标签
+        self.finish: Dict[str, float] = {}  # 项目 -> 上一个分配任务的完成标签
+        self.skips: Dict[int, int] = {}
+        self.max_defer = max_defer  # 路径重叠最多暂缓多久（秒）
+        self.deferred_since: Dict[int, float] = {}  # task_id -> 第一次因路径重叠被暂缓的时刻（monotonic）
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.overlap_deferrals = 0
+
+    def weight(self, project: str) -> float:
+        return max(self.weights.get(project, 1.0), 0.01)
+
+    def order(self, index: QueueIndex, now: datetime = None) -> List[dict]:
+        """各项目排队任务的公平交织序列（前 window 个），供 assign / take 使用
+
+        项目 p 的第 k 个任务（k 从 0 开始）开始标签为 max(V, F_p) + k / weight，按标签升序；
+        空闲过的项目从当前虚拟时间 V 开始，不会攒下额度；已达并发上限的项目不参与。
+        """
+        tagged = []
+        for project in index.projects():
+            cap = self.caps.get(project)
+            room = self.window if cap is None else min(self.window, cap - index.running.get(project, 0))
+            if room <= 0:
+                continue
+            start, step = max(self.finish.get(project, 0.0), self.vtime), 1 / self.weight(project)
+            for k, task in enumerate(index.head(project, room, now)):
+                tagged.append((start + k * step, task["id"], task))
+        tagged.sort(key=lambda t: t[:2])
+        return [task for _, _, task in tagged[:self.window]]
+
+    def dispatchable(self, index: QueueIndex, now: datetime = None) -> int:
+        """现在就能分发的排队任务数：不算退避中的任务，有并发上限的项目最多算到剩余名额"""
+        total = 0
+        for project in index.projects():
+            room = len(index.queues[project])
+            cap = self.caps.get(project)
+            if cap is not None:
+                room = min(room, cap - index.running.get(project, 0))
+            if room > 0:
+                total += sum(1 for _ in index.head(project, room, now))
+        return total
+
+    def charge(self, tasks: List[dict]):
+        """已认领的任务推进所属项目的完成标签和虚拟时间"""
+        for task in tasks:
+            project = task["project"]
+            start = max(self.finish.get(project, 0.0), self.vtime)
+            self.finish[project] = start + 1 / self.weight(project)
+            self.vtime = start
+        # 完成标签落后于虚拟时间的项目和从未分配过的等价，不必保留
+        self.finish = {p: f for p, f in self.finish.items() if f > self.vtime}
+
+    def take(self, candidates: List[dict], count: int, running_by_project: Dict[str, int] = None) -> List[dict]:
+        """按候选顺序取最多 count 个不超过项目并发上限的任务（远程 agent 拉取用，没有亲和）"""
+        running = dict(running_by_project or {})
+        picked = []
+        for task in candidates:
+            if len(picked) >= count:
+                break
+            if self._allowed(task, running):
+                picked.append(task)
+                running[task["project"]] = running.get(task["project"], 0) + 1
+        return picked
+
+    def assign(self, idle_workers: List[dict], candidates: List[dict],
+               running_by_project: Dict[str, int] = None,
+               busy_paths: Dict[str, Set[str]] = None, limit: int = None) -> List[Tuple[dict, dict]]:
+        """返回 [(worker, task), ...]；candidates 需按 order() 给出的公平顺序排列
+
+        busy_paths: 项目 -> 正在被改动的路径（运行中 / 待合并的任务）
+        limit: 本轮最多分配几个（限流额度）；在更新跳过次数和亲和统计之前生效
+        """
+        workers = list(idle_workers)
+        quota = len(workers) if limit is None else min(len(workers), max(0, limit))
+        running = dict(running_by_project or {})
+        busy = {project: set(paths) for project, paths in (busy_paths or {}).items()}
+        # 已达到项目并发上限、或和正在改动的文件重叠的任务本轮不参与分配
+        remaining = [t for t in candidates if self._allowed(t, running)]
+        deferred = [t for t in remaining if self._overlaps(t, busy)]
+        self.overlap_deferrals += len(deferred)
+        now = time.monotonic()
+        for task in deferred:
+            self.deferred_since.setdefault(task["id"], now)
+        remaining = [t for t in remaining if t not in deferred]
+        pairs: List[Tuple[dict, dict]] = []
+
+        def take(worker: dict, task: dict):
+            workers.remove(worker)
+            pairs.append((worker, task))
+            running[task["project"]] = running.get(task["project"], 0) + 1
+            busy.setdefault(task["project"], set()).update(task.get("paths") or ())
+            remaining[:] = [t for t in remaining
+                            if t is not task and self._allowed(t, running) and not self._overlaps(t, busy)]
+
+        # 1. 被跳过太多次的任务先分配（尽量仍给同项目 worker）
+        for task in [t for t in remaining if self.skips.get(t["id"], 0) >= self.max_skips]:
+            if len(pairs) >= quota:
+                break
+            if task not in remaining:
+                continue
+            warm = [w for w in workers if w.get("project") == task["project"]]
+            take(warm[0] if warm else workers[0], task)
+
+        # 2. 有项目缓存的 worker 优先拿本轮按公平顺序本来就会分出去的同项目任务
+        #    （只调换 worker 和任务的配对，不改变各项目分到的份额）
+        for worker in list(workers):
+            if not remaining or len(pairs) >= quota:
+                break
+            head = remaining[:quota - len(pairs)]
+            match = next((t for t in head if t["project"] == worker.get("project")), None)
+            if match:
+                take(worker, match)
+
+        # 3. 剩下的按公平顺序分配
+        for worker in list(workers):
+            if not remaining or len(pairs) >= quota:
+                break
+            take(worker, remaining[0])
+
+        self._update_skips(candidates, pairs)
+        assigned = {task["id"] for _, task in pairs}
+        waiting = {t["id"] for t in candidates} - assigned
+        self.deferred_since = {i: t for i, t in self.deferred_since.items() if i in waiting}
+        for worker, task in pairs:
+            if worker.get("project") == task["project"]:
+                self.affinity_hits += 1
+            else:
+                self.affinity_misses += 1
+        return pairs
+
+    def _allowed(self, task: dict, running: Dict[str, int]) -> bool:
+        cap = self.caps.get(task["project"])
+        return cap is None or running.get(task["project"], 0) < cap
+
+    def _overlaps(self, task: dict, busy: Dict[str, Set[str]]) -> bool:
+        paths = task.get("paths")
+        if not paths or self.skips.get(task["id"], 0) >= self.max_skips:
+            return False
+        since = self.deferred_since.get(task["id"])
+        if since is not None and time.monotonic() - since >= self.max_defer:
+            return False
+        return not busy.get(task["project"], set()).isdisjoint(paths)
+
+    def _update_skips(self, candidates: List[dict], pairs: List[Tuple[dict, dict]]):
+        """排在某个已分配任务前面却没被分配的任务，跳过次数 +1"""
+        assigned = {task["id"] for _, task in pairs}
+        order = [t["id"] for t in candidates]
+        last = max((order.index(task_id) for task_id in assigned), default=-1)
+        skips = {}
+        for task_id in order[:last]:
+            if task_id not in assigned:
+                skips[task_id] = self.skips.get(task_id, 0) + 1
+        # 只保留仍在候选窗口中的任务，避免计数表无限增长
+        for task_id in order[last + 1:]:
+            if task_id in self.skips:
+                skips[task_id] = self.skips[task_id]
+        self.skips = skips
+
+    def stats(self) -> dict:
+        total = self.affinity_hits + self.affinity_misses
+        return {
+            "affinity_hits": self.affinity_hits,
+            "affinity_misses": self.affinity_misses,
+            "affinity_hit_rate": round(self.affinity_hits / total, 3) if total else 0.0,
+            "overlap_deferrals": self.overlap_deferrals,
+            "deferred": len(self.deferred_since),
+            "weights": self.weights,
+            "caps": self.caps,
+            "virtual_time": round(self.vtime, 3),
+            "finish_tags": {p: round(f, 3) for p, f in self.finish.items()},
+        }
@@ -0,0 +1,200 @@
+"""
+Task Logs - 任务输出日志
+agent 子进程输出边读边写入磁盘上的 per-task 日志文件，内存占用有界，
+完整记录可以按字节区间读取
+文件读写都在专用的 I/O 线程池里做（run_io），不阻塞事件循环；
+子进程输出每次读取时已缓冲的数据（最多 CHUNK_SIZE）合并成一次写入
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+MAX_LINE = 1024 * 1024  # 超长行只落盘不解析
+TAIL_SIZE = 64 * 1024   # stderr / 非 JSON 输出保留的尾部
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("CC_MANAGER_LOG_IO_THREADS", 4)),
+                               thread_name_prefix="log-io")
+
+
+async def run_io(fn: Callable, *args, **kwargs):
+    """在日志 I/O 线程池中执行同步的文件操作"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+class TaskLogStore:
+    def __init__(self, log_dir: str = None):
+        self.log_dir = log_dir or os.getenv("CC_MANAGER_LOG_DIR", "/root/cc-manager/logs")
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._append_lock = threading.Lock()  # append 先取大小再写，同一任务的并发上传不能交错
+
+    def path(self, task_id: int) -> str:
+        return os.path.join(self.log_dir, f"task-{task_id}.log")
+
+    def stderr_path(self, task_id: int) -> str:
+        return os.path.join(self.log_dir, f"task-{task_id}.stderr")
+
+    def read_bytes(self, task_id: int, offset: int = 0, limit: int = CHUNK_SIZE) -> Optional[tuple]:
+        """读取 [offset, offset+limit) 字节区间，返回 (offset, data, size)；日志不存在返回 None
+
+        未读到文件末尾时截到最后一个换行，避免切断 JSON 行 / UTF-8 字符。
+        """
+        path = self.path(task_id)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        offset = max(0, min(offset, size))
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(limit)
+        if offset + len(data) < size:
+            cut = data.rfind(b"\n")
+            if cut >= 0:
+                data = data[:cut + 1]
+        return offset, data, size
+
+    def read(self, task_id: int, offset: int = 0, limit: int = CHUNK_SIZE) -> Optional[dict]:
+        chunk = self.read_bytes(task_id, offset, limit)
+        if chunk is None:
+            return None
+        offset, data, size = chunk
+        return {
+            "task_id": task_id,
+            "offset": offset,
+            "next_offset": offset + len(data),
+            "size": size,
+            "data": data.decode("utf-8", errors="replace"),
+        }
+
+    def size(self, task_id: int) -> int:
+        try:
+            return os.path.getsize(self.path(task_id))
+        except OSError:
+            return 0
+
+    def append(self, task_id: int, offset: int, data: bytes) -> Optional[int]:
+        """在 offset 处追加远程 agent 上传的日志块，重复部分跳过
+
+        返回写入后的文件大小；offset 超过当前大小（中间有缺口）时返回 None。
+        """
+        with self._append_lock:
+            size = self.size(task_id)
+            if offset > size:
+                return None
+            data = data[size - offset:]
+            if data:
+                with open(self.path(task_id), "ab") as f:
+                    f.write(data)
+            return size + len(data)
+
+    def discard(self, task_id: int):
+        """删除任务的 stdout / stderr 日志（不存在时忽略）"""
+        for path in (self.path(task_id), self.stderr_path(task_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class _Tail:
+    """只保留最后 N 字节"""
+
+    def __init__(self, size: int = TAIL_SIZE):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+
+    def append(self, data: bytes):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def text(self) -> str:
+        return b"".join(self.chunks)[-self.size:].decode("utf-8", errors="replace")
+
+
+async def _pump(stream: asyncio.StreamReader, path: str, tail: _Tail,
+                on_line: Optional[Callable[[bytes, int], None]] = None):
+    """按块读取子进程输出并追加到日志文件，完整行连同其文件偏移交给 on_line
+
+    写入在 I/O 线程里完成后才回调 on_line，客户端按偏移回读时数据已经落盘；
+    写入期间新到的输出留在 StreamReader 的缓冲里，下一次 read 一并取走。
+    """
+    pending = b""
+    f = await run_io(open, path, "ab", buffering=0)
+    try:
+        pos = await run_io(f.seek, 0, os.SEEK_END)  # pending 在文件中的起始偏移
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_io(f.write, chunk)
+            tail.append(chunk)
+            if on_line is None:
+                continue
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                on_line(line, pos)
+                pos += len(line) + 1
+            if len(pending) > MAX_LINE:
+                pos += len(pending)
+                pending = b""
+        if on_line is not None and pending:
+            on_line(pending, pos)
+    finally:
+        await run_io(f.close)
+
+
+async def capture_output(proc: asyncio.subprocess.Process, task_id: int, store: TaskLogStore,
+                         on_event: Optional[Callable[[dict], None]] = None,
+                         on_output: Optional[Callable[[int, str], None]] = None) -> dict:
+    """流式读取 claude --output-format stream-json 的输出直到进程退出
+
+    on_event 收到解析后的事件，on_output 收到 (文件偏移, 原始行文本)。
+    返回最终 result 事件的文本（没有则为 stdout 尾部）和 stderr 尾部。
+    """
+    out_tail, err_tail = _Tail(), _Tail()
+    final = {}
+
+    def on_line(line: bytes, offset: int):
+        if on_output and len(line) <= MAX_LINE:
+            on_output(offset, line.decode("utf-8", errors="replace"))
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(event, dict):
+            return
+        if event.get("type") == "result":
+            final.update(event)
+        if on_event:
+            on_event(event)
+
+    await asyncio.gather(
+        _pump(proc.stdout, store.path(task_id), out_tail, on_line),
+        _pump(proc.stderr, store.stderr_path(task_id), err_tail),
+    )
+    await proc.wait()
+
+    result = final.get("result")
+    return {
+        "stdout": result if isinstance(result, str) else out_tail.text(),
+        "stderr": err_tail.text(),
+        "is_error": bool(final.get("is_error")),
+        "subtype": final.get("subtype"),
+        "log_path": store.path(task_id),
+    }
@@ -1,67 +1,806 @@
+import hashlib
 import os
 import sqlite3
-from datetime import datetime
-from typing import List, Optional
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from models import Base, Task
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import case, func, delete, insert, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, defer
+from models import Base, Task, TaskDependency, Worker
+from db import get_engine, run_db
+from failures import retry_delay
+from metrics import REGISTRY
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.strip().encode()).hexdigest()
+
+
+# 远程 agent 的 worker id 从这里开始分配，不和本地 worker slot（1..N）冲突
+AGENT_ID_BASE = 1000
+# running 任务的租约时长（秒），持有者需在到期前续期；过期后重新入队
+LEASE_SECONDS = int(os.getenv("CC_MANAGER_LEASE_SECONDS", 60))
+# 同一任务最多被认领的次数，租约过期且达到上限的任务标记为 failed
+MAX_ATTEMPTS = int(os.getenv("CC_MANAGER_MAX_ATTEMPTS", 3))
+
+TASKS = REGISTRY.gauge("cc_tasks", "Tasks in a non-terminal state", ["status", "project"])
+TASK_WAIT = REGISTRY.histogram("cc_task_wait_seconds", "Time from submission to being claimed", ["attempt"])
+TASK_RESULTS = REGISTRY.counter("cc_task_results_total", "Reported task outcomes", ["status", "failure_class"])
+
 
 class TaskQueue:
-    def __init__(self, db_path: str = "/root/cc-manager/tasks.db"):
-        self.db_path = db_path
-        self.engine = create_engine(f"sqlite:///{db_path}", echo=False)
-        Base.metadata.create_all(self.engine)
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv("CC_MANAGER_DB", "/root/cc-manager/tasks.db")
+        # 同一 db 文件在进程内共用一个 engine，建表和迁移只做一次
+        self.engine = get_engine(self.db_path, setup=self._setup)
         self.Session = sessionmaker(bind=self.engine)
-    
-    def add_task(self, project: str, title: str, prompt: str, mode: str = "execute", priority: int = 0) -> int:
+        self.lease_seconds = LEASE_SECONDS
+        self.max_attempts = MAX_ATTEMPTS
+        REGISTRY.add_collector("tasks", self._collect)
+
+    async def _collect(self):
+        rows = await run_db(self.count_active)
+        TASKS.replace({(status, project): n for status, project, n in rows})
+
+    @classmethod
+    def _setup(cls, engine):
+        Base.metadata.create_all(engine)
+        cls._migrate(engine)
+
+    @staticmethod
+    def _migrate(engine):
+        """补齐旧 tasks.db 缺失的列和索引（create_all 不会修改已存在的表）"""
+        inspector = inspect(engine)
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                    if column.server_default is not None:
+                        ddl += f" DEFAULT {column.server_default.arg}"
+                    conn.execute(text(ddl))
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+
+    @staticmethod
+    def _next_version():
+        """下一个变更版本号（在写事务内求值，多进程下也单调递增）"""
+        return select(func.coalesce(func.max(Task.version), 0) + 1).scalar_subquery()
+
+    @staticmethod
+    def _held_by(worker_id: int, owner: Optional[str]):
+        """任务仍由 (owner, worker_id) 持有；owner 为空表示远程 agent（worker_id 全局唯一）"""
+        return (Task.worker_id == worker_id) & (Task.owner.is_(None) if owner is None else Task.owner == owner)
+
+    @staticmethod
+    def _ready():
+        """可分发条件：排队中且不在退避期"""
+        return (Task.status == "queued") & (Task.not_before.is_(None) | (Task.not_before <= datetime.utcnow()))
+
+    def current_version(self) -> int:
         session = self.Session()
-        task = Task(project=project, title=title, prompt=prompt, mode=mode, priority=priority)
-        session.add(task)
-        session.commit()
-        task_id = task.id
+        version = session.query(func.max(Task.version)).scalar()
         session.close()
-        return task_id
+        return version or 0
     
-    def get_next_task(self) -> Optional[Task]:
-        session = self.Session()
-        # 按优先级 DESC, ID ASC 获取队列中第一个任务
-        task = session.query(Task).filter(
-            Task.status == "queued"
-        ).order_by(Task.priority.desc(), Task.id.asc()).first()
-        
-        if task:
-            task_dict = {
-                "id": task.id,
-                "project": task.project,
-                "title": task.title,
-                "prompt": task.prompt,
-                "mode": task.mode,
+    def submit_task(self, project: str, title: str, prompt: str, mode: str = "execute", priority: int = 0,
+                    no_cache: bool = False, idempotency_key: str = None,
+                    depends_on: List[int] = None) -> Tuple[int, str, bool]:
+        """入队前去重，返回 (task_id, status, created)
+
+        - 幂等键已用过：返回当时创建的任务（无论状态）
+        - 同一 (project, prompt, mode) 已在排队或运行：挂到已有任务上，共享它的结果
+          （带依赖的任务属于某个 DAG，不参与这种去重）
+        """
+        digest = prompt_hash(prompt)
+        session = self.Session()
+        try:
+            existing = None
+            if idempotency_key:
+                existing = session.query(Task.id, Task.status).filter(
+                    Task.idempotency_key == idempotency_key
+                ).first()
+            if existing is None and not depends_on:
+                existing = session.query(Task.id, Task.status).filter(
+                    Task.prompt_hash == digest, Task.project == project, Task.mode == mode,
+                    Task.status.in_(["queued", "running"]),
+                ).order_by(Task.id.asc()).first()
+            if existing is not None:
+                return existing.id, existing.status, False
+            task = self._create(session, {
+                "project": project, "title": title, "prompt": prompt, "mode": mode, "priority": priority,
+                "no_cache": no_cache, "idempotency_key": idempotency_key,
+            }, depends_on or [])
+            try:
+                session.commit()
+            except IntegrityError:
+                # 另一个进程刚用同一个幂等键插入
+                session.rollback()
+                existing = session.query(Task.id, Task.status).filter(
+                    Task.idempotency_key == idempotency_key
+                ).one()
+                return existing.id, existing.status, False
+            return task.id, task.status, True
+        finally:
+            session.close()
+
+    # ===== 任务依赖（DAG） =====
+    @staticmethod
+    def _initial_state(deps: List[Tuple[int, str]]) -> dict:
+        """由依赖 [(id 或 DAG 节点 key, status)] 决定初始状态：全部完成 queued，有未完成的 blocked，有失败的 failed"""
+        dead = [(d, st) for d, st in deps if st in ("failed", "cancelled")]
+        pending = sum(1 for _, st in deps if st != "done")
+        if dead:
+            # 同一 DAG 内的依赖此时还没有 id，用节点 key 表示
+            dep, status = dead[0]
+            label = f"#{dep}" if isinstance(dep, int) else repr(dep)
+            return {"status": "failed", "pending_deps": pending, "failure_class": "dependency",
+                    "result": f"Dependency {label} {status}", "finished_at": datetime.utcnow()}
+        return {"status": "blocked" if pending else "queued", "pending_deps": pending}
+
+    def _dep_statuses(self, session, depends_on: List[int]) -> Dict[int, str]:
+        deps = dict(session.query(Task.id, Task.status).filter(Task.id.in_(depends_on)).all()) if depends_on else {}
+        missing = [d for d in depends_on if d not in deps]
+        if missing:
+            raise ValueError(f"Unknown dependencies: {missing}")
+        return deps
+
+    def _create(self, session, fields: dict, depends_on: List[int]) -> Task:
+        """插入单个任务及其依赖边"""
+        depends_on = sorted(set(depends_on))
+        deps = self._dep_statuses(session, depends_on)
+        task = Task(**fields, **self._initial_state([(d, deps[d]) for d in depends_on]),
+                    prompt_hash=prompt_hash(fields["prompt"]), version=self._next_version())
+        session.add(task)
+        session.flush()
+        session.add_all(TaskDependency(task_id=task.id, depends_on=d) for d in depends_on)
+        return task
+
+    def add_dag(self, nodes: List[dict]) -> Dict[str, int]:
+        """一次提交一组有依赖关系的任务，返回 {节点 key: task_id}
+
+        depends_on 中的字符串引用同一批节点的 key，整数引用已存在的任务 id。
+        """
+        by_key = {}
+        for node in nodes:
+            if node["key"] in by_key:
+                raise ValueError(f"Duplicate node key: {node['key']}")
+            by_key[node["key"]] = node
+        # Kahn 拓扑排序：父节点先插入，才能拿到 id
+        indegree = {key: 0 for key in by_key}
+        children: Dict[str, List[str]] = {key: [] for key in by_key}
+        for key, node in by_key.items():
+            for dep in node.get("depends_on", []):
+                if isinstance(dep, str):
+                    if dep not in by_key:
+                        raise ValueError(f"Node {key} depends on unknown key: {dep}")
+                    indegree[key] += 1
+                    children[dep].append(key)
+        order = [key for key, n in indegree.items() if n == 0]
+        for key in order:
+            for child in children[key]:
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    order.append(child)
+        if len(order) < len(by_key):
+            raise ValueError("Dependency cycle among: " + ", ".join(k for k, n in indegree.items() if n > 0))
+
+        session = self.Session()
+        try:
+            external = self._dep_statuses(session, sorted({
+                d for node in nodes for d in node.get("depends_on", []) if not isinstance(d, str)
+            }))
+            # 按拓扑序推算每个节点的初始状态，整批一条 INSERT
+            states: Dict[str, str] = {}
+            rows = []
+            for key in order:
+                node = by_key[key]
+                deps = {d: external[d] for d in node.get("depends_on", []) if not isinstance(d, str)}
+                deps.update({d: states[d] for d in node.get("depends_on", []) if isinstance(d, str)})
+                state = self._initial_state(list(deps.items()))
+                states[key] = state["status"]
+                rows.append({
+                    "project": node["project"],
+                    "title": node["title"],
+                    "prompt": node["prompt"],
+                    "mode": node.get("mode", "execute"),
+                    "priority": node.get("priority", 0),
+                    "no_cache": node.get("no_cache", False),
+                    "prompt_hash": prompt_hash(node["prompt"]),
+                    "created_at": datetime.utcnow(),
+                    "result": None,
+                    "failure_class": None,
+                    "finished_at": None,
+                    **state,
+                })
+            result = session.execute(
+                insert(Task).values(version=self._next_version()).returning(Task.id, sort_by_parameter_order=True),
+                rows,
+            )
+            ids = dict(zip(order, (row.id for row in result)))
+            edges = {
+                (ids[key], ids[d] if isinstance(d, str) else d)
+                for key in order for d in by_key[key].get("depends_on", [])
             }
+            if edges:
+                session.execute(insert(TaskDependency), [{"task_id": t, "depends_on": d} for t, d in edges])
+            session.commit()
+            return ids
+        finally:
             session.close()
-            return task_dict
-        
+
+    def _settle(self, session, task_id: int, status: str) -> Dict[str, List[int]]:
+        """任务进入终态后处理依赖它的任务：done 时依赖计数减一并释放归零的，失败 / 取消时整个下游子树失败"""
+        dependents = select(TaskDependency.task_id).where(TaskDependency.depends_on == task_id)
+        if status == "done":
+            rows = session.execute(
+                update(Task)
+                .where(Task.id.in_(dependents), Task.status == "blocked")
+                .values(pending_deps=Task.pending_deps - 1,
+                        status=case((Task.pending_deps <= 1, "queued"), else_="blocked"),
+                        version=self._next_version())
+                .returning(Task.id, Task.status)
+            ).all()
+            return {"released": sorted(r.id for r in rows if r.status == "queued"), "cascaded": []}
+        cascaded, frontier = [], [task_id]
+        while frontier:
+            frontier = session.execute(
+                update(Task)
+                .where(Task.id.in_(select(TaskDependency.task_id).where(TaskDependency.depends_on.in_(frontier))),
+                       Task.status == "blocked")
+                .values(status="failed", failure_class="dependency", result=f"Dependency #{task_id} {status}",
+                        finished_at=datetime.utcnow(), version=self._next_version())
+                .returning(Task.id)
+            ).scalars().all()
+            cascaded += frontier
+        return {"released": [], "cascaded": sorted(cascaded)}
+
+    def get_dependencies(self, task_id: int) -> Dict[str, List[int]]:
+        session = self.Session()
+        depends_on = session.query(TaskDependency.depends_on).filter(TaskDependency.task_id == task_id).all()
+        dependents = session.query(TaskDependency.task_id).filter(TaskDependency.depends_on == task_id).all()
         session.close()
-        return None
+        return {"depends_on": sorted(r[0] for r in depends_on), "dependents": sorted(r[0] for r in dependents)}
+
+    def add_tasks(self, tasks: List[dict]) -> List[int]:
+        """批量入队：一个事务、一条多行 INSERT，返回按输入顺序排列的 id
+
+        带 idempotency_key 的任务按幂等键去重：键已用过（或同一批里重复）的返回已有任务的 id，不再插入。
+        """
+        if not tasks:
+            return []
+        try:
+            return self._add_tasks(tasks)
+        except IntegrityError:
+            # 另一个进程刚用同一个幂等键插入，重新查一遍
+            return self._add_tasks(tasks)
+
+    def _add_tasks(self, tasks: List[dict]) -> List[int]:
+        keys = {t["idempotency_key"] for t in tasks if t.get("idempotency_key")}
+        session = self.Session()
+        try:
+            existing = dict(session.query(Task.idempotency_key, Task.id).filter(
+                Task.idempotency_key.in_(keys)).all()) if keys else {}
+            fresh, seen = [], set(existing)
+            for t in tasks:
+                key = t.get("idempotency_key")
+                if key and key in seen:
+                    continue
+                if key:
+                    seen.add(key)
+                fresh.append(t)
+            new_ids = self._insert_tasks(session, fresh)
+            session.commit()
+        finally:
+            session.close()
+        inserted = list(zip(fresh, new_ids))
+        by_key = {**existing, **{t["idempotency_key"]: i for t, i in inserted if t.get("idempotency_key")}}
+        unkeyed = iter(i for t, i in inserted if not t.get("idempotency_key"))
+        return [by_key[t["idempotency_key"]] if t.get("idempotency_key") else next(unkeyed) for t in tasks]
+
+    def _insert_tasks(self, session, tasks: List[dict]) -> List[int]:
+        if not tasks:
+            return []
+        rows = [
+            {
+                "project": t["project"],
+                "title": t["title"],
+                "prompt": t["prompt"],
+                "mode": t.get("mode", "execute"),
+                "priority": t.get("priority", 0),
+                "no_cache": t.get("no_cache", False),
+                "prompt_hash": prompt_hash(t["prompt"]),
+                "idempotency_key": t.get("idempotency_key"),
+                "status": "queued",
+                "created_at": datetime.utcnow(),
+            }
+            for t in tasks
+        ]
+        result = session.execute(
+            insert(Task).values(version=self._next_version()).returning(Task.id, sort_by_parameter_order=True),
+            rows,
+        )
+        return [row.id for row in result]
     
-    def update_task_status(self, task_id: int, status: str, result: str = None, worker_id: int = None):
-        session = self.Session()
-        task = session.query(Task).filter(Task.id == task_id).first()
-        if task:
-            task.status = status
-            if result:
-                task.result = result
-            if worker_id:
-                task.worker_id = worker_id
-            if status in ["done", "failed"]:
-                task.finished_at = datetime.utcnow()
+    def claim_assignments(self, assignments: Dict[int, int], owner: str = None) -> List[dict]:
+        """按调度器给出的 {task_id: worker_id} 原子认领；已被其他分发进程抢走的任务会被跳过
+
+        owner 是本地 worker 所属分发进程的标识，远程 agent 认领时为空。
+        """
+        if not assignments:
+            return []
+        return self._claim(list(assignments), lambda rows: ((r, assignments[r.id]) for r in rows), owner)
+
+    def _claim(self, task_ids, pair, owner: str = None) -> List[dict]:
+        session = self.Session()
+        try:
+            rows = session.execute(
+                update(Task)
+                .where(Task.id.in_(task_ids), self._ready())
+                .values(status="running", version=self._next_version(), attempts=Task.attempts + 1,
+                        lease_expires_at=self._lease_deadline(), owner=owner)
+                .returning(Task.id, Task.project, Task.title, Task.prompt, Task.mode, Task.priority, Task.no_cache,
+                           Task.created_at, Task.attempts)
+            ).all()
+            now = datetime.utcnow()
+            for r in rows:
+                TASK_WAIT.observe((now - r.created_at).total_seconds(), attempt="first" if r.attempts == 1 else "retry")
+            rows.sort(key=lambda r: (-(r.priority or 0), r.id))
+            claimed = [
+                {
+                    "id": r.id,
+                    "project": r.project,
+                    "title": r.title,
+                    "prompt": r.prompt,
+                    "mode": r.mode,
+                    "no_cache": bool(r.no_cache),
+                    "worker_id": worker_id,
+                }
+                for r, worker_id in pair(rows)
+            ]
+            if claimed:
+                session.execute(update(Task), [{"id": t["id"], "worker_id": t["worker_id"]} for t in claimed])
+            session.commit()
+            return claimed
+        finally:
+            session.close()
+
+    def _lease_deadline(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def holds_lease(self, task_id: int, worker_id: int, owner: str = None) -> bool:
+        """任务是否仍由该 worker 运行中"""
+        session = self.Session()
+        try:
+            return session.query(Task.id).filter(
+                Task.id == task_id, self._held_by(worker_id, owner), Task.status == "running"
+            ).first() is not None
+        finally:
+            session.close()
+
+    def renew_leases(self, task_ids: Optional[List[int]] = None, worker_id: int = None, owner: str = None) -> int:
+        """续期 running 任务的租约：指定 task_ids，或 worker_id 持有的全部任务（两者可同时限定）
+
+        owner 限定只续期该分发进程持有的任务。
+        """
+        if task_ids is None and worker_id is None or task_ids == []:
+            return 0
+        query = update(Task).where(Task.status == "running")
+        if owner is not None:
+            query = query.where(Task.owner == owner)
+        if task_ids is not None:
+            query = query.where(Task.id.in_(task_ids))
+        if worker_id is not None:
+            query = query.where(Task.worker_id == worker_id)
+        session = self.Session()
+        try:
+            renewed = session.execute(query.values(lease_expires_at=self._lease_deadline())).rowcount
+            session.commit()
+            return renewed
+        finally:
+            session.close()
+
+    def requeue_expired(self) -> Dict[str, List[int]]:
+        """租约过期的 running 任务：未达重试上限的重新入队，否则标记 failed
+
+        lease_expires_at 为空的 running 任务来自加租约之前的版本，同样视为过期。
+        """
+        now = datetime.utcnow()
+        expired = (Task.status == "running") & (Task.lease_expires_at.is_(None) | (Task.lease_expires_at < now))
+        session = self.Session()
+        try:
+            requeued = session.execute(
+                update(Task)
+                # 退避重试也会增加 attempts，这里只统计租约过期的次数
+                .where(expired, func.coalesce(Task.attempts, 0) - func.coalesce(Task.retries, 0) < self.max_attempts)
+                .values(status="queued", worker_id=None, owner=None, lease_expires_at=None,
+                        version=self._next_version())
+                .returning(Task.id)
+            ).scalars().all()
+            failed = session.execute(
+                update(Task)
+                .where(expired)
+                .values(status="failed", lease_expires_at=None, finished_at=now, version=self._next_version(),
+                        result=f"Lease expired after {self.max_attempts} attempts")
+                .returning(Task.id)
+            ).scalars().all()
+            cascaded = []
+            for task_id in failed:
+                cascaded += self._settle(session, task_id, "failed")["cascaded"]
             session.commit()
+            return {"requeued": sorted(requeued), "failed": sorted(failed), "cascaded": sorted(cascaded)}
+        finally:
+            session.close()
+
+    def reap_dispatchers(self, timeout: float) -> List[int]:
+        """心跳超时的分发进程（包括没有 owner 的旧版本 slot 行）：删除其 worker 行，
+        持有的任务租约立即过期（随后由 requeue_expired 回收），返回这些任务的 id
+
+        其他仍在心跳的分发进程的任务不受影响。
+        """
+        now = datetime.utcnow()
+        session = self.Session()
+        try:
+            dead = session.execute(
+                delete(Worker)
+                .where(Worker.kind == "dispatcher", Worker.last_heartbeat < now - timedelta(seconds=timeout))
+                .returning(Worker.owner)
+            ).scalars().all()
+            legacy = session.execute(
+                delete(Worker)
+                .where(Worker.kind == "local", Worker.owner.is_(None), Worker.current_task_id.isnot(None))
+                .returning(Worker.id, Worker.current_task_id)
+            ).all()
+            expired = []
+            if dead:
+                session.query(Worker).filter(Worker.kind == "local", Worker.owner.in_(dead)).delete(
+                    synchronize_session=False)
+                expired += session.execute(
+                    update(Task)
+                    .where(Task.owner.in_(dead), Task.status == "running")
+                    .values(lease_expires_at=now)
+                    .returning(Task.id)
+                ).scalars().all()
+            for worker_id, task_id in legacy:
+                expired += session.execute(
+                    update(Task)
+                    .where(Task.id == task_id, self._held_by(worker_id, None), Task.status == "running")
+                    .values(lease_expires_at=now)
+                    .returning(Task.id)
+                ).scalars().all()
+            session.query(Worker).filter(Worker.kind == "local", Worker.owner.is_(None)).delete(
+                synchronize_session=False)
+            session.commit()
+            return expired
+        finally:
+            session.close()
+
+    def sync_workers(self, owner: str, workers: List[dict]):
+        """把本分发进程的本地 worker 内存状态写入 workers 表，并刷新进程心跳
+
+        slot 行按 (owner, slot) 定位，已缩容移除的 slot 一并删除，不碰其他进程的行。
+        """
+        now = datetime.utcnow()
+        session = self.Session()
+        try:
+            dispatcher = session.query(Worker).filter(Worker.kind == "dispatcher", Worker.owner == owner).first()
+            if dispatcher is None:
+                session.add(Worker(kind="dispatcher", name=owner, owner=owner, status="running", last_heartbeat=now))
+            else:
+                dispatcher.last_heartbeat = now
+            rows = {r.slot: r for r in session.query(Worker).filter(Worker.kind == "local", Worker.owner == owner)}
+            for w in workers:
+                row = rows.pop(w["id"], None)
+                if row is None:
+                    row = Worker(kind="local", owner=owner, slot=w["id"])
+                    session.add(row)
+                row.status, row.current_task_id = w["status"], w["current_task_id"]
+                row.worktree_path, row.project, row.last_heartbeat = w["worktree_path"], w["project"], now
+            for row in rows.values():
+                session.delete(row)
+            session.commit()
+        finally:
+            session.close()
+
+    def queue_changes(self, since: Optional[int] = None) -> Tuple[int, List[dict]]:
+        """调度索引（queue_index.py）的同步数据
+
+        since 为 None 时返回全部排队 / 运行中的任务，否则返回版本号大于 since 的任务（含已结束的，
+        供索引移除）。返回 (同步到的版本号, [{"id", "project", "priority", "status", "created_at", "not_before"}])。
+        """
+        columns = (Task.id, Task.project, Task.priority, Task.status, Task.created_at, Task.not_before, Task.version)
+        session = self.Session()
+        if since is None:
+            # 先取版本号再取数据：期间新提交的行会在下一次增量同步中重复应用，结果不变
+            version = session.query(func.max(Task.version)).scalar() or 0
+            rows = session.query(*columns).filter(Task.status.in_(["queued", "running"])).all()
+        else:
+            rows = session.query(*columns).filter(Task.version > since).order_by(Task.version.asc()).all()
+            version = rows[-1].version if rows else since
         session.close()
-    
+        return version, [r._asdict() for r in rows]
+
+    def cancel_task(self, task_id: int) -> Optional[dict]:
+        """取消未结束的任务（条件更新，不覆盖已写入的终态）
+
+        返回 {"status": 取消前的状态, "worker_id", "released", "cascaded"}；任务不存在或已结束返回 None。
+        运行中的任务之后由执行者的 finish_task / fail_task 写入时会因状态不符被丢弃。
+        """
+        session = self.Session()
+        try:
+            row = session.query(Task.status, Task.worker_id).filter(Task.id == task_id).first()
+            if not row or row.status not in ("blocked", "queued", "running"):
+                return None
+            updated = session.execute(
+                update(Task)
+                .where(Task.id == task_id, Task.status == row.status)
+                .values(status="cancelled", finished_at=datetime.utcnow(), lease_expires_at=None,
+                        version=self._next_version())
+            ).rowcount
+            if not updated:
+                session.rollback()
+                return None
+            effects = self._settle(session, task_id, "cancelled")
+            session.commit()
+            return {"status": row.status, "worker_id": row.worker_id, **effects}
+        finally:
+            session.close()
+
+    GIT_FIELDS = {"commit_sha", "branch_name", "push_status", "push_error", "merge_status", "merge_error"}
+
+    def update_git(self, task_id: int, fields: dict, worker_id: int = None) -> bool:
+        """记录 git 流水线的提交 / 推送结果；指定 worker_id 时只更新由它执行的任务"""
+        values = {k: v for k, v in fields.items() if k in self.GIT_FIELDS}
+        if not values:
+            return False
+        session = self.Session()
+        try:
+            stmt = update(Task).where(Task.id == task_id)
+            if worker_id is not None:
+                stmt = stmt.where(Task.worker_id == worker_id)
+            updated = session.execute(stmt.values(version=self._next_version(), **values)).rowcount
+            session.commit()
+            return bool(updated)
+        finally:
+            session.close()
+
+    def list_merge_pending(self) -> List[dict]:
+        """合并队列中尚未落地的任务（进程重启后恢复队列用）"""
+        session = self.Session()
+        rows = session.query(Task.id, Task.project, Task.title, Task.branch_name, Task.commit_sha).filter(
+            Task.merge_status == "queued"
+        ).order_by(Task.finished_at.asc()).all()
+        session.close()
+        return [r._asdict() for r in rows]
+
+    def get_prompts(self, task_ids: List[int]) -> Dict[int, str]:
+        session = self.Session()
+        rows = session.query(Task.id, Task.prompt).filter(Task.id.in_(task_ids)).all()
+        session.close()
+        return dict(rows)
+
+    def get_task(self, task_id: int) -> Optional[Task]:
+        """按主键获取单个任务"""
+        session = self.Session()
+        task = session.get(Task, task_id)
+        session.close()
+        return task
+
     def list_tasks(self, status: str = None, limit: int = 50) -> List[Task]:
         session = self.Session()
-        query = session.query(Task)
+        # 列表不需要大字段，避免每行加载完整 prompt/result
+        query = session.query(Task).options(defer(Task.prompt), defer(Task.result), defer(Task.plan_text))
         if status:
             query = query.filter(Task.status == status)
         tasks = query.order_by(Task.created_at.desc()).limit(limit).all()
         session.close()
         return tasks
+
+    def usage_by_project(self, hours: float = 24) -> List[dict]:
+        """最近 hours 小时内结束的任务按项目汇总资源用量，用于容量规划"""
+        since = datetime.utcnow() - timedelta(hours=hours)
+        session = self.Session()
+        rows = session.query(
+            Task.project, func.count(Task.id),
+            func.avg(Task.cpu_seconds), func.max(Task.cpu_seconds),
+            func.avg(Task.peak_rss_mb), func.max(Task.peak_rss_mb),
+            func.avg(Task.wall_seconds), func.max(Task.wall_seconds),
+        ).filter(
+            Task.finished_at >= since, Task.wall_seconds.isnot(None)
+        ).group_by(Task.project).all()
+        session.close()
+        keys = ("project", "tasks", "cpu_seconds_avg", "cpu_seconds_max", "peak_rss_mb_avg", "peak_rss_mb_max",
+                "wall_seconds_avg", "wall_seconds_max")
+        return [{k: round(v, 2) if isinstance(v, float) else v for k, v in zip(keys, r)} for r in rows]
+
+    def count_active(self) -> List[Tuple[str, str, int]]:
+        """未结束任务按 (status, project) 计数"""
+        session = self.Session()
+        rows = session.query(Task.status, Task.project, func.count(Task.id)).filter(
+            Task.status.in_(["blocked", "queued", "running"])
+        ).group_by(Task.status, Task.project).all()
+        session.close()
+        return [tuple(r) for r in rows]
+
+    def count_tasks(self, status: str) -> int:
+        session = self.Session()
+        count = session.query(func.count(Task.id)).filter(Task.status == status).scalar()
+        session.close()
+        return count
+
+    def list_tasks_since(self, version: int, limit: int = 500) -> List[Task]:
+        """返回版本号大于 version 的任务（按版本升序），用于增量刷新
+
+        版本号由写事务里的 max(version)+1 子查询给出：批量 INSERT（add_tasks）逐行求值，每行一个版本；
+        批量 UPDATE（认领多个任务、回收过期租约、批量取消等）只求值一次，多行共享同一个版本。
+        截断时把最后一个版本的剩余行也一起返回，调用方可以放心把游标推进到最后一行的版本
+        （此时返回的行数可能超过 limit）。
+        """
+        session = self.Session()
+        query = session.query(Task).options(defer(Task.prompt), defer(Task.result), defer(Task.plan_text))
+        tasks = query.filter(Task.version > version).order_by(Task.version.asc(), Task.id.asc()).limit(limit).all()
+        if len(tasks) == limit:
+            last = tasks[-1]
+            tasks += query.filter(Task.version == last.version, Task.id > last.id).order_by(Task.id.asc()).all()
+        session.close()
+        return tasks
+
+    # ===== 远程 worker agent =====
+    def register_agent(self, name: str) -> int:
+        session = self.Session()
+        try:
+            max_id = session.query(func.max(Worker.id)).scalar() or 0
+            agent = Worker(id=max(AGENT_ID_BASE, max_id + 1), kind="agent", name=name,
+                           status="idle", last_heartbeat=datetime.utcnow())
+            session.add(agent)
+            session.commit()
+            return agent.id
+        finally:
+            session.close()
+
+    def heartbeat_agent(self, agent_id: int, running_task_ids: Optional[List[int]] = None) -> bool:
+        """刷新心跳并续期任务租约（running_task_ids 为 None 时续期该 agent 的全部任务）
+
+        agent 不存在或已被判定死亡时返回 False。
+        """
+        session = self.Session()
+        try:
+            agent = session.get(Worker, agent_id)
+            if not agent or agent.kind != "agent" or agent.status == "dead":
+                return False
+            agent.last_heartbeat = datetime.utcnow()
+            if running_task_ids is not None:
+                agent.status = "running" if running_task_ids else "idle"
+                agent.current_task_id = running_task_ids[0] if running_task_ids else None
+            session.commit()
+        finally:
+            session.close()
+        self.renew_leases(running_task_ids, worker_id=agent_id)
+        return True
+
+    def orphaned_tasks(self, agent_id: int, task_ids: List[int]) -> List[int]:
+        """agent 上报仍在运行、但已不再由它持有（被取消 / 回收）的任务，agent 应停止执行"""
+        if not task_ids:
+            return []
+        session = self.Session()
+        held = {r[0] for r in session.query(Task.id).filter(
+            Task.id.in_(task_ids), Task.status == "running", Task.worker_id == agent_id
+        )}
+        session.close()
+        return [t for t in task_ids if t not in held]
+
+    def list_agents(self) -> List[dict]:
+        session = self.Session()
+        agents = session.query(Worker).filter(Worker.kind == "agent", Worker.status != "dead").all()
+        session.close()
+        return [
+            {
+                "id": a.id,
+                "name": a.name,
+                "status": a.status,
+                "current_task_id": a.current_task_id,
+                "last_heartbeat": a.last_heartbeat.isoformat() if a.last_heartbeat else None,
+            }
+            for a in agents
+        ]
+
+    def reap_agents(self, timeout: float) -> List[int]:
+        """心跳超时的 agent 标记为 dead，并让其运行中任务的租约立即过期，返回这些 agent 的 id
+
+        任务随后由 requeue_expired 按重试上限统一处理。
+        """
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            dead = session.execute(
+                update(Worker)
+                .where(Worker.kind == "agent", Worker.status != "dead",
+                       Worker.last_heartbeat < now - timedelta(seconds=timeout))
+                .values(status="dead", current_task_id=None)
+                .returning(Worker.id)
+            ).scalars().all()
+            if dead:
+                session.execute(
+                    update(Task)
+                    .where(Task.worker_id.in_(dead), Task.status == "running")
+                    .values(lease_expires_at=now)
+                )
+            session.commit()
+            return dead
+        finally:
+            session.close()
+
+    USAGE_FIELDS = {"cpu_seconds", "peak_rss_mb", "wall_seconds"}
+
+    def _usage_values(self, usage: Optional[dict]) -> dict:
+        return {k: v for k, v in (usage or {}).items() if k in self.USAGE_FIELDS and v is not None}
+
+    def finish_task(self, task_id: int, worker_id: int, status: str, result: str = None,
+                    failure_class: str = None, plan_text: str = None,
+                    usage: dict = None, owner: str = None) -> Optional[Dict[str, List[int]]]:
+        """只有任务仍由该 worker 运行时才写入结果（防止被回收后的旧 agent 覆盖）
+
+        本地 worker 需带上所属分发进程 owner，slot 编号在多个分发进程之间会重复。
+        usage 是本次运行的资源用量 {"cpu_seconds", "peak_rss_mb", "wall_seconds"}。
+        写入成功返回依赖处理结果 {"released", "cascaded"}，否则返回 None。
+        """
+        values = {"plan_text": plan_text} if plan_text is not None else {}
+        values.update(self._usage_values(usage))
+        session = self.Session()
+        try:
+            updated = session.execute(
+                update(Task)
+                .where(Task.id == task_id, self._held_by(worker_id, owner), Task.status == "running")
+                .values(status=status, result=result, finished_at=datetime.utcnow(), lease_expires_at=None,
+                        failure_class=failure_class, version=self._next_version(), **values)
+            ).rowcount
+            if not updated:
+                return None
+            effects = self._settle(session, task_id, status)
+            session.commit()
+            TASK_RESULTS.inc(status=status, failure_class=failure_class or "")
+            return effects
+        finally:
+            session.close()
+
+    def fail_task(self, task_id: int, worker_id: int, error: str, failure_class: str,
+                  usage: dict = None, owner: str = None) -> Optional[dict]:
+        """记录失败：暂时性故障按退避重新入队，否则标记 failed
+
+        返回 {"status", "retries", "delay", "released", "cascaded"}；任务已不属于该 worker 时返回 None。
+        """
+        session = self.Session()
+        try:
+            task = session.query(Task.retries).filter(
+                Task.id == task_id, self._held_by(worker_id, owner), Task.status == "running"
+            ).first()
+            if task is None:
+                return None
+            retries = task.retries or 0
+            delay = retry_delay(failure_class, retries)
+            values = {"result": error, "failure_class": failure_class, "lease_expires_at": None,
+                      "version": self._next_version(), **self._usage_values(usage)}
+            if delay is None:
+                values.update(status="failed", finished_at=datetime.utcnow())
+            else:
+                retries += 1
+                values.update(status="queued", worker_id=None, owner=None, retries=retries,
+                              not_before=datetime.utcnow() + timedelta(seconds=delay))
+            updated = session.execute(
+                update(Task)
+                .where(Task.id == task_id, self._held_by(worker_id, owner), Task.status == "running")
+                .values(**values)
+            ).rowcount
+            if not updated:
+                return None
+            effects = {"released": [], "cascaded": []}
+            if values["status"] == "failed":
+                effects = self._settle(session, task_id, "failed")
+            session.commit()
+            TASK_RESULTS.inc(status="retry" if delay is not None else "failed", failure_class=failure_class)
+            return {"status": values["status"], "retries": retries, "delay": delay, **effects}
+        finally:
+            session.close()
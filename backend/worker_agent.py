@@ -0,0 +1,259 @@
+"""
+Worker Agent - 远程 worker 进程
+向中心 CC Manager 注册并定时心跳，通过 HTTP 租约拉取任务，在本机运行 Claude Code，
+把输出按字节偏移回传到 manager 的任务日志，结束后上报结果。
+心跳中断超过 lease_timeout 时 manager 会把该 agent 的任务重新入队。
+
+用法: python worker_agent.py --manager http://host:8080 [--name box2] [--slots 2]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Dict, Optional
+
+sys.path.insert(0, os.path.dirname(__file__))
+from git_pipeline import GitPipeline
+from runner import Runner
+from task_logs import TaskLogStore, run_io
+from worker_manager import WorkerManager
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [Agent] %(message)s",
+    datefmt="%H:%M:%S"
+)
+log = logging.getLogger(__name__)
+
+SHIP_INTERVAL = 1.0       # 日志上传间隔（秒）
+SHIP_CHUNK = 256 * 1024   # 单次上传上限
+
+
+class ManagerError(Exception):
+    def __init__(self, status: int, detail):
+        super().__init__(f"HTTP {status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+class ManagerClient:
+    """基于 urllib 的最小 HTTP 客户端，请求放到线程里执行"""
+
+    def __init__(self, base_url: str, timeout: float = 30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    async def post(self, path: str, payload: dict = None, data: bytes = None, **params) -> dict:
+        return await asyncio.to_thread(self._post, path, payload, data, params)
+
+    def _post(self, path: str, payload: Optional[dict], data: Optional[bytes], params: dict) -> dict:
+        url = self.base_url + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        if data is None:
+            data = json.dumps(payload or {}).encode()
+            content_type = "application/json"
+        else:
+            content_type = "application/octet-stream"
+        req = urllib.request.Request(url, data=data, method="POST", headers={"Content-Type": content_type})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.loads(resp.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            try:
+                detail = json.loads(e.read()).get("detail")
+            except Exception:
+                detail = e.reason
+            raise ManagerError(e.code, detail)
+
+
+class WorkerAgent:
+    def __init__(self, manager_url: str, name: str, slots: int = 2):
+        self.client = ManagerClient(manager_url)
+        self.name = name
+        self.wm = WorkerManager(num_workers=slots)
+        self.logs = TaskLogStore(os.path.join(tempfile.gettempdir(), f"cc-agent-{os.getpid()}"))
+        self.agent_id: Optional[int] = None
+        self.heartbeat_interval = 10
+        self.poll_interval = 2
+        self.running: Dict[int, asyncio.Task] = {}  # task_id -> 执行协程
+        self._sent: Dict[int, int] = {}             # task_id -> 已上传的本地日志字节数
+        self.git = GitPipeline(on_update=self._on_git_update)
+        # 默认以 agent 进程自身的用户运行；以 root 运行时可用 CC_AGENT_USER 降权
+        self.runner = Runner(self.logs, run_as=os.getenv("CC_AGENT_USER"))
+
+    async def run(self):
+        await self._register()
+        asyncio.create_task(self._heartbeat_loop())
+        asyncio.create_task(self.git.run())
+        while True:
+            idle = self.wm.get_idle_workers()
+            tasks = []
+            if idle:
+                try:
+                    resp = await self.client.post(f"/api/agents/{self.agent_id}/lease",
+                                                  {"max_tasks": len(idle)})
+                    tasks = resp["tasks"]
+                except ManagerError as e:
+                    if e.status == 404:
+                        await self._reset()
+                    else:
+                        log.error(f"Lease failed: {e}")
+                except Exception as e:
+                    log.error(f"Lease failed: {e}")
+            for worker, task in zip(idle, tasks):
+                self.wm.set_worker_running(worker["id"], task["id"], task["project"])
+                self.running[task["id"]] = asyncio.create_task(self._run_task(worker, task))
+            if not tasks:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _register(self):
+        while True:
+            try:
+                resp = await self.client.post("/api/agents/register", {"name": self.name})
+                self.agent_id = resp["agent_id"]
+                self.heartbeat_interval = resp.get("heartbeat_interval", self.heartbeat_interval)
+                log.info(f"Registered as agent #{self.agent_id} ({self.name})")
+                return
+            except Exception as e:
+                log.error(f"Register failed, retrying: {e}")
+                await asyncio.sleep(5)
+
+    async def _reset(self):
+        """manager 已判定本 agent 死亡（任务已被重新入队）：放弃手上的任务并重新注册"""
+        log.warning("Lease lost, abandoning running tasks and re-registering")
+        for task in list(self.running.values()):
+            task.cancel()
+        await self._register()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                resp = await self.client.post(f"/api/agents/{self.agent_id}/heartbeat",
+                                              {"running": list(self.running)})
+                for task_id in resp.get("cancel", []):
+                    if task_id in self.running:
+                        log.info(f"Task #{task_id} cancelled by manager, stopping")
+                        asyncio.create_task(self.runner.cancel(task_id))
+            except ManagerError as e:
+                if e.status == 404:
+                    await self._reset()
+                else:
+                    log.error(f"Heartbeat failed: {e}")
+            except Exception as e:
+                log.error(f"Heartbeat failed: {e}")
+
+    async def _run_task(self, worker: dict, task: dict):
+        worker_id, task_id = worker["id"], task["id"]
+        agent_id = self.agent_id
+        report = {"success": False, "result": "", "stderr": ""}
+        shipper = asyncio.create_task(self._ship_log(task_id, agent_id, task.get("log_offset", 0)))
+        try:
+            log.info(f"Slot #{worker_id} starting task #{task_id}: {task['title']}")
+            worktree_path = await self.wm.get_worktree(worker_id, task["project"], task_id)
+            result = await self._execute_cc(task, worktree_path)
+            report = {
+                "success": result["success"],
+                "result": result.get("stdout", ""),
+                "stderr": result.get("stderr", ""),
+                "error": result.get("error"),
+                "is_error": result.get("is_error", False),
+                "subtype": result.get("subtype"),
+                "returncode": result.get("returncode"),
+                "usage": result.get("usage"),
+            }
+            if result.get("cancelled"):
+                report = None
+            elif result["success"]:
+                self.git.submit(task, self.wm.hand_off_worktree(worktree_path), self.wm.release_path)
+        except asyncio.CancelledError:
+            shipper.cancel()
+            raise
+        except Exception as e:
+            log.error(f"Slot #{worker_id} exception: {e}")
+            report = {"success": False, "result": "", "error": str(e)}
+        finally:
+            self.running.pop(task_id, None)
+            self.runner.forget(task_id)
+            self.wm.release_worktree(worker_id)
+            self.wm.set_worker_idle(worker_id)
+
+        shipper.cancel()
+        await self._flush_log(task_id, agent_id, task.get("log_offset", 0), final=True)
+        if report is None:
+            # 任务已在 manager 侧取消，不再上报结果
+            log.info(f"Task #{task_id} stopped after cancellation")
+        else:
+            await self._report(task_id, agent_id, report)
+
+    async def _report(self, task_id: int, agent_id: int, report: dict):
+        for attempt in range(5):
+            try:
+                await self.client.post(f"/api/tasks/{task_id}/result", report, agent_id=agent_id)
+                log.info(f"Task #{task_id} reported ({'ok' if report['success'] else 'failed'})")
+                return
+            except ManagerError as e:
+                log.error(f"Task #{task_id} result rejected: {e}")
+                return
+            except Exception as e:
+                log.error(f"Task #{task_id} report failed: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _ship_log(self, task_id: int, agent_id: int, base_offset: int):
+        while True:
+            await asyncio.sleep(SHIP_INTERVAL)
+            await self._flush_log(task_id, agent_id, base_offset)
+
+    async def _flush_log(self, task_id: int, agent_id: int, base_offset: int, final: bool = False):
+        """把本地日志中尚未上传的完整行发给 manager（失败时下次从同一位置重发）"""
+        sent = self._sent.get(task_id, 0)
+        while True:
+            chunk = await run_io(self.logs.read_bytes, task_id, sent, SHIP_CHUNK)
+            if chunk is None:
+                return
+            _, data, size = chunk
+            if not final and not data.endswith(b"\n"):
+                data = data[:data.rfind(b"\n") + 1]
+            if not data:
+                return
+            try:
+                await self.client.post(f"/api/tasks/{task_id}/log", data=data,
+                                       agent_id=agent_id, offset=base_offset + sent)
+            except Exception as e:
+                log.warning(f"Log upload for task #{task_id} failed: {e}")
+                return
+            sent += len(data)
+            self._sent[task_id] = sent
+            if sent >= size:
+                if final:
+                    self._sent.pop(task_id, None)
+                return
+
+    async def _execute_cc(self, task: dict, worktree_path: str) -> dict:
+        # 本地日志每次从头写，上传时再加上 manager 侧的起始偏移
+        await run_io(self.logs.discard, task["id"])
+        return await self.runner.run(task, worktree_path)
+
+    async def _on_git_update(self, task_id: int, fields: dict):
+        await self.client.post(f"/api/tasks/{task_id}/git", fields, agent_id=self.agent_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manager", default=os.getenv("CC_MANAGER_URL", "http://127.0.0.1:8080"))
+    parser.add_argument("--name", default=socket.gethostname())
+    parser.add_argument("--slots", type=int, default=int(os.getenv("WORKERS", 2)))
+    args = parser.parse_args()
+    asyncio.run(WorkerAgent(args.manager, args.name, args.slots).run())
+
+
+if __name__ == "__main__":
+    main()
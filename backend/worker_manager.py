@@ -1,91 +1,202 @@
 """
 Worker Manager - Worker 生命周期管理
-管理 2 个 worker slot + Git worktree 绑定
+管理 worker slot + Git worktree 绑定（配置过的项目从预热的 worktree 池取用）
 """
 import asyncio
 import logging
 import os
+import time
 from typing import List, Optional, Dict
 
+from metrics import REGISTRY
+from worktree_pool import WorktreePool
+
 log = logging.getLogger(__name__)
 
+WORKERS = REGISTRY.gauge("cc_workers", "Local worker slots by state", ["state"])
+WORKERS_TARGET = REGISTRY.gauge("cc_workers_target", "Target number of local worker slots")
+WORKER_BUSY = REGISTRY.counter("cc_worker_busy_seconds_total",
+                               "Accumulated time local worker slots spent running tasks")
+WORKTREES_HELD = REGISTRY.gauge("cc_worktrees_held", "Worktrees handed to the git pipeline and not yet committed")
+
 
 class WorkerManager:
-    def __init__(self, num_workers: int = 2):
+    def __init__(self, num_workers: int = 2, min_workers: int = None, max_workers: int = None):
         self.num_workers = num_workers
-        self.workspace_root = "/home/ccuser/workspaces"
+        self.min_workers = min_workers if min_workers is not None else num_workers
+        self.max_workers = max(max_workers or num_workers, num_workers)
+        self.workspace_root = os.getenv("CC_MANAGER_WORKSPACES", "/home/ccuser/workspaces")
+        self.pool = WorktreePool(self.workspace_root, default_pool_size=num_workers)
         
         # Worker 状态表（内存）
         self.workers: Dict[int, dict] = {}
+        self.version = 0  # 状态变更计数，用于 /api/workers 的 ETag
+        # 交给 git 流水线、尚未提交完的 worktree：path -> 提交完成事件
+        self._held: Dict[str, asyncio.Event] = {}
+        self._busy_since: Dict[int, float] = {}  # worker_id -> 上次计入 busy 时间的时刻
+        REGISTRY.add_collector("workers", self._collect)
         for i in range(1, num_workers + 1):
-            self.workers[i] = {
-                "id": i,
-                "status": "idle",
-                "current_task_id": None,
-                "worktree_path": None,
-                "project": None,
-            }
+            self._add_worker(i)
         
         log.info(f"WorkerManager initialized with {num_workers} workers")
 
+    def _add_worker(self, worker_id: int):
+        self.workers[worker_id] = {
+            "id": worker_id,
+            "status": "idle",
+            "current_task_id": None,
+            "worktree_path": None,
+            "project": None,
+            "draining": False,  # 缩容中：当前任务跑完后移除
+        }
+        self.version += 1
+
+    def resize(self, num_workers: int) -> int:
+        """调整 worker 数量（限制在 [min_workers, max_workers]）
+
+        扩容直接加 slot；缩容先移除空闲 worker，运行中（含分发中）的标记 draining，跑完再移除。
+        """
+        target = max(self.min_workers, min(self.max_workers, num_workers))
+        active = sorted(w["id"] for w in self.workers.values() if not w["draining"])
+        if target > len(active):
+            # 先撤销还没移除的 draining，再补新 slot
+            for worker in sorted(self.workers.values(), key=lambda w: w["id"]):
+                if worker["draining"] and len(active) < target:
+                    worker["draining"] = False
+                    active.append(worker["id"])
+            next_id = 1
+            while len(active) < target:
+                while next_id in self.workers:
+                    next_id += 1
+                self._add_worker(next_id)
+                active.append(next_id)
+        elif target < len(active):
+            surplus = len(active) - target
+            # 空闲的优先移除，id 大的优先
+            for worker_id in sorted(active, key=lambda i: (self.workers[i]["status"] == "idle", i), reverse=True)[:surplus]:
+                if self.workers[worker_id]["status"] == "idle":
+                    del self.workers[worker_id]
+                else:
+                    self.workers[worker_id]["draining"] = True
+        if target != self.num_workers:
+            log.info(f"Worker pool resized {self.num_workers} -> {target}")
+        self.num_workers = target
+        self.version += 1
+        return target
+
     def get_idle_workers(self) -> List[dict]:
         """返回所有空闲 worker"""
-        return [w for w in self.workers.values() if w["status"] == "idle"]
+        return [w for w in self.workers.values() if w["status"] == "idle" and not w["draining"]]
 
-    def set_worker_running(self, worker_id: int, task_id: int):
+    def reserve_idle(self) -> List[dict]:
+        """分发开始时占住全部空闲 worker（状态 dispatching），分发期间的 await 里 resize 不会删掉它们；
+        分发结束后用 unreserve 归还没分到任务的
+        """
+        idle = self.get_idle_workers()
+        for w in idle:
+            w["status"] = "dispatching"
+        if idle:
+            self.version += 1
+        return idle
+
+    def unreserve(self, worker_ids: List[int]):
+        """归还仍处于 dispatching 的 worker；分发期间被缩容标记的直接移除"""
+        for worker_id in worker_ids:
+            worker = self.workers.get(worker_id)
+            if worker is None or worker["status"] != "dispatching":
+                continue
+            if worker["draining"]:
+                del self.workers[worker_id]
+            else:
+                worker["status"] = "idle"
+            self.version += 1
+
+    def set_worker_running(self, worker_id: int, task_id: int, project: str = None):
         """标记 worker 为运行中"""
         if worker_id in self.workers:
             self.workers[worker_id]["status"] = "running"
             self.workers[worker_id]["current_task_id"] = task_id
+            self._busy_since.setdefault(worker_id, time.monotonic())
+            if project:
+                self.workers[worker_id]["project"] = project
+            self.version += 1
 
     def set_worker_idle(self, worker_id: int):
-        """释放 worker，恢复空闲"""
+        """释放 worker，恢复空闲；缩容中的 worker 直接移除"""
+        self._account_busy(worker_id, time.monotonic(), stop=True)
         if worker_id in self.workers:
+            if self.workers[worker_id]["draining"]:
+                del self.workers[worker_id]
+                self.version += 1
+                return
             self.workers[worker_id]["status"] = "idle"
             self.workers[worker_id]["current_task_id"] = None
+            self.version += 1
+
+    def _account_busy(self, worker_id: int, now: float, stop: bool = False):
+        since = self._busy_since.pop(worker_id, None) if stop else self._busy_since.get(worker_id)
+        if since is not None:
+            WORKER_BUSY.inc(now - since)
+            if not stop:
+                self._busy_since[worker_id] = now
+
+    def _collect(self):
+        # 运行中的 slot 也把已经过去的时间计入，rate(cc_worker_busy_seconds_total) 才是实时利用率
+        now = time.monotonic()
+        for worker_id in list(self._busy_since):
+            self._account_busy(worker_id, now)
+        states = {"idle": 0, "running": 0, "draining": 0}
+        for w in self.workers.values():
+            state = "draining" if w["draining"] else w["status"]
+            states[state] = states.get(state, 0) + 1
+        WORKERS.replace({(state,): n for state, n in states.items()})
+        WORKERS_TARGET.set(self.num_workers)
+        WORKTREES_HELD.set(len(self._held))
 
     def get_all_workers(self) -> List[dict]:
         """返回所有 worker 状态"""
         return list(self.workers.values())
 
-    async def get_worktree(self, worker_id: int, project: str) -> str:
-        """获取或创建 worker 对应的 worktree"""
-        # 非 Git 项目或无项目配置时，使用临时工作目录
-        work_dir = f"/home/ccuser/workspaces/worker-{worker_id}"
-        os.makedirs(work_dir, exist_ok=True)
+    def count_busy(self) -> int:
+        return sum(1 for w in self.workers.values() if w["status"] != "idle")
+
+    async def get_worktree(self, worker_id: int, project: str, task_id: int = None) -> str:
+        """获取 worker 对应的 worktree：优先从项目 worktree 池取，未配置的项目用临时工作目录"""
+        work_dir = await self.pool.checkout(project, task_id) if task_id else None
+        if work_dir is None:
+            work_dir = f"{self.workspace_root}/worker-{worker_id}"
+            os.makedirs(work_dir, exist_ok=True)
+            # 临时目录按 worker 复用，上一个任务的改动提交完之前不能动它
+            held = self._held.get(work_dir)
+            if held:
+                await held.wait()
         
         self.workers[worker_id]["worktree_path"] = work_dir
         self.workers[worker_id]["project"] = project
+        self.version += 1
         
         return work_dir
 
+    def release_worktree(self, worker_id: int):
+        """任务结束后归还 worktree，回收在后台进行（已交给 git 流水线的由流水线归还）"""
+        worker = self.workers.get(worker_id)
+        path = worker and worker["worktree_path"]
+        if path and path not in self._held and self.pool.owns(path):
+            self.pool.release(path)
+
+    def hand_off_worktree(self, path: str) -> str:
+        """把 worktree 交给 git 流水线，提交完成后由 release_path 归还"""
+        self._held[path] = asyncio.Event()
+        return path
+
+    def release_path(self, path: str):
+        event = self._held.pop(path, None)
+        if event:
+            event.set()
+        if self.pool.owns(path):
+            self.pool.release(path)
+
     async def setup_project_worktrees(self, project: str, repo_url: str, branch: str = "main"):
         """为项目初始化 worktree 池"""
-        project_dir = f"{self.workspace_root}/{project}"
-        main_dir = f"{project_dir}/main"
-        
-        os.makedirs(project_dir, exist_ok=True)
-        
-        # 克隆主仓库（如果不存在）
-        if not os.path.exists(f"{main_dir}/.git"):
-            proc = await asyncio.create_subprocess_shell(
-                f"git clone {repo_url} {main_dir}",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await proc.communicate()
-            log.info(f"Cloned {repo_url} to {main_dir}")
-        
-        # 为每个 worker 创建 worktree
-        for i in range(1, self.num_workers + 1):
-            worker_dir = f"{project_dir}/worker-{i}"
-            if not os.path.exists(worker_dir):
-                proc = await asyncio.create_subprocess_shell(
-                    f"cd {main_dir} && git worktree add {worker_dir} -b worker-{i}-branch",
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                await proc.communicate()
-                log.info(f"Created worktree for worker {i}: {worker_dir}")
-        
-        log.info(f"Project '{project}' worktrees ready")
+        self.pool.add_project(project, repo_url, branch, pool_size=self.num_workers)
+        await self.pool.prepare(project)
@@ -0,0 +1,259 @@
+"""
+Worktree Pool - 按项目预热的 Git worktree 池
+每个项目只 clone 一次到 {root}/{project}/main，并预先建好 N 个 detached worktree
+（pool-1..N，指向最新的 origin/<branch>）。worker 取用时只需本地切一个任务分支，
+用完后在后台 reset / clean / 切回最新基线，不占下一次分发的关键路径。
+
+git 操作由 manager（root）执行，agent 以 CC_WORKTREE_OWNER 用户在 worktree 里跑 git：
+主 clone 整体交给该用户并设为 core.sharedRepository=group（目录带 setgid），
+root 之后写入的对象 / ref 也归该用户组可写；worktree 和它在 .git/worktrees 下的 gitdir 归该用户，
+否则 agent 的 git 会报 dubious ownership。
+
+项目配置来自 CC_MANAGER_PROJECTS 指向的 JSON 文件：
+  {"deepcell": {"repo": "git@github.com:org/deepcell.git", "branch": "main", "pool_size": 2}}
+可选 "merge_queue": true / "merge_check": "<命令>" 开启任务分支自动合入，见 merge_queue.py；
+"weight"（公平分享权重，默认 1）/ "max_concurrency"（同时运行上限）见 scheduler.py。
+未配置的项目返回 None，由调用方退回到普通工作目录。
+"""
+import asyncio
+import json
+import logging
+import os
+import pwd
+import time
+from typing import Dict, Optional, Set
+
+log = logging.getLogger(__name__)
+
+FETCH_INTERVAL = 60  # 同一项目两次 git fetch 的最小间隔（秒）
+# manager 自己创建的提交（任务提交、合并提交）使用的身份，不依赖主机上的 git 配置
+GIT_IDENTITY = ("-c", f"user.name={os.getenv('CC_MANAGER_GIT_NAME', 'CC Manager')}",
+                "-c", f"user.email={os.getenv('CC_MANAGER_GIT_EMAIL', 'cc-manager@localhost')}")
+
+
+async def _git(*args: str, cwd: str = None) -> tuple:
+    """执行 git 命令，返回 (returncode, stdout, stderr)"""
+    proc = await asyncio.create_subprocess_exec(
+        # manager 以 root 运行、worktree 归 ccuser 所有，需要跳过 safe.directory 检查
+        "git", "-c", "safe.directory=*", *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    return proc.returncode, out.decode(errors="replace").strip(), err.decode(errors="replace").strip()
+
+
+async def _run(*args: str):
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.DEVNULL)
+    await proc.wait()
+
+
+async def clean_head(path: str) -> Optional[str]:
+    """工作区干净时返回 HEAD commit，否则（有改动 / 不是 git 仓库）返回 None"""
+    rc, head, _ = await _git("rev-parse", "HEAD", cwd=path)
+    if rc != 0:
+        return None
+    rc, dirty, _ = await _git("status", "--porcelain", cwd=path)
+    return head if rc == 0 and not dirty else None
+
+
+def load_projects(path: str = None) -> Dict[str, dict]:
+    path = path or os.getenv("CC_MANAGER_PROJECTS", "/root/cc-manager/projects.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.error(f"Failed to load projects from {path}: {e}")
+        return {}
+
+
+class _Project:
+    def __init__(self, name: str, root: str, repo: str, branch: str, pool_size: int):
+        self.name = name
+        self.repo = repo
+        self.branch = branch
+        self.pool_size = pool_size
+        self.dir = os.path.join(root, name)
+        self.main_dir = os.path.join(self.dir, "main")
+        self.available: asyncio.Queue = asyncio.Queue()
+        self.all: Set[str] = set()
+        self.reserved: Set[str] = set()  # 正在临时创建、还没加入 all 的 worktree 路径
+        self.lock = asyncio.Lock()
+        self.ready = False
+        self.last_fetch = 0.0
+
+
+class WorktreePool:
+    def __init__(self, workspace_root: str, default_pool_size: int = 2,
+                 projects: Dict[str, dict] = None, owner: str = None):
+        self.workspace_root = workspace_root
+        self.owner = owner or os.getenv("CC_WORKTREE_OWNER", "ccuser")
+        self.projects: Dict[str, _Project] = {}
+        self._background: Set[asyncio.Task] = set()
+        for name, cfg in (load_projects() if projects is None else projects).items():
+            self.add_project(name, cfg["repo"], cfg.get("branch", "main"),
+                             cfg.get("pool_size", default_pool_size))
+
+    def add_project(self, name: str, repo: str, branch: str = "main", pool_size: int = 2):
+        if name not in self.projects:
+            self.projects[name] = _Project(name, self.workspace_root, repo, branch, pool_size)
+
+    def has_project(self, name: str) -> bool:
+        return name in self.projects
+
+    async def prepare_all(self):
+        for name in list(self.projects):
+            try:
+                await self.prepare(name)
+            except Exception as e:
+                log.error(f"Worktree pool for '{name}' failed: {e}")
+
+    async def prepare(self, name: str):
+        """clone 主仓库并补齐 pool_size 个 worktree（幂等）"""
+        project = self.projects[name]
+        async with project.lock:
+            if project.ready:
+                return
+            os.makedirs(project.dir, exist_ok=True)
+            if not os.path.exists(os.path.join(project.main_dir, ".git")):
+                rc, _, err = await _git("clone", "-q", "-b", project.branch, project.repo, project.main_dir)
+                if rc != 0:
+                    raise RuntimeError(f"git clone {project.repo} failed: {err}")
+                log.info(f"Cloned {project.repo} to {project.main_dir}")
+            await _git("worktree", "prune", cwd=project.main_dir)
+            await self._fetch(project, force=True)
+            for i in range(1, project.pool_size + 1):
+                path = os.path.join(project.dir, f"pool-{i}")
+                if path in project.all:
+                    continue
+                await self._add_worktree(project, path)
+            await self._share(project)
+            project.ready = True
+            log.info(f"Project '{name}' worktree pool ready ({project.pool_size} worktrees)")
+
+    async def checkout(self, name: str, task_id: int) -> Optional[str]:
+        """取一个预热好的 worktree 并切到 task-{task_id} 分支；未配置的项目返回 None"""
+        project = self.projects.get(name)
+        if project is None:
+            return None
+        if not project.ready:
+            await self.prepare(name)
+        try:
+            path = project.available.get_nowait()
+        except asyncio.QueueEmpty:
+            # 池子暂时用完（还在后台回收），临时多建一个；名字在 await 之前占住，并发的 checkout 不会撞名
+            path = self._reserve(project)
+            try:
+                await self._add_worktree(project, path, enqueue=False)
+            finally:
+                project.reserved.discard(path)
+        rc, _, err = await _git("checkout", "-q", "-B", f"task-{task_id}", cwd=path)
+        if rc != 0:
+            log.error(f"Checkout task-{task_id} in {path} failed: {err}")
+        return path
+
+    def release(self, path: str):
+        """归还 worktree，在后台回收后重新放回池子"""
+        for project in self.projects.values():
+            if path in project.all:
+                task = asyncio.create_task(self._recycle(project, path))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+                return
+
+    def owns(self, path: str) -> bool:
+        return any(path in project.all for project in self.projects.values())
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            name: {"ready": p.ready, "total": len(p.all), "available": p.available.qsize()}
+            for name, p in self.projects.items()
+        }
+
+    def _reserve(self, project: _Project) -> str:
+        i = 1
+        while True:
+            path = os.path.join(project.dir, f"pool-{i}")
+            if path not in project.all and path not in project.reserved:
+                project.reserved.add(path)
+                return path
+            i += 1
+
+    async def _add_worktree(self, project: _Project, path: str, enqueue: bool = True):
+        if not os.path.exists(os.path.join(path, ".git")):
+            rc, _, err = await _git("worktree", "add", "-q", "--detach", path, f"origin/{project.branch}",
+                                    cwd=project.main_dir)
+            if rc != 0:
+                raise RuntimeError(f"git worktree add {path} failed: {err}")
+            await self.chown_worktree(path)
+            log.info(f"Created worktree {path}")
+        else:
+            await self._reset(project, path)
+        project.all.add(path)
+        if enqueue:
+            project.available.put_nowait(path)
+
+    async def _recycle(self, project: _Project, path: str):
+        try:
+            await self._fetch(project)
+            await self._reset(project, path)
+            project.available.put_nowait(path)
+        except Exception as e:
+            log.error(f"Recycle worktree {path} failed: {e}")
+
+    async def _reset(self, project: _Project, path: str):
+        """丢弃残留改动，回到最新基线（detached）"""
+        await _git("reset", "-q", "--hard", cwd=path)
+        await _git("clean", "-q", "-fdx", cwd=path)
+        rc, _, err = await _git("checkout", "-q", "--detach", f"origin/{project.branch}", cwd=path)
+        if rc != 0:
+            raise RuntimeError(f"reset {path} failed: {err}")
+        await self.chown_worktree(path)
+
+    async def _fetch(self, project: _Project, force: bool = False):
+        if not force and time.monotonic() - project.last_fetch < FETCH_INTERVAL:
+            return
+        rc, _, err = await _git("fetch", "-q", "origin", project.branch, cwd=project.main_dir)
+        if rc != 0:
+            log.warning(f"git fetch for '{project.name}' failed: {err}")
+        project.last_fetch = time.monotonic()
+
+    def _owner_ids(self) -> Optional[str]:
+        """manager 以 root 运行且 worktree 用户存在时返回 "uid:gid"，否则不需要改属主"""
+        if os.geteuid() != 0:
+            return None
+        try:
+            entry = pwd.getpwnam(self.owner)
+        except KeyError:
+            return None
+        return f"{entry.pw_uid}:{entry.pw_gid}"
+
+    async def _share(self, project: _Project):
+        """主 clone（含 objects / refs / worktrees）整体交给 worktree 用户，幂等"""
+        ids = self._owner_ids()
+        if ids is None:
+            return
+        git_dir = os.path.join(project.main_dir, ".git")
+        await _git("config", "core.sharedRepository", "group", cwd=project.main_dir)
+        await _run("chown", "-R", ids, project.dir)
+        # setgid 目录：root 之后新建的对象目录 / ref 文件继承该用户组，配合 sharedRepository 组可写
+        await _run("find", git_dir, "-type", "d", "-exec", "chmod", "g+rwxs", "{}", "+")
+
+    async def chown_worktree(self, path: str):
+        """worktree 目录和它在主 clone 里的 gitdir 交给 worktree 用户（manager 以 root 运行时）"""
+        ids = self._owner_ids()
+        if ids is None:
+            return
+        targets = [path]
+        try:
+            with open(os.path.join(path, ".git")) as f:
+                gitdir = f.read().strip().partition("gitdir: ")[2]
+            if gitdir:
+                targets.append(gitdir)
+        except OSError:
+            pass
+        await _run("chown", "-R", ids, *targets)
@@ -1,4 +1,4 @@
-const { createApp, ref, reactive, onMounted, computed } = Vue;
+const { createApp, ref, reactive, onMounted, computed, watch } = Vue;
 
 createApp({
   template: `
@@ -48,7 +48,7 @@ createApp({
         <h2 style="color: white; margin-bottom: 8px;">Tasks</h2>
         <div style="display: flex; gap: 8px; margin-bottom: 12px; flex-wrap: wrap;">
           <button 
-            v-for="s in ['all', 'queued', 'running', 'done', 'failed']" 
+            v-for="s in ['all', 'blocked', 'queued', 'running', 'done', 'failed']" 
             :key="s"
             @click="filterStatus = s"
             :style="filterStatus === s ? 'background: white; color: #4F8CFF;' : 'background: rgba(255,255,255,0.2); color: white;'"
@@ -59,12 +59,16 @@ createApp({
         </div>
         
         <div class="task-list" v-if="filteredTasks.length > 0">
-          <div class="task-item" v-for="task in filteredTasks" :key="task.id">
+          <div class="task-item" v-for="task in filteredTasks" :key="task.id" @click="openLog(task)">
             <div class="task-info">
               <div class="task-title">{{ task.title }}</div>
               <div class="task-meta">
                 {{ task.project }} · ID: {{ task.id }} · {{ formatTime(task.created_at) }}
                 <span v-if="task.worker_id"> · Worker #{{ task.worker_id }}</span>
+                <span v-if="task.retries"> · 重试 {{ task.retries }} 次</span>
+                <span v-if="task.failure_class"> · {{ task.failure_class }}</span>
+                <span v-if="task.push_status" :title="task.commit_sha"> · {{ task.branch_name }} {{ task.push_status }}</span>
+                <span v-if="task.merge_status"> · merge {{ task.merge_status }}</span>
               </div>
             </div>
             <div class="task-status" :class="'status-' + task.status">
@@ -75,6 +79,15 @@ createApp({
         <div v-else style="background: white; padding: 20px; border-radius: 12px; text-align: center; color: #999;">
           无任务
         </div>
+
+        <!-- 实时日志 -->
+        <div class="log-panel" v-if="logTask">
+          <div class="log-header">
+            <span>#{{ logTask.id }} {{ logTask.title }}</span>
+            <button @click="closeLog">✕</button>
+          </div>
+          <pre class="log-body">{{ logLines.join('\\n') }}</pre>
+        </div>
       </div>
     </div>
   `,
@@ -90,20 +103,34 @@ createApp({
     const workers = ref([]);
     const filterStatus = ref('all');
     const submitting = ref(false);
+    const logTask = ref(null);
+    const logLines = ref([]);
+    let logOffset = 0;
+    let logFetching = false;
+    let logRefetch = false;
+    let ws = null;
+    let reloadTimer = null;
+    let tasksVersion = null;
     
     const filteredTasks = computed(() => {
       if (filterStatus.value === 'all') return tasks.value;
       return tasks.value.filter(t => t.status === filterStatus.value);
     });
     
+    // 同一份草稿重试提交时复用幂等键，服务端不会重复建任务
+    let submitKey = null;
+    const newKey = () => Date.now().toString(36) + Math.random().toString(36).slice(2);
+    watch(() => [newTask.project, newTask.prompt, newTask.mode], () => { submitKey = null; });
+
     const submitTask = async () => {
       if (!newTask.prompt.trim()) return;
       
       submitting.value = true;
+      submitKey = submitKey || newKey();
       try {
         const res = await fetch('/api/tasks', {
           method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
+          headers: { 'Content-Type': 'application/json', 'Idempotency-Key': submitKey },
           body: JSON.stringify({
             project: newTask.project,
             title: newTask.prompt.substring(0, 60),
@@ -114,7 +141,8 @@ createApp({
         
         if (res.ok) {
           newTask.prompt = '';
-          await Promise.all([loadTasks(), loadWorkers()]);
+          submitKey = null;
+          await loadTasks();
         }
       } catch (e) {
         console.error('Error:', e);
@@ -123,12 +151,34 @@ createApp({
       }
     };
     
+    // 首次全量加载，之后按 since=<version> 只拉变化过的任务
     const loadTasks = async () => {
       try {
-        const res = await fetch('/api/tasks?limit=30');
-        if (res.ok) tasks.value = await res.json();
+        if (tasksVersion === null) {
+          const res = await fetch('/api/tasks?limit=30');
+          if (!res.ok) return;
+          tasks.value = await res.json();
+          tasksVersion = Number(res.headers.get('X-Queue-Version')) || 0;
+          return;
+        }
+        let more = true;
+        while (more) {
+          const res = await fetch(`/api/tasks?since=${tasksVersion}&limit=100`);
+          if (!res.ok) return;
+          const delta = await res.json();
+          mergeTasks(delta.tasks);
+          tasksVersion = delta.version;
+          more = delta.more;
+        }
       } catch (e) {}
     };
+
+    const mergeTasks = (changed) => {
+      if (!changed.length) return;
+      const byId = new Map(tasks.value.map(t => [t.id, t]));
+      for (const t of changed) byId.set(t.id, Object.assign(byId.get(t.id) || {}, t));
+      tasks.value = [...byId.values()].sort((a, b) => b.id - a.id).slice(0, 30);
+    };
     
     const loadWorkers = async () => {
       try {
@@ -137,6 +187,129 @@ createApp({
       } catch (e) {}
     };
     
+    // 状态推送只带部分字段，遇到未知任务时合并成一次列表刷新
+    const scheduleReload = () => {
+      if (reloadTimer) return;
+      reloadTimer = setTimeout(() => {
+        reloadTimer = null;
+        loadTasks();
+      }, 500);
+    };
+
+    const applyStatus = (msg) => {
+      const task = tasks.value.find(t => t.id === msg.task_id);
+      if (!task) return scheduleReload();
+      const { type, task_id, ...fields } = msg;
+      Object.assign(task, fields);
+      if (logTask.value && logTask.value.id === task_id) Object.assign(logTask.value, fields);
+    };
+
+    // stream-json 事件转成可读文本
+    const formatEvent = (line) => {
+      let ev;
+      try { ev = JSON.parse(line); } catch (e) { return line.trim() || null; }
+      if (ev.type === 'assistant' && ev.message && Array.isArray(ev.message.content)) {
+        const parts = ev.message.content.map(c => {
+          if (c.type === 'text') return c.text;
+          if (c.type === 'tool_use') return '🔧 ' + c.name;
+          return null;
+        }).filter(Boolean);
+        return parts.length ? parts.join('\n') : null;
+      }
+      if (ev.type === 'result') return (ev.is_error ? '❌ ' : '✅ ') + (ev.result || '');
+      return null;
+    };
+
+    const appendLog = (data) => {
+      for (const line of data.split('\n')) {
+        const text = formatEvent(line);
+        if (text) logLines.value.push(text);
+      }
+    };
+
+    // 从 logOffset 开始按字节区间补齐日志
+    const fetchLog = async () => {
+      if (!logTask.value) return;
+      if (logFetching) {
+        logRefetch = true;
+        return;
+      }
+      logFetching = true;
+      logRefetch = false;
+      const taskId = logTask.value.id;
+      try {
+        while (logTask.value && logTask.value.id === taskId) {
+          const res = await fetch(`/api/tasks/${taskId}/log?offset=${logOffset}`);
+          if (!res.ok) break;
+          const chunk = await res.json();
+          if (!logTask.value || logTask.value.id !== taskId) break;
+          appendLog(chunk.data);
+          logOffset = chunk.next_offset;
+          if (chunk.next_offset >= chunk.size) break;
+        }
+      } catch (e) {
+      } finally {
+        logFetching = false;
+      }
+      if (logRefetch) fetchLog();
+    };
+
+    const applyLog = (msg) => {
+      if (!logTask.value || logTask.value.id !== msg.task_id) return;
+      if (msg.offset < logOffset) return;
+      if (msg.offset > logOffset || logFetching) return fetchLog();
+      appendLog(msg.data);
+      logOffset = msg.offset + new TextEncoder().encode(msg.data).length + 1;
+    };
+
+    const send = (msg) => {
+      if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify(msg));
+    };
+
+    const openLog = (task) => {
+      if (logTask.value) send({ action: 'unsubscribe', task_id: logTask.value.id });
+      logTask.value = { ...task };
+      logLines.value = [];
+      logOffset = 0;
+      send({ action: 'subscribe', task_id: task.id });
+      fetchLog();
+    };
+
+    const closeLog = () => {
+      if (logTask.value) send({ action: 'unsubscribe', task_id: logTask.value.id });
+      logTask.value = null;
+      logLines.value = [];
+    };
+
+    // WebSocket 推送替代定时轮询，断线后重连并全量刷新一次
+    const connect = () => {
+      const proto = location.protocol === 'https:' ? 'wss:' : 'ws:';
+      ws = new WebSocket(`${proto}//${location.host}/ws/logs`);
+      ws.onopen = () => {
+        loadTasks();
+        loadWorkers();
+        if (logTask.value) {
+          send({ action: 'subscribe', task_id: logTask.value.id });
+          fetchLog();
+        }
+      };
+      ws.onmessage = (event) => {
+        let msg;
+        try { msg = JSON.parse(event.data); } catch (e) { return; }
+        if (msg.type === 'status') applyStatus(msg);
+        else if (msg.type === 'batch') scheduleReload();
+        else if (msg.type === 'resync') {
+          // 服务端丢了状态消息（可能也包括 dropped 通知），任务列表和正在看的日志都重新拉
+          scheduleReload();
+          if (logTask.value) fetchLog();
+        }
+        else if (msg.type === 'workers') workers.value = msg.workers;
+        else if (msg.type === 'log') applyLog(msg);
+        else if (msg.type === 'dropped' && logTask.value && logTask.value.id === msg.task_id) fetchLog();
+      };
+      ws.onclose = () => setTimeout(connect, 3000);
+    };
+
     const formatTime = (iso) => {
       return new Date(iso).toLocaleString('zh-CN', { 
         month: '2-digit', 
@@ -149,12 +322,7 @@ createApp({
     onMounted(() => {
       loadTasks();
       loadWorkers();
-      
-      // 每 2 秒刷新
-      setInterval(() => {
-        loadTasks();
-        loadWorkers();
-      }, 2000);
+      connect();
       
       if ('serviceWorker' in navigator) {
         navigator.serviceWorker.register('/sw.js').catch(() => {});
@@ -170,7 +338,11 @@ createApp({
       submitting,
       submitTask,
       loadTasks,
-      formatTime
+      formatTime,
+      logTask,
+      logLines,
+      openLog,
+      closeLog
     };
   }
 }).mount('#app');
@@ -0,0 +1,45 @@
+"""
+批量入队基准测试：N 次单条 add_tasks 对比一次 add_tasks
+
+用法: python scripts/bench_batch_insert.py [--tasks 10000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from task_queue import TaskQueue
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=10000)
+    args = parser.parse_args()
+
+    tasks = [
+        {"project": f"proj-{i % 8}", "title": f"refactor module {i}", "prompt": "x" * 500, "priority": i % 3}
+        for i in range(args.tasks)
+    ]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        tq = TaskQueue(db_path=os.path.join(workdir, "single.db"))
+        t0 = time.perf_counter()
+        for t in tasks:
+            tq.add_tasks([t])
+        single = time.perf_counter() - t0
+
+        tq = TaskQueue(db_path=os.path.join(workdir, "batch.db"))
+        t0 = time.perf_counter()
+        ids = tq.add_tasks(tasks)
+        batch = time.perf_counter() - t0
+        assert len(ids) == args.tasks
+
+    print(f"single: {args.tasks} x add_tasks([t]) {single:7.2f}s  ({args.tasks / single:8.0f} tasks/s)")
+    print(f" batch: 1 x add_tasks({args.tasks}) {batch:7.2f}s  ({args.tasks / batch:8.0f} tasks/s)")
+    print(f"speedup: {single / batch:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+API 读写并发压测
+
+子进程：运行 CC Manager API（uvicorn）+ 模拟分发循环的写入协程 + 事件循环卡顿监测
+父进程：200 个并发客户端持续请求 /api/tasks 和 /api/tasks/{id}
+
+对比：
+  - executor : DB 调用经 run_db() / run_db_write() 放到线程池（当前实现）
+  - inline   : DB 调用直接在事件循环里执行（旧行为）
+写入延迟分两项：端到端（含写完后等事件循环调度回分发协程的时间）和 db（到写线程里执行完为止，
+反映写入是否被读请求挤占）。
+
+用法: python scripts/bench_db_load.py [--readers 200] [--seconds 10] [--seed 20000]
+"""
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../backend")
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def serve(mode: str, workdir: str, port: int, seconds: float, seed: int, results):
+    os.environ["CC_MANAGER_DB"] = os.path.join(workdir, f"{mode}.db")
+    os.environ["CC_MANAGER_LOG_DIR"] = workdir
+    sys.path.insert(0, BACKEND)
+    import logging
+    logging.disable(logging.INFO)
+    import uvicorn
+    import main
+    import ralph_loop
+    from sqlalchemy import insert
+    from models import Task
+
+    with main.tq.engine.begin() as conn:
+        conn.execute(insert(Task), [
+            {"project": "bench", "title": f"t{i}", "prompt": "x" * 500, "status": "done", "version": 0}
+            for i in range(seed)
+        ])
+
+    if mode == "inline":
+        async def run_inline(fn, *args, **kwargs):
+            return fn(*args, **kwargs)
+        main.run_db = main.run_db_write = run_inline
+        ralph_loop.run_db = ralph_loop.run_db_write = run_inline
+
+    async def lag_monitor(stalls: list, stop: asyncio.Event):
+        interval = 0.005
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            stalls.append(max(0.0, time.perf_counter() - t0 - interval))
+
+    async def write(writes: list, fn, *args, **kwargs):
+        """记录 (端到端耗时, DB 耗时)：DB 耗时到 fn 在写线程里返回为止，不含之后等事件循环调度的时间"""
+        done = []
+
+        def call():
+            result = fn(*args, **kwargs)
+            done.append(time.perf_counter())
+            return result
+
+        t0 = time.perf_counter()
+        result = await main.run_db_write(call)
+        writes.append((time.perf_counter() - t0, done[0] - t0))
+        return result
+
+    async def dispatcher(writes: list, stop: asyncio.Event):
+        # 模拟分发循环：入队 → 认领 → 完成
+        while not stop.is_set():
+            [task_id] = await write(writes, main.tq.add_tasks, [{"project": "bench", "title": "w", "prompt": "y"}])
+            await write(writes, main.tq.claim_assignments, {task_id: 1})
+            await write(writes, main.tq.finish_task, task_id, 1, "done", "ok")
+            await asyncio.sleep(0.01)
+
+    async def run():
+        server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning", lifespan="off"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+        results.put("ready")
+        await asyncio.sleep(0.5)
+        stop = asyncio.Event()
+        stalls, writes = [], []
+        tasks = [asyncio.create_task(lag_monitor(stalls, stop)), asyncio.create_task(dispatcher(writes, stop))]
+        await asyncio.sleep(seconds)
+        stop.set()
+        await asyncio.gather(*tasks)
+        server.should_exit = True
+        await server_task
+        results.put({"stalls": stalls, "writes": writes})
+
+    asyncio.run(run())
+
+
+async def http_get(reader, writer, path: str) -> int:
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def readers(port: int, count: int, seconds: float, seed: int) -> list:
+    latencies = []
+    deadline = time.monotonic() + seconds
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            while time.monotonic() < deadline:
+                path = "/api/tasks?limit=30" if random.random() < 0.5 else f"/api/tasks/{random.randint(1, seed)}"
+                t0 = time.perf_counter()
+                await http_get(reader, writer, path)
+                latencies.append(time.perf_counter() - t0)
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(count)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i, mode in enumerate(("inline", "executor")):
+            port = 18700 + i
+            results = mp.Queue()
+            proc = mp.Process(target=serve, args=(mode, workdir, port, args.seconds + 0.5, args.seed, results))
+            proc.start()
+            results.get()
+            reads = asyncio.run(readers(port, args.readers, args.seconds, args.seed))
+            stats = results.get()
+            proc.join()
+
+            stalls, writes = stats["stalls"], stats["writes"]
+            e2e, db = [w[0] for w in writes], [w[1] for w in writes]
+            print(f"{mode:>8}: reads={len(reads) / args.seconds:7.0f}/s "
+                  f"read p50={statistics.median(reads) * 1000:6.1f}ms p99={percentile(reads, 0.99) * 1000:7.1f}ms | "
+                  f"writes={len(writes)} p99={percentile(e2e, 0.99) * 1000:7.1f}ms "
+                  f"(db p99={percentile(db, 0.99) * 1000:6.1f}ms) | "
+                  f"loop stall total={sum(stalls):5.2f}s p99={percentile(stalls, 0.99) * 1000:6.1f}ms "
+                  f"max={max(stalls) * 1000:6.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
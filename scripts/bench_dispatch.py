@@ -0,0 +1,88 @@
+"""
+提交 → 开始执行 延迟基准测试
+
+用大量短任务压测 RalphLoop，对比：
+  - poll   : 仅靠定时轮询（旧行为，interval=5s）
+  - notify : 入队 / worker 释放时立即唤醒
+
+用法: python scripts/bench_dispatch.py [--tasks 20] [--workers 2] [--task-ms 50]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from task_queue import TaskQueue
+from ralph_loop import RalphLoop
+from task_logs import TaskLogStore
+
+
+class BenchLoop(RalphLoop):
+    """不真正调用 claude，只记录任务开始时间"""
+
+    def __init__(self, task_ms: int, **kwargs):
+        super().__init__(**kwargs)
+        self.task_ms = task_ms
+        self.started = {}
+
+    async def _execute_cc(self, task: dict, worktree_path: str) -> dict:
+        self.started[task["id"]] = time.monotonic()
+        await asyncio.sleep(self.task_ms / 1000)
+        return {"success": True, "stdout": "ok", "stderr": "", "returncode": 0}
+
+
+async def run(mode: str, num_tasks: int, num_workers: int, task_ms: int, workdir: str) -> list:
+    tq = TaskQueue(db_path=os.path.join(workdir, f"{mode}.db"))
+    loop = BenchLoop(task_ms=task_ms, num_workers=num_workers, tq=tq, logs=TaskLogStore(workdir))
+
+    async def get_worktree(worker_id, project, task_id=None):
+        return workdir
+
+    loop.wm.get_worktree = get_worktree
+    if mode == "poll":
+        loop.interval = 5
+        loop.notify = lambda: None
+
+    runner = asyncio.create_task(loop.start())
+    submitted = {}
+    for i in range(num_tasks):
+        task_id = tq.add_tasks([{"project": "bench", "title": f"t{i}", "prompt": f"noop {i}"}])[0]
+        submitted[task_id] = time.monotonic()
+        loop.notify()
+        await asyncio.sleep(task_ms / 1000 / num_workers)
+
+    while len(loop.started) < num_tasks:
+        await asyncio.sleep(0.01)
+    await loop.stop()
+    await runner
+    return [loop.started[i] - submitted[i] for i in submitted]
+
+
+def report(mode: str, waits: list):
+    waits = sorted(w * 1000 for w in waits)
+    p99 = waits[min(len(waits) - 1, int(len(waits) * 0.99))]
+    print(f"{mode:>7}: n={len(waits)} mean={statistics.mean(waits):8.1f}ms "
+          f"p50={statistics.median(waits):8.1f}ms p99={p99:8.1f}ms max={waits[-1]:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--task-ms", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ("poll", "notify"):
+            waits = asyncio.run(run(mode, args.tasks, args.workers, args.task_ms, workdir))
+            report(mode, waits)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+公平分享调度基准测试
+
+在临时 DB 上模拟：bulk 项目先批量提交大量任务，随后 small（权重 1）和 vip（权重 3）各提交一批，
+worker 每步跑完一个任务。对比：
+  - fifo : 旧行为，按 priority DESC, id ASC 全局取（QueueIndex aging=0 下的全局排序）
+  - fair : QueueIndex 增量快照 + Scheduler.order / assign（start-time fair queuing）
+输出各项目的平均等待步数和前 N 次分发中的占比；另外检查老化，并对比每轮全量重建快照与增量同步快照的耗时。
+
+用法: python scripts/bench_fair_share.py [--bulk 200] [--workers 2]
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from sqlalchemy import update
+from models import Task
+from queue_index import QueueIndex
+from scheduler import Scheduler
+from task_queue import TaskQueue
+
+WEIGHTS = {"vip": 3.0}
+
+
+def submit(tq: TaskQueue, project: str, count: int, priority: int = 0) -> list:
+    return tq.add_tasks([{"project": project, "title": f"{project} {i}", "prompt": f"{project} {i}",
+                          "priority": priority} for i in range(count)])
+
+
+def simulate(mode: str, bulk: int, workers: int, workdir: str) -> dict:
+    tq = TaskQueue(db_path=os.path.join(workdir, f"{mode}.db"))
+    submitted = {}
+    for project, count in (("bulk", bulk), ("small", 10), ("vip", 30)):
+        for task_id in submit(tq, project, count):
+            submitted[task_id] = project
+    index, scheduler = QueueIndex(aging=0) if mode == "fifo" else QueueIndex(), Scheduler(weights=WEIGHTS)
+    slots = {w: {"id": w, "project": None, "busy": None} for w in range(1, workers + 1)}
+    dispatched = []  # (step, task_id)
+    step = 0
+    while len(dispatched) < len(submitted):
+        for slot in slots.values():
+            if slot["busy"]:
+                tq.finish_task(slot["busy"], slot["id"], "done", "ok")
+                slot["busy"] = None
+        idle = [s for s in slots.values() if not s["busy"]]
+        since = index.since()
+        index.apply(*tq.queue_changes(since), full=since is None)
+        if mode == "fifo":
+            head = sorted(entry for queue in index.queues.values() for entry in queue)[:len(idle)]
+            pairs = [(w, {"id": task_id}) for w, (_, task_id) in zip(idle, head)]
+        else:
+            pairs = scheduler.assign(idle, scheduler.order(index), index.running)
+        claimed = tq.claim_assignments({t["id"]: w["id"] for w, t in pairs})
+        index.mark_running(claimed)
+        scheduler.charge(claimed)
+        for task in claimed:
+            slots[task["worker_id"]].update(busy=task["id"], project=task["project"])
+            dispatched.append((step, task["id"]))
+        step += 1
+    waits = {}
+    for at, task_id in dispatched:
+        waits.setdefault(submitted[task_id], []).append(at)
+    head = [submitted[task_id] for _, task_id in dispatched[:40]]
+    return {project: (statistics.mean(w), head.count(project)) for project, w in waits.items()}
+
+
+def check_aging(workdir: str):
+    """1 小时前提交的低优先级任务应排在刚提交的高一级任务前面（aging=600s，+6）"""
+    tq = TaskQueue(db_path=os.path.join(workdir, "aging.db"))
+    old = submit(tq, "p", 1, priority=0)[0]
+    fresh = submit(tq, "p", 5, priority=1)
+    with tq.Session() as session:
+        session.execute(update(Task).where(Task.id == old).values(created_at=datetime.utcnow() - timedelta(hours=1)))
+        session.commit()
+    index = QueueIndex(aging=600)
+    index.apply(*tq.queue_changes(None), full=True)
+    order = [t["id"] for t in index.head("p", 10)]
+    assert order == [old] + fresh, order
+    index = QueueIndex(aging=0)
+    index.apply(*tq.queue_changes(None), full=True)
+    assert [t["id"] for t in index.head("p", 10)] == fresh + [old]
+
+
+def bench_sync(workdir: str, queued: int, iters: int = 50):
+    tq = TaskQueue(db_path=os.path.join(workdir, "sync.db"))
+    for i in range(0, queued, 5000):
+        tq.add_tasks([{"project": f"proj-{j % 8}", "title": "t", "prompt": f"p {i + j}"} for j in range(5000)])
+    index, scheduler = QueueIndex(), Scheduler()
+    start = time.perf_counter()
+    index.apply(*tq.queue_changes(None), full=True)
+    full = time.perf_counter() - start
+
+    def timed(fn, iters: int = iters) -> float:
+        samples = []
+        for _ in range(iters):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return statistics.median(samples) * 1000
+
+    def fair_round():
+        index.apply(*tq.queue_changes(index.version))
+        scheduler.order(index)
+
+    def reload_round():
+        rebuilt = QueueIndex()
+        rebuilt.apply(*tq.queue_changes(None), full=True)
+        scheduler.order(rebuilt)
+
+    reload = timed(reload_round, iters=5)
+    fair = timed(fair_round)
+    print(f"sync ({queued} queued): initial load {full * 1000:.1f}ms, "
+          f"per round: full reload + order p50={reload:.2f}ms, incremental sync + order p50={fair:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bulk", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--queued", type=int, default=20000)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in ("fifo", "fair"):
+            result = simulate(mode, args.bulk, args.workers, workdir)
+            print(f"{mode:>5}: " + "  ".join(f"{p}: mean wait={w:6.1f} steps, first-40 share={n:2d}"
+                                             for p, (w, n) in sorted(result.items())))
+        check_aging(workdir)
+        print("aging: OK")
+        bench_sync(workdir, args.queued)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+单任务启动开销基准测试
+
+用一个立即输出 result 事件并退出的假 claude，对比每个任务从启动到结束的耗时：
+  - script : 旧方式，写临时脚本 → chmod → os.system(chown) → su → bash → exec claude
+  - direct : runner.Runner，create_subprocess_exec 直接 exec claude（降权由 subprocess 完成）
+同时记录压测期间事件循环的最大卡顿（os.system 是同步调用，会阻塞事件循环）。
+需要以 root 运行（su / chown / 切换用户），--user 默认是当前用户。
+
+用法: python scripts/bench_launch.py [--tasks 50] [--concurrency 4] [--user ccuser]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import pwd
+import shlex
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from runner import Runner
+from task_logs import TaskLogStore, capture_output
+
+FAKE_CLAUDE = """#!/bin/sh
+echo '{"type":"result","subtype":"success","is_error":false,"result":"ok"}'
+"""
+
+
+async def launch_script(task: dict, workdir: str, claude: str, user: str, logs: TaskLogStore):
+    """旧的 RalphLoop._execute_cc 启动路径"""
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".sh", delete=False, dir="/tmp") as f:
+        script_path = f.name
+        f.write(f"""#!/bin/bash
+export ANTHROPIC_API_KEY='{os.getenv("ANTHROPIC_API_KEY", "")}'
+export HOME={shlex.quote(pwd.getpwnam(user).pw_dir)}
+cd {shlex.quote(workdir)}
+exec {claude} -p {shlex.quote(task["prompt"])} --output-format stream-json --verbose
+""")
+    try:
+        os.chmod(script_path, 0o755)
+        os.system(f"chown {user}:{user} {script_path}")
+        proc = await asyncio.create_subprocess_exec(
+            "su", "-s", "/bin/bash", user, script_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        output = await capture_output(proc, task["id"], logs)
+        assert proc.returncode == 0 and output["stdout"] == "ok", output
+    finally:
+        os.unlink(script_path)
+
+
+async def launch_direct(task: dict, workdir: str, runner: Runner):
+    result = await runner.run(task, workdir)
+    assert result["success"], result
+
+
+async def run(mode: str, tasks: int, concurrency: int, user: str, root: str) -> tuple:
+    claude = os.path.join(root, "claude")
+    logs = TaskLogStore(os.path.join(root, f"logs-{mode}"))
+    runner = Runner(logs, run_as=user)
+    runner.claude = claude
+    sem = asyncio.Semaphore(concurrency)
+    durations, lag = [], [0.0]
+    stop = asyncio.Event()
+
+    async def probe():
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            lag[0] = max(lag[0], loop.time() - start - 0.001)
+
+    async def one(task_id: int):
+        async with sem:
+            task = {"id": task_id, "prompt": f"task {task_id}", "mode": "execute"}
+            start = time.perf_counter()
+            if mode == "script":
+                await launch_script(task, root, claude, user, logs)
+            else:
+                await launch_direct(task, root, runner)
+            durations.append(time.perf_counter() - start)
+
+    prober = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(1, tasks + 1)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await prober
+    return durations, elapsed, lag[0]
+
+
+def report(mode: str, durations: list, elapsed: float, lag: float):
+    ms = sorted(d * 1000 for d in durations)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{mode:>6}: n={len(ms)} mean={statistics.mean(ms):7.1f}ms p50={statistics.median(ms):7.1f}ms "
+          f"p95={p95:7.1f}ms total={elapsed:6.2f}s max_loop_lag={lag * 1000:6.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--user", default=pwd.getpwuid(os.geteuid()).pw_name)
+    args = parser.parse_args()
+    if os.geteuid() != 0:
+        sys.exit("must run as root (su / chown)")
+    logging.disable(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as root:
+        os.chmod(root, 0o755)
+        with open(os.path.join(root, "claude"), "w") as f:
+            f.write(FAKE_CLAUDE)
+        os.chmod(os.path.join(root, "claude"), 0o755)
+        for mode in ("script", "direct"):
+            report(mode, *asyncio.run(run(mode, args.tasks, args.concurrency, args.user, root)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+TaskQueue 查询基准测试
+
+向临时 DB 灌入大量任务，分别在无索引 / 有索引（TaskQueue 迁移后）两种状态下
+统计 get_task、list_tasks、queue_changes（分发循环每轮的增量同步）的 p50/p99 延迟。
+
+用法: python scripts/bench_task_queue.py [--rows 500000] [--iters 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from sqlalchemy import create_engine, insert, text
+from models import Base, Task
+from task_queue import TaskQueue
+
+STATUSES = ["done"] * 90 + ["failed"] * 6 + ["queued"] * 3 + ["running"]
+
+
+def seed(db_path: str, rows: int):
+    engine = create_engine(f"sqlite:///{db_path}")
+    Base.metadata.create_all(engine)
+    start = datetime.utcnow() - timedelta(days=365)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            batch.append({
+                "project": f"proj-{i % 8}",
+                "title": f"task {i}",
+                "prompt": "x" * 500,
+                "result": "y" * 2000,
+                "priority": random.randint(0, 3),
+                "status": random.choice(STATUSES),
+                "mode": "execute",
+                "created_at": start + timedelta(seconds=i * 60),
+            })
+            if len(batch) == 10000:
+                conn.execute(insert(Task), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Task), batch)
+    engine.dispose()
+
+
+def drop_indexes(tq: TaskQueue):
+    """模拟迁移前的旧 tasks.db"""
+    with tq.engine.begin() as conn:
+        for index in Task.__table__.indexes:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+
+def measure(name: str, fn, iters: int):
+    samples = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"  {name:<22} p50={statistics.median(samples):8.3f}ms p99={p99:8.3f}ms")
+
+
+def bench(tq: TaskQueue, rows: int, iters: int):
+    measure("get_task", lambda: tq.get_task(random.randint(1, rows)), iters)
+    measure("list_tasks", lambda: tq.list_tasks(limit=30), iters)
+    measure("list_tasks(queued)", lambda: tq.list_tasks(status="queued", limit=30), iters)
+    measure("queue_changes(since)", lambda: tq.queue_changes(0), iters)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--iters", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "tasks.db")
+        t0 = time.time()
+        seed(db_path, args.rows)
+        print(f"seeded {args.rows} tasks in {time.time() - t0:.1f}s")
+        tq = TaskQueue(db_path=db_path)
+
+        drop_indexes(tq)
+        print("without indexes:")
+        # 旧版详情接口：list_tasks(limit=10000) 后在 Python 里线性查找
+        def old_get_task():
+            task_id = args.rows - random.randint(0, 9999)
+            return next(t for t in tq.list_tasks(limit=10000) if t.id == task_id)
+
+        measure("get_task (old scan)", old_get_task, 5)
+        bench(tq, args.rows, max(10, args.iters // 10))
+
+        t0 = time.time()
+        tq._migrate(tq.engine)
+        print(f"with indexes (migration took {time.time() - t0:.1f}s):")
+        bench(tq, args.rows, args.iters)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+git 提交 / 推送流水线自检（本地 bare 仓库，不需要网络）
+
+建一个 bare 仓库作为 origin，clone 后开 N 个 worktree 模拟 N 个任务各自改文件，
+全部交给 GitPipeline，检查：
+  - 每个任务分支都推到了 origin，SHA 与记录一致
+  - 同一仓库的 N 个分支合并成 1 次 git push
+  - worktree 在提交后立即归还（不等推送）
+  - 推送到不可达的远端时按退避重试，最终标记 failed
+
+用法: python scripts/check_git_pipeline.py [--tasks 5]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from git_pipeline import GitPipeline
+
+
+def git(*args, cwd=None) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def make_repo(root: str, tasks: int, remote: str = None) -> list:
+    origin = os.path.join(root, "origin.git")
+    main = os.path.join(root, "main")
+    git("init", "-q", "--bare", "-b", "main", origin)
+    git("clone", "-q", origin, main)
+    git("config", "user.email", "check@example.com", cwd=main)
+    git("config", "user.name", "check", cwd=main)
+    with open(os.path.join(main, "README"), "w") as f:
+        f.write("base\n")
+    git("add", "-A", cwd=main)
+    git("commit", "-q", "-m", "base", cwd=main)
+    git("push", "-q", "origin", "HEAD:main", cwd=main)
+    if remote:
+        git("remote", "set-url", "origin", remote, cwd=main)
+    paths = []
+    for task_id in range(1, tasks + 1):
+        path = os.path.join(root, f"pool-{task_id}")
+        git("worktree", "add", "-q", "-b", f"task-{task_id}", path, cwd=main)
+        with open(os.path.join(path, f"task-{task_id}.txt"), "w") as f:
+            f.write(f"task {task_id}\n")
+        paths.append(path)
+    return paths
+
+
+async def run(tasks: int, remote: str = None, timeout: float = 30, **kwargs) -> tuple:
+    updates = {}
+
+    async def on_update(task_id, fields):
+        updates.setdefault(task_id, {}).update(fields)
+
+    released = {}
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_repo(root, tasks, remote)
+        pipeline = GitPipeline(on_update=on_update, **kwargs)
+        runner = asyncio.create_task(pipeline.run())
+        start = time.monotonic()
+        for task_id, path in enumerate(paths, 1):
+            pipeline.submit({"id": task_id, "title": f"check {task_id}"}, path,
+                            lambda p: released.setdefault(p, time.monotonic() - start))
+        final = {"pushed", "failed"}
+        while time.monotonic() - start < timeout:
+            if len(updates) == tasks and all(u.get("push_status") in final for u in updates.values()):
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.monotonic() - start
+        remote_refs = {}
+        if remote is None:
+            for line in git("ls-remote", os.path.join(root, "origin.git")).splitlines():
+                sha, ref = line.split("\t")
+                remote_refs[ref] = sha
+        runner.cancel()
+    return pipeline, updates, released, remote_refs, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=5)
+    args = parser.parse_args()
+
+    pipeline, updates, released, refs, elapsed = asyncio.run(run(args.tasks, batch_window=0.5))
+    print(f"local bare repo: {args.tasks} tasks in {elapsed:.2f}s, stats={pipeline.stats()}")
+    print(f"  worktrees released after commit at: "
+          f"{', '.join(f'{t:.2f}s' for t in sorted(released.values()))}")
+    for task_id, fields in sorted(updates.items()):
+        ok = refs.get(f"refs/heads/task-{task_id}") == fields.get("commit_sha")
+        print(f"  task #{task_id}: {fields.get('push_status')} {fields.get('commit_sha', '')[:10]} "
+              f"{'OK' if ok else 'MISMATCH'}")
+        assert ok and fields["push_status"] == "pushed"
+    assert pipeline.pushes == 1, "pushes for one repo should be batched"
+    assert len(released) == args.tasks
+
+    pipeline, updates, _, _, elapsed = asyncio.run(run(
+        2, remote="https://unreachable.invalid/repo.git", batch_window=0.1, retry_base=0.2, max_retries=2))
+    print(f"unreachable remote: {elapsed:.2f}s, stats={pipeline.stats()}")
+    for task_id, fields in sorted(updates.items()):
+        print(f"  task #{task_id}: {fields.get('push_status')} ({(fields.get('push_error') or '')[:80]})")
+        assert fields["push_status"] == "failed"
+    assert pipeline.pushes == 3, "one push plus two retries"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+合并队列自检（本地 bare 仓库，不需要网络）
+
+N 个任务各自在 pool worktree 的 task-{id} 分支上提交并推送，其中一个和其他任务改同一个文件，
+一个改坏了检查命令依赖的文件，交给 MergeQueue 后检查：
+  - 改动不冲突的任务全部合入 main，一次落地多条
+  - 和已合入任务冲突的任务标记 conflict
+  - 配置了 merge_check 时，检查失败的任务被剔除，后面的任务照常落地
+  - 路径重叠提示：prompt 中提到的文件能被识别出来
+
+用法: python scripts/check_merge_queue.py [--tasks 6]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../backend"))
+from merge_queue import MergeQueue
+from runner import Runner
+from task_logs import TaskLogStore
+from worktree_pool import WorktreePool
+
+
+def git(*args, cwd=None) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def write(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+async def run(tasks: int, check: bool) -> tuple:
+    updates = {}
+
+    async def on_update(task_id, fields):
+        updates.setdefault(task_id, {}).update(fields)
+
+    with tempfile.TemporaryDirectory() as root:
+        origin = os.path.join(root, "origin.git")
+        seed = os.path.join(root, "seed")
+        git("init", "-q", "--bare", "-b", "main", origin)
+        git("clone", "-q", origin, seed)
+        write(os.path.join(seed, "shared.txt"), "base\n")
+        write(os.path.join(seed, "check.sh"), "test ! -e broken\n")
+        write(os.path.join(seed, "src/app/views.py"), "# views\n")
+        git("add", "-A", cwd=seed)
+        git("-c", "user.name=seed", "-c", "user.email=seed@example.com", "commit", "-q", "-m", "base", cwd=seed)
+        git("push", "-q", "origin", "HEAD:main", cwd=seed)
+
+        cfg = {"repo": origin, "branch": "main", "pool_size": tasks, "merge_queue": True}
+        if check:
+            cfg["merge_check"] = "sh check.sh"
+        pool = WorktreePool(os.path.join(root, "ws"), projects={"demo": cfg})
+        await pool.prepare("demo")
+        main_dir = pool.projects["demo"].main_dir
+        git("config", "user.name", "check", cwd=main_dir)
+        git("config", "user.email", "check@example.com", cwd=main_dir)
+
+        queue = MergeQueue(pool, {"demo": cfg}, Runner(TaskLogStore(os.path.join(root, "logs"))), on_update=on_update)
+        runner = asyncio.create_task(queue.run())
+        conflicting, broken = 2, 4
+        for task_id in range(1, tasks + 1):
+            path = await pool.checkout("demo", task_id)
+            write(os.path.join(path, f"task-{task_id}.txt"), f"task {task_id}\n")
+            if task_id in (1, conflicting):
+                write(os.path.join(path, "shared.txt"), f"changed by task {task_id}\n")
+            if task_id == broken:
+                write(os.path.join(path, "broken"), "x\n")
+            git("add", "-A", cwd=path)
+            git("commit", "-q", "-m", f"task {task_id}", cwd=path)
+            git("push", "-q", "origin", f"task-{task_id}", cwd=path)
+            await queue.submit(task_id, "demo", f"task {task_id}", f"task-{task_id}", git("rev-parse", "HEAD", cwd=path))
+
+        start = time.monotonic()
+        final = {"merged", "conflict", "check_failed", "failed"}
+        while time.monotonic() - start < 60:
+            if len(updates) == tasks and all(u.get("merge_status") in final for u in updates.values()):
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.monotonic() - start
+        landed = git("log", "--format=%s", "main", cwd=origin).splitlines()
+        hints = await queue.predict_paths("demo", "修改 views.py 和 ./shared.txt，参考 src/app/views.py")
+        runner.cancel()
+    return queue, updates, landed, hints, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=6)
+    args = parser.parse_args()
+
+    for check in (False, True):
+        queue, updates, landed, hints, elapsed = asyncio.run(run(args.tasks, check))
+        print(f"merge_check={'on' if check else 'off'}: {elapsed:.2f}s, stats={queue.stats()}")
+        for task_id, fields in sorted(updates.items()):
+            print(f"  task #{task_id}: {fields['merge_status']} {fields.get('merge_error') or ''}"[:120])
+        print(f"  main: {landed[:3]} ... ({len(landed)} commits)")
+        expected = {2: "conflict", 4: "check_failed" if check else "merged"}
+        for task_id, fields in updates.items():
+            assert fields["merge_status"] == expected.get(task_id, "merged"), (task_id, fields)
+        assert hints == {"src/app/views.py", "shared.txt"}, hints
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()